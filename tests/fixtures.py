@@ -33,20 +33,29 @@ def setup_station_connections(rdbms_connection, rdbms_admin_connection, neo4j_db
 
 
 @pytest.fixture
-def setup_connection(setup_train, setup_stations):  # for test_buy_ticket
-    # Define the connections for testing purposes
+def setup_schedule(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train, setup_station_connections):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    # The train runs over all the connected stations every day of 2024 at 08:00, waiting 5 minutes at each stop
+    stops = [(station_key, 5) for station_key in setup_station_connections]
+    t.add_schedule(setup_train, 8, 0, stops, 1, 1, 2024, 31, 12, 2024)
+    return stops
+
+
+@pytest.fixture
+def setup_connection(setup_train, setup_station_connections):  # for test_buy_ticket
+    # Define the connections for testing purposes (over the connected stations: tickets are priced from their edges)
     train_id = setup_train.to_int()  # Call the setup_train fixture to get the train_id
     connections = [
         {
             'train_id': train_id,  # Use the train_id from the setup_train fixture
-            'starting_station_key': setup_stations[0].to_int(),  # Use the key from the setup_stations fixture
-            'ending_station_key': setup_stations[1].to_int(),  # Use the key from the setup_stations fixture
-            'travel_time': 20
+            'starting_station_key': setup_station_connections[0].to_int(),  # Use the key from the setup_station_connections fixture
+            'ending_station_key': setup_station_connections[1].to_int(),  # Use the key from the setup_station_connections fixture
+            'travel_time': 30
         },
         {
             'train_id': train_id,  # Use the same train_id for the second connection
-            'starting_station_key': setup_stations[1].to_int(),  # Use the key from the setup_stations fixture
-            'ending_station_key': setup_stations[2].to_int(),  # Use the key from the setup_stations fixture
+            'starting_station_key': setup_station_connections[1].to_int(),  # Use the key from the setup_station_connections fixture
+            'ending_station_key': setup_station_connections[2].to_int(),  # Use the key from the setup_station_connections fixture
             'travel_time': 30
         }
         # Add more connections as needed
@@ -82,3 +91,46 @@ def setup_purchase_history(rdbms_admin_connection, setup_user, setup_train):
 
     return user_email
 
+
+@pytest.fixture
+def connection_pools(mariadb, mariadb_host, mariadb_port, mariadb_database):
+    # ConnectionPools for the user and the admin role (closed at the end of the test)
+    from functools import partial
+    from traits.pool import ConnectionPool
+    import mysql.connector
+
+    def pool(user, password, size):
+        return ConnectionPool(partial(mysql.connector.connect, host=mariadb_host, port=mariadb_port,
+                                      database=mariadb_database, user=user, password=password), size=size, timeout=10)
+
+    pools = pool(BASE_USER_NAME, BASE_USER_PASS, 4), pool(ADMIN_USER_NAME, ADMIN_USER_PASS, 2)
+    yield pools
+    for connection_pool in pools:
+        connection_pool.close()
+
+
+@pytest.fixture
+def open_async_traits(mariadb, mariadb_host, mariadb_port, mariadb_database, neo4j_db, neo4j_db_host, neo4j_db_port):
+    # opens an AsyncTraits on aiomysql pools (user and admin role) and an async Neo4j driver, closed at the end of the
+    # block: they are bound to the event loop, so they are created within the running one
+    from contextlib import asynccontextmanager
+    import aiomysql
+    from neo4j import AsyncGraphDatabase
+    from traits.async_implementation import AsyncTraits
+
+    @asynccontextmanager
+    async def open_traits(user_pool_size=4, admin_pool_size=2):
+        pools = [await aiomysql.create_pool(host=mariadb_host, port=int(mariadb_port), db=mariadb_database,
+                                            user=user, password=password, maxsize=size)
+                 for user, password, size in ((BASE_USER_NAME, BASE_USER_PASS, user_pool_size),
+                                              (ADMIN_USER_NAME, ADMIN_USER_PASS, admin_pool_size))]
+        driver = AsyncGraphDatabase.driver(f"neo4j://{neo4j_db_host}:{neo4j_db_port}")
+        try:
+            yield AsyncTraits(*pools, driver)
+        finally:
+            for pool in pools:
+                pool.close()
+                await pool.wait_closed()
+            await driver.close()
+
+    return open_traits
@@ -1,6 +1,15 @@
 
 from public.traits.interface import BASE_USER_NAME, BASE_USER_PASS, ADMIN_USER_NAME, ADMIN_USER_PASS
 from traits.implementation import Traits, TraitsUtility
+from traits.cache import SearchCache, TrainStatusCache
+from traits.validation import MissingKeysError
+from traits.statements import PreparedStatements
+from traits.fares import FareTable
+from traits.routing import ConnectionScan, JourneyResults, SORTING_KEYS, build_connections
+from traits.raptor import Raptor
+from traits.contraction import ContractionHierarchy, dijkstra
+from traits.csr import CSRGraph
+from traits.replicas import ReplicaRouter
 from public.traits.interface import TraitsKey, TrainStatus, SortingCriteria
 import pytest
 from tests.fixtures import *
@@ -47,7 +56,9 @@ def test_generate_sql_initialization_code(rdbms_connection, rdbms_admin_connecti
                 start_station_key INT NOT NULL,
                 end_station_key INT NOT NULL,
                 FOREIGN KEY (user_email) REFERENCES Users(email),
-                FOREIGN KEY (train_id) REFERENCES Trains(train_id)
+                FOREIGN KEY (train_id) REFERENCES Trains(train_id),
+                INDEX tickets_by_user (user_email, reserved_seat),
+                INDEX tickets_by_train (train_id, reserved_seat)
             );
             """,
             """
@@ -57,7 +68,41 @@ def test_generate_sql_initialization_code(rdbms_connection, rdbms_admin_connecti
                 purchase_date DATETIME NOT NULL,
                 FOREIGN KEY (user_email) REFERENCES Users(email),
                 FOREIGN KEY (ticket_id) REFERENCES Tickets(ticket_id),
-                PRIMARY KEY (user_email, ticket_id)
+                PRIMARY KEY (user_email, ticket_id),
+                INDEX purchase_history_by_date (user_email, purchase_date DESC, ticket_id DESC)
+                );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS TicketLegs (
+                ticket_id INT NOT NULL,
+                leg_order INT NOT NULL,
+                train_id INT NOT NULL,
+                start_station_key INT NOT NULL,
+                end_station_key INT NOT NULL,
+                price FLOAT NOT NULL,
+                reserved_seat BIT NOT NULL DEFAULT 0,
+                FOREIGN KEY (ticket_id) REFERENCES Tickets(ticket_id) ON DELETE CASCADE,
+                FOREIGN KEY (train_id) REFERENCES Trains(train_id),
+                PRIMARY KEY (ticket_id, leg_order),
+                INDEX ticket_legs_by_train (train_id, reserved_seat)
+                );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS RefundQueue (
+                queue_id INT AUTO_INCREMENT PRIMARY KEY,
+                ticket_id INT NOT NULL,
+                train_id INT NOT NULL,
+                queued_at DATETIME NOT NULL,
+                FOREIGN KEY (ticket_id) REFERENCES Tickets(ticket_id) ON DELETE CASCADE,
+                INDEX refund_queue_by_train (train_id)
+                );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS Outbox (
+                outbox_id INT AUTO_INCREMENT PRIMARY KEY,
+                operation VARCHAR(64) NOT NULL,
+                payload VARCHAR(1024) NOT NULL,
+                created_at DATETIME NOT NULL
                 );
             """
         ]
@@ -66,6 +111,90 @@ def test_generate_sql_initialization_code(rdbms_connection, rdbms_admin_connecti
 
     assert len(expected_statements) == len(actual_statements)  # The number of SQL statements should match
 
+def test_query_plans(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_purchase_history):
+    from traits.explain import extract_sql_statements, full_table_scans
+    utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    statements, dynamic = extract_sql_statements()
+    assert any("FROM PurchaseHistory" in statement for statement in statements)
+    assert all("{" not in statement for statement in statements)
+
+    # every access path to Tickets and PurchaseHistory is covered by an index
+    assert utils.find_full_table_scans() == []
+
+    assert any("FROM Users WHERE email IN" in statement for statement in statements)  # the existence check is covered
+
+    # and the check does find the scans
+    assert full_table_scans(rdbms_admin_connection, ["SELECT * FROM Tickets WHERE price = %s"]) == [
+        ("SELECT * FROM Tickets WHERE price = %s", "Tickets")]
+
+    # on a non-trivial table, also a scan ignoring an available index (tickets_by_train) is reported
+    ignoring_index = "SELECT * FROM Tickets WHERE train_id <> %s"
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.executemany("INSERT INTO Tickets (user_email, train_id, reserved_seat, price, purchase_date, start_station_key, end_station_key) VALUES (%s, %s, %s, %s, NOW(), %s, %s)",
+                           [(setup_purchase_history, 1, False, 10.0, 1, 2)] * 2000)
+        cursor.execute("ANALYZE TABLE Tickets")
+        cursor.fetchall()
+    rdbms_admin_connection.commit()
+    assert full_table_scans(rdbms_admin_connection, [ignoring_index], min_rows=1000) == [(ignoring_index, "Tickets")]
+    assert full_table_scans(rdbms_admin_connection, [ignoring_index], min_rows=10 ** 6) == []
+
+
+def test_initialize_neo4j(rdbms_connection, rdbms_admin_connection, neo4j_db):
+    utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    # Running the initialization twice must not fail (IF NOT EXISTS)
+    utils.initialize_neo4j()
+    utils.initialize_neo4j()
+
+    with neo4j_db.session() as session:
+        constraints = [record['name'] for record in session.run("SHOW CONSTRAINTS")]
+        indexes = {record['name']: record['state'] for record in session.run("SHOW INDEXES")}
+    assert "station_id_unique" in constraints, "Uniqueness constraint on stations not created"
+    assert "schedule_trip_id_unique" in constraints, "Uniqueness constraint on imported trips not created"
+    for name in ["schedule_train_id", "schedule_validity", "stop_station_id"]:
+        assert indexes.get(name) == "ONLINE", f"Index {name} not created or not online"
+
+
+def test_import_timetable(rdbms_connection, rdbms_admin_connection, neo4j_db, tmp_path):
+    utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    # A small timetable: three stations on a line, two trips of the same train
+    files = {
+        'stations.csv': "station_id,details\n1,A\n2,B\n3,C\n",
+        'edges.csv': "start_station_id,end_station_id,travel_time\n1,2,30\n2,3,20\n",
+        'trips.csv': "trip_id,train_id,starting_hours_24_h,starting_minutes,valid_from,valid_until,capacity\n"
+                     "t1,1,8,0,2024-01-01,2024-12-31,100\nt2,1,9,0,2024-01-01,2024-12-31,100\n",
+        'stop_times.csv': "trip_id,stop_sequence,station_id,waiting_time\n"
+                          "t1,0,1,0\nt1,1,2,5\nt1,2,3,0\nt2,0,1,0\nt2,1,2,5\n",
+    }
+    for name, content in files.items():
+        (tmp_path / name).write_text(content)
+    paths = [str(tmp_path / name) for name in files]
+    checkpoint = str(tmp_path / "checkpoint.json")
+
+    progress = []
+    stats = utils.import_timetable(*paths, batch_size=1, checkpoint_path=checkpoint, progress=progress.append)
+    assert (stats['stations'], stats['edges'], stats['trains'], stats['schedules'], stats['stops']) == (3, 2, 1, 2, 5), "Wrong statistics"
+    assert len(progress) == stats['batches'], "Progress not reported for every batch"
+    assert len(utils.get_all_schedules()) == 2, "Schedules not imported"
+    assert t.get_train_current_status(TraitsKey(1)) == TrainStatus.OPERATIONAL, "Train not imported"
+    assert len(t.search_connections(TraitsKey(1), TraitsKey(3))) == 1, "Imported timetable cannot be searched"
+
+    # Importing again after an interruption during the stop times does not duplicate anything
+    with open(checkpoint, "w") as file:
+        file.write('{"phase": "stop_times", "rows": 0}')
+    utils.import_timetable(*paths, checkpoint_path=checkpoint)
+    assert len(utils.get_all_schedules()) == 2, "Schedules imported twice"
+
+    # Invalid rows are reported with file and line
+    (tmp_path / "edges.csv").write_text("start_station_id,end_station_id,travel_time\n1,3,0\n")
+    with pytest.raises(ValueError) as exc_info:
+        utils.import_timetable(*paths)
+    assert str(exc_info.value) == "edges.csv, line 2: Invalid travel time", "Wrong error message"
+
+
 def test_get_all_users(rdbms_connection, rdbms_admin_connection, neo4j_db):
     # Create an instance of the TraitsUtility class and the Traits class (basic setup, through tests)
     utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
@@ -113,7 +242,7 @@ def test_get_all_schedules(rdbms_connection, rdbms_admin_connection, neo4j_db, s
 
     # Basic Features
     #######################################
-def test_search_connections(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_station_connections):
+def test_search_connections(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_station_connections, setup_schedule):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
     # Define the starting and ending stations
@@ -131,7 +260,7 @@ def test_search_connections(rdbms_connection, rdbms_admin_connection, neo4j_db,
     assert str(connections[-1]['end_key']) == ending_station_key.to_string(), "Ending station does not match"
 
 
-def test_search_connections_sorting(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_station_connections):
+def test_search_connections_sorting(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_station_connections, setup_schedule):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
     # Define the starting and ending stations
@@ -161,6 +290,178 @@ def test_search_connections_sorting(rdbms_connection, rdbms_admin_connection, ne
         # Check that the connections list is equal to its sorted copy
         assert connections == sorted_connections, "Connections are not sorted correctly"
 
+def test_search_connections_with_travel_time(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_schedule):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    # The schedule departs at 08:05 from the first station and arrives at 09:10 at the last one (2 x 30 minutes + 5 waiting)
+    connections = t.search_connections(setup_stations[0], setup_stations[-1], 1, 6, 2024, 8, 0)
+    assert len(connections) == 1, "The connection departing after 08:00 was not found"
+    assert connections[0]['travel_time'] == 65, "Wrong travel time"
+    assert connections[0]['changes'] == 0, "Wrong number of changes"
+    assert connections[0]['estimated_price'] == 30, "Wrong estimated price"
+
+    # No train departs after 09:00
+    assert len(t.search_connections(setup_stations[0], setup_stations[-1], 1, 6, 2024, 9, 0)) == 0, "Connection departs too early"
+
+    # Arriving before 09:00 is not possible
+    assert len(t.search_connections(setup_stations[0], setup_stations[-1], 1, 6, 2024, 9, 0, is_departure_time=False)) == 0, "Connection arrives too late"
+
+    # The schedule is not valid in 2025
+    assert len(t.search_connections(setup_stations[0], setup_stations[-1], 1, 6, 2025)) == 0, "Schedule is not valid on that day"
+
+
+def test_search_cache():
+    now = [0.0]
+    cache = SearchCache(max_size=2, ttl=10, clock=lambda: now[0])
+
+    cache.put("a", 1)
+    cache.put("b", 2)
+    assert cache.get("a") == 1, "Cached value not returned"
+    cache.put("c", 3)  # "b" is the least recently used entry
+    assert cache.get("b") is None, "Least recently used entry not evicted"
+
+    now[0] = 11  # all entries expired
+    assert cache.get("a") is None, "Expired entry returned"
+    assert cache.stats() == {'size': 1, 'hits': 1, 'misses': 2, 'evictions': 1, 'expirations': 1}, "Wrong counters"
+
+
+def test_search_connections_cache(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_train, setup_schedule):
+    cache = SearchCache()
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, search_cache=cache)
+
+    connections = t.search_connections(setup_stations[0], setup_stations[-1])
+    assert t.search_connections(setup_stations[0], setup_stations[-1]) == connections, "Cached result differs"
+    assert (cache.hits, cache.misses) == (1, 1), "Second search not answered by the cache"
+    t.search_connections(setup_stations[0], setup_stations[-1], sort_by=SortingCriteria.ESTIMATED_PRICE, is_ascending=False)
+    assert (cache.hits, cache.misses) == (2, 1), "Search done again for another sorting"
+
+    # Changing the timetable invalidates the cache
+    t.add_schedule(setup_train, 9, 0, setup_schedule, 1, 1, 2024, 31, 12, 2024)
+    assert len(cache) == 0, "Cache not invalidated"
+    assert len(t.search_connections(setup_stations[0], setup_stations[-1])) == len(connections) + 1, "Stale result returned"
+
+
+def test_journey_results():
+    journeys = [{'travel_time': travel_time, 'changes': changes, 'waiting_time': waiting_time, 'estimated_price': price, 'legs': []}
+                for travel_time, changes, waiting_time, price in [(65, 0, 0, 30), (50, 1, 5, 30), (65, 2, 10, 20), (80, 0, 0, 40)]]
+    results = JourneyResults(journeys)
+
+    # the partial sort returns what a full sort would
+    for sort_by, key in SORTING_KEYS.items():
+        for is_ascending in (True, False):
+            expected = sorted(journeys, key=lambda j: (j[key], j['travel_time']), reverse=not is_ascending)
+            for limit in (None, 0, 2, 10):
+                assert results.sort(sort_by, is_ascending, limit) == (expected if limit is None else expected[:limit])
+
+    results.sort(limit=1)[0]['travel_time'] = 0
+    assert results.sort(limit=1)[0]['travel_time'] == 50, "The sorted journeys must be copies"
+
+
+def test_raptor_pareto_front():
+    adjacency = {1: {2: (10, 5.0), 3: (60, 10.0)}, 2: {3: (10, 15.0)}}
+    schedules = [{'train_id': train_id, 'starting_hours_24_h': hours, 'starting_minutes': minutes, 'stops': [[station, 0] for station in stops]}
+                 for train_id, hours, minutes, stops in [(1, 8, 0, [1, 3]),  # slow and cheap
+                                                         (2, 8, 0, [1, 2]), (3, 8, 15, [2, 3]),  # fastest, with a change
+                                                         (4, 8, 30, [1, 2, 3]),  # no change
+                                                         (5, 10, 0, [1, 3])]]  # dominated by train 1
+    raptor = Raptor(build_connections(schedules, adjacency))
+
+    front = [(j['arrival_time'], j['changes'], j['estimated_price'], [leg['train_id'] for leg in j['legs']])
+             for j in raptor.search(1, 3)]
+    assert front == [(8 * 60 + 25, 1, 20, [2, 3]), (8 * 60 + 50, 0, 20, [4, 4]), (9 * 60, 0, 10, [1])]
+    assert [j['arrival_time'] for j in raptor.search(1, 3, max_changes=0)] == [8 * 60 + 50, 9 * 60]
+    assert [j['arrival_time'] for j in raptor.search(1, 3, departure_after=8 * 60 + 10)] == [8 * 60 + 50, 11 * 60]
+
+
+def test_raptor_overtaking_trips():
+    adjacency = {1: {2: (10, 5.0)}, 2: {3: (10, 5.0)}}
+    # same stations, but train 2 leaves later and overtakes train 1 waiting 40 minutes at station 2
+    schedules = [{'train_id': 1, 'starting_hours_24_h': 8, 'starting_minutes': 0, 'stops': [[1, 0], [2, 40], [3, 0]]},
+                 {'train_id': 2, 'starting_hours_24_h': 8, 'starting_minutes': 5, 'stops': [[1, 0], [2, 0], [3, 0]]}]
+    connections = build_connections(schedules, adjacency)
+    raptor = Raptor(connections)
+    assert len(raptor.routes) == 2, "Overtaking trips in the same route"
+
+    front = [(j['arrival_time'], j['changes'], j['estimated_price'], [leg['train_id'] for leg in j['legs']])
+             for j in raptor.search(1, 3)]
+    assert front == [(8 * 60 + 25, 0, 10, [2, 2])]
+    # the Connection Scan finds the same direct train
+    fastest = ConnectionScan(connections).search(1, 3)[0]
+    assert (fastest['travel_time'], fastest['changes'], [leg['train_id'] for leg in fastest['legs']]) == (20, 0, [2, 2])
+
+
+def test_search_pareto_connections(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_stations, setup_schedule):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    journeys = t.search_pareto_connections(setup_stations[0], setup_stations[-1])
+    assert [(j['travel_time'], j['changes'], j['estimated_price']) for j in journeys] == [(65, 0, 30)]
+
+    with pytest.raises(ValueError):
+        t.search_pareto_connections(setup_stations[0], setup_stations[0])
+
+
+def test_contraction_hierarchy(tmp_path):
+    adjacency = {1: {2: (10, 5.0), 3: (60, 10.0)}, 2: {3: (10, 15.0), 4: (5, 2.5)}, 4: {3: (10, 5.0)}, 5: {1: (1, 0.5)}}
+    for metric in ('travel_time', 'price'):
+        hierarchy = ContractionHierarchy.build(adjacency, metric)
+        hierarchy.save(tmp_path / "hierarchy.json")
+        for h in (hierarchy, ContractionHierarchy.load(tmp_path / "hierarchy.json")):
+            for source in adjacency:
+                for target in range(1, 6):
+                    if source != target:
+                        assert h.query(source, target) == dijkstra(adjacency, metric, source, target)
+    assert ContractionHierarchy.build(adjacency, 'price').query(1, 3) == (10, [1, 3])
+    assert hierarchy.is_fresh_for(adjacency) and not hierarchy.is_fresh_for({1: {2: (10, 5.0)}})
+
+
+def test_shortest_route(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_station_connections, tmp_path):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    first, middle, last = setup_station_connections
+    expected = {'start_key': 1, 'end_key': 3, 'stations': [1, 2, 3], 'travel_time': 60, 'estimated_price': 30}
+    assert t.shortest_route(first, last) == expected  # full search
+
+    t.prepare_hierarchies(tmp_path)
+    assert t.shortest_route(first, last) == expected
+    assert t.shortest_route(last, first, SortingCriteria.ESTIMATED_PRICE) is None
+    assert t.search_connections(last, first) == []  # not connected: answered without scanning the timetable
+
+    # the persisted hierarchies are fresh until the station graph changes
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    assert sorted(t.load_hierarchies(tmp_path)) == ['price', 'travel_time']
+    t.connect_train_stations(first, last, 10)
+    assert t.load_hierarchies(tmp_path) == []
+    assert t.shortest_route(first, last)['stations'] == [1, 3]  # stale hierarchies are not used
+
+    with pytest.raises(ValueError):
+        t.shortest_route(first, last, SortingCriteria.NUMBER_OF_TRAIN_CHANGES)
+
+
+def test_csr_graph():
+    adjacency = {1: {2: (10, 5.0), 3: (60, 10.0)}, 2: {3: (10, 15.0)}, 7: {1: (1, 0.5)}}
+    graph = CSRGraph.from_adjacency(adjacency)
+
+    assert list(graph.station_ids) == [1, 2, 3, 7] and list(graph.offsets) == [0, 2, 3, 3, 4]
+    assert graph.index(TraitsKey(7)) == 3 and graph.index(4) is None
+    assert list(graph.edges(1)) == [(2, 10, 5.0), (3, 60, 10.0)] and list(graph.edges(3)) == []
+    assert graph.position(1, 3) == 1 and graph.prices[graph.position(7, 1)] == 0.5 and graph.position(2, 1) is None
+    for metric in ('travel_time', 'price'):
+        for source in (1, 2, 3, 7):
+            for target in (1, 2, 3, 7):
+                if source != target:
+                    assert graph.shortest_path(source, target, metric) == dijkstra(adjacency, metric, source, target)
+    assert graph.nbytes == 4 * 8 + 5 * 4 + 4 * (4 + 4 + 8)  # ids, offsets, then per edge: neighbor, travel time, price
+
+    with pytest.raises(ValueError):
+        CSRGraph.from_records([1, 2], [(2, 1, 10, 5.0), (1, 2, 10, 5.0)])  # not sorted by start station
+
+
+def test_csr_graph_from_neo4j(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_station_connections):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    graph = CSRGraph.from_neo4j(neo4j_db)
+    assert list(graph.station_ids) == [1, 2, 3]
+    assert [list(graph.edges(station)) for station in setup_station_connections] == [[(2, 30, 15.0)], [(3, 30, 15.0)], []]
+    assert list(t.station_graph.csr().offsets) == list(graph.offsets)
+
+
 def test_get_train_current_status(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -181,6 +482,60 @@ def test_get_train_current_status(rdbms_connection, rdbms_admin_connection, neo4
     assert status is None, "Status should be None for non-existent train"
 
 
+def test_prepared_statements(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection):
+    statements = PreparedStatements()
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, statements=statements)
+
+    for _ in range(3):
+        assert t.get_train_current_status(setup_train) == TrainStatus.OPERATIONAL
+    t.buy_ticket(setup_user, setup_connection, True)
+    t.buy_ticket(setup_user, setup_connection, True)
+
+    # prepared once per connection, executed many times
+    stats = statements.stats()
+    assert stats['train_status']['executions'] == 3 and stats['train_status']['prepares'] == 1
+    assert stats['insert_ticket']['executions'] == 2 and stats['insert_ticket']['prepares'] == 1
+    assert stats['reserve_seat']['executions'] == 2
+    assert stats['existence_check']['executions'] == 2
+    assert all(s['total_time'] >= 0 and s['average_time'] >= 0 for s in stats.values())
+
+    # the server drops the prepared statements of the connection: they are prepared again
+    rdbms_admin_connection.cmd_reset_connection()
+    assert t.get_train_current_status(setup_train) == TrainStatus.OPERATIONAL
+    assert statements.stats()['train_status']['reprepares'] == 1
+
+
+def test_train_status_cache(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection):
+    now = [0.0]
+    cache = TrainStatusCache(ttl=5, clock=lambda: now[0])
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, status_cache=cache)
+
+    # one query for all the misses, then answered from the cache
+    keys = [setup_train, TraitsKey(9999), setup_train]
+    assert t.get_train_statuses(keys) == [TrainStatus.OPERATIONAL, None, TrainStatus.OPERATIONAL]
+    assert t.get_train_statuses(keys) == [TrainStatus.OPERATIONAL, None, TrainStatus.OPERATIONAL]
+    assert (cache.hits, cache.misses) == (2, 2)
+    assert t.get_train_current_status(TraitsKey(9999)) is None
+    assert t.get_train_capacities([setup_train]) == [100]
+
+    # the writes of the instance update the cache
+    t.update_train_details(setup_train, train_status=TrainStatus.DELAYED)
+    t.add_train(TraitsKey(2), 50, TrainStatus.OPERATIONAL)
+    assert t.get_train_statuses([setup_train, TraitsKey(2)]) == [TrainStatus.DELAYED, TrainStatus.OPERATIONAL]
+    t.buy_ticket(setup_user, setup_connection, True)
+    assert t.get_train_capacities([setup_train, TraitsKey(2)]) == [99, 50]
+    t.delete_train(TraitsKey(2))
+    assert t.get_train_current_status(TraitsKey(2)) is None
+
+    # changes made by others are seen when the entries expire
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("UPDATE Trains SET status = %s WHERE train_id = %s", (TrainStatus.BROKEN.value, setup_train.to_int()))
+    rdbms_admin_connection.commit()
+    assert t.get_train_current_status(setup_train) == TrainStatus.DELAYED
+    now[0] = 10
+    assert t.get_train_current_status(setup_train) == TrainStatus.BROKEN
+
+
 def test_get_train_current_status_non_existent_train(rdbms_connection, rdbms_admin_connection, neo4j_db):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -234,6 +589,274 @@ def test_buy_ticket_with_seat_reservation(rdbms_connection, rdbms_admin_connecti
         assert train['capacity'] == initial_capacity - 1, "Train's capacity was not correctly updated"
 
 
+def test_buy_ticket_concurrent_reservations(connection_factory, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection,
+                                            record_property):
+    from concurrent.futures import ThreadPoolExecutor
+    import time
+
+    train_id = setup_train.to_int()
+
+    def buy(_):
+        # every buyer uses its own connection, like separate clients would
+        with connection_factory(BASE_USER_NAME, BASE_USER_PASS) as connection:
+            t = Traits(connection, rdbms_admin_connection, neo4j_db)
+            try:
+                t.buy_ticket(setup_user, setup_connection, True)
+                return True
+            except ValueError as e:
+                assert str(e) == "No seats available for reservation"
+                return False
+
+    # increasing contention: more and more buyers race for the last few seats
+    for capacity, buyers in [(5, 2), (5, 8), (5, 16)]:
+        with rdbms_admin_connection.cursor() as cursor:
+            cursor.execute("UPDATE Trains SET capacity = %s WHERE train_id = %s", (capacity, train_id))
+            cursor.execute("DELETE FROM PurchaseHistory")
+            cursor.execute("DELETE FROM Tickets")
+        rdbms_admin_connection.commit()
+
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=buyers) as executor:
+            results = list(executor.map(buy, range(buyers)))
+        elapsed = time.perf_counter() - started
+        # the throughput under contention is reported with the test results (e.g. in the JUnit XML of --junitxml)
+        record_property(f"reservations_per_second_{buyers}_buyers", round(sum(results) / elapsed, 1))
+        record_property(f"attempts_per_second_{buyers}_buyers", round(buyers / elapsed, 1))
+
+        with rdbms_admin_connection.cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (train_id,))
+            remaining = cursor.fetchone()['capacity']
+            cursor.execute("SELECT COUNT(*) AS reserved FROM Tickets WHERE train_id = %s AND reserved_seat = 1", (train_id,))
+            reserved = cursor.fetchone()['reserved']
+        rdbms_admin_connection.commit()
+
+        # no seat is sold twice and the capacity never becomes negative
+        assert sum(results) == min(capacity, buyers)
+        assert reserved == sum(results)
+        assert remaining == capacity - sum(results) >= 0
+
+
+def test_buy_ticket_on_multiple_trains(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    first_train = setup_train.to_int()
+    second_train = t.add_train(TraitsKey(2), 0, TrainStatus.OPERATIONAL).to_int()  # no seats left
+
+    connection = [dict(setup_connection[0]), dict(setup_connection[1], train_id=second_train)]
+
+    # the second train is full: nothing is reserved, not even on the first train
+    with pytest.raises(ValueError, match="No seats available for reservation"):
+        t.buy_ticket(setup_user, connection, True)
+    assert t.get_purchase_history(setup_user) == []
+
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("UPDATE Trains SET capacity = 10 WHERE train_id = %s", (second_train,))
+    rdbms_admin_connection.commit()
+
+    t.buy_ticket(setup_user, connection, True)
+
+    # a seat was reserved on every train
+    with rdbms_connection.cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT train_id, capacity FROM Trains WHERE train_id IN (%s, %s)", (first_train, second_train))
+        assert {row['train_id']: row['capacity'] for row in cursor.fetchall()} == {first_train: 99, second_train: 9}
+
+    # and the purchase history shows each leg with its own price and seat
+    history = t.get_purchase_history(setup_user)
+    assert len(history) == 1
+    ticket = history[0]
+    assert ticket['price'] == 15 + 2 + 15 + 2
+    assert [(leg['train_id'], leg['price'], leg['reserved_seat']) for leg in ticket['connections']] == [
+        (first_train, 17, True), (second_train, 17, True)]
+
+    # a broken train cancels its leg only: the ticket keeps its seat on the other train
+    t.update_train_details(setup_train, train_status=TrainStatus.BROKEN)
+    ticket = t.get_purchase_history(setup_user)[0]
+    assert ticket['reserved_seat'], "Reservation on the other train cancelled"
+    assert [(leg['train_id'], leg['reserved_seat']) for leg in ticket['connections']] == [
+        (first_train, False), (second_train, True)]
+
+
+def test_fare_table():
+    fares = FareTable({1: {2: (30, 15.0)}, 2: {3: (10, 5.0)}})
+    connection = [{'train_id': 1, 'starting_station_key': 1, 'ending_station_key': 2, 'travel_time': 1},  # edge price
+                  {'train_id': 1, 'starting_station_key': 2, 'ending_station_key': 3, 'travel_time': 20}]
+    legs, total = fares.price_legs(connection, True)
+    assert [leg[4] for leg in legs] == [15 + 2, 5 + 2] and total == 24
+    assert fares.price_many([connection, connection[:1]], [True, False]) == [24, 15]
+
+    # a leg without an edge cannot be priced
+    unconnected = connection + [{'train_id': 1, 'starting_station_key': 3, 'ending_station_key': 4, 'travel_time': 20}]
+    assert fares.connects(connection) and not fares.connects(unconnected)
+    with pytest.raises(ValueError, match="Stations are not connected"):
+        fares.price_legs(unconnected, False)
+    with pytest.raises(ValueError, match="Stations are not connected"):
+        fares.price_many([unconnected], [False])
+
+
+def test_buy_ticket_charges_the_quoted_price(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_stations, setup_schedule):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    journey = t.search_connections(setup_stations[0], setup_stations[-1])[0]
+    assert journey['estimated_price'] == 30
+
+    # the caller's travel times are not trusted: the legs are priced from the edges
+    legs = [dict(leg, travel_time=1) for leg in journey['legs']]
+    assert t.quote_prices([legs], also_reserve_seats=False) == [journey['estimated_price']]
+    t.buy_ticket(setup_user, legs, False)
+    assert t.get_purchase_history(setup_user)[0]['price'] == journey['estimated_price']
+
+    # a leg between stations that are not connected is rejected, not priced from its travel time
+    backwards = [{'train_id': legs[0]['train_id'], 'starting_station_key': setup_stations[-1].to_int(),
+                  'ending_station_key': setup_stations[0].to_int(), 'travel_time': 1}]
+    with pytest.raises(ValueError, match="Stations are not connected"):
+        t.buy_ticket(setup_user, backwards, False)
+    assert t.buy_tickets([{'user_email': setup_user, 'connection': backwards}])[0]['error'] == "Stations are not connected"
+    assert len(t.get_purchase_history(setup_user)) == 1
+
+
+def test_buy_tickets(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    train_id = setup_train.to_int()
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("UPDATE Trains SET capacity = 2 WHERE train_id = %s", (train_id,))
+    rdbms_admin_connection.commit()
+
+    outcomes = t.buy_tickets([{'user_email': setup_user, 'connection': setup_connection}] * 3 + [
+        {'user_email': setup_user, 'connection': setup_connection, 'also_reserve_seats': False},
+        {'user_email': "non_registered_user@example.com", 'connection': setup_connection},
+        {'user_email': setup_user, 'connection': []},
+    ])
+
+    # only two seats were left: the third reservation fails, the ticket without reservation is still bought
+    assert [outcome['error'] for outcome in outcomes] == [None, None, "No seats available for reservation", None,
+                                                          "User does not exist", "The connection must contain at least one train"]
+    ticket_ids = [outcome['ticket_id'] for outcome in outcomes if outcome['ticket_id'] is not None]
+    assert len(set(ticket_ids)) == 3
+
+    with rdbms_connection.cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (train_id,))
+        assert cursor.fetchone()['capacity'] == 0
+
+    # the returned ticket ids are the ones stored in the purchase history
+    history = t.get_purchase_history(setup_user)
+    assert sorted(ticket['ticket_id'] for ticket in history) == sorted(ticket_ids)
+    assert sum(ticket['reserved_seat'] for ticket in history) == 2
+
+
+def test_buy_tickets_with_string_ids(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    as_strings = [{key: str(value) for key, value in leg.items()} for leg in setup_connection]
+    mixed = [as_strings[0], setup_connection[1]]
+    unknown = [dict(as_strings[0], train_id="9999")]
+
+    t.buy_ticket(setup_user, as_strings, True)
+    with pytest.raises(ValueError, match="Train does not exist"):
+        t.buy_ticket(setup_user, unknown, True)
+    outcomes = t.buy_tickets([{'user_email': setup_user, 'connection': connection} for connection in (mixed, unknown)])
+    assert [outcome['error'] for outcome in outcomes] == [None, "Train does not exist"]
+
+    # one seat per ticket on the train, whatever the type of its id
+    with rdbms_connection.cursor(dictionary=True) as cursor:
+        cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (setup_train.to_int(),))
+        assert cursor.fetchone()['capacity'] == 100 - 2
+    assert [leg['train_id'] for ticket in t.get_purchase_history(setup_user) for leg in ticket['connections']] == \
+        [setup_train.to_int()] * 4
+
+
+def test_connection_pool(connection_pools, neo4j_db, setup_user, setup_connection):
+    from concurrent.futures import ThreadPoolExecutor
+
+    user_pool, admin_pool = connection_pools
+    t = Traits(user_pool, admin_pool, neo4j_db)  # one instance shared by all the threads
+
+    def buy(_):
+        t.buy_ticket(setup_user, setup_connection, False)
+        return len(t.get_purchase_history(setup_user))
+
+    with ThreadPoolExecutor(max_workers=8) as executor:
+        list(executor.map(buy, range(16)))
+
+    assert len(t.get_purchase_history(setup_user)) == 16
+
+    # never more connections than the size of the pool, all of them returned at the end of the calls
+    stats = t.pool_stats()
+    assert stats['user']['peak_in_use'] <= user_pool.size and stats['user']['created'] <= user_pool.size
+    assert stats['user']['in_use'] == 0 and stats['user']['utilisation'] == 0
+    assert stats['user']['checkouts'] == 16 * 2 + 1
+    assert stats['admin']['checkouts'] == 0  # only admin features use the admin connection
+
+    # pooled connections are only available within the methods of Traits
+    with pytest.raises(RuntimeError):
+        t.rdbms_connection.cursor()
+
+    user_pool.close()
+    assert t.pool_stats()['user']['created'] == 0
+
+
+def test_async_traits(rdbms_connection, rdbms_admin_connection, connection_pools, neo4j_db, open_async_traits,
+                      setup_user, setup_connection, record_property):
+    from concurrent.futures import ThreadPoolExecutor
+    import asyncio
+    import time
+
+    requests = 200
+    train_key = TraitsKey(setup_connection[0]['train_id'])
+    Traits(rdbms_connection, rdbms_admin_connection, neo4j_db).buy_ticket(setup_user, setup_connection, True)
+
+    async def offloaded():
+        # the sync Traits on pools of the same size, offloaded to one thread per pooled connection
+        t = Traits(*connection_pools, neo4j_db)
+        loop = asyncio.get_running_loop()
+        with ThreadPoolExecutor(max_workers=sum(pool.size for pool in connection_pools)) as executor:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(
+                loop.run_in_executor(executor, t.get_purchase_history, setup_user) if i % 2 else
+                loop.run_in_executor(executor, t.get_train_current_status, train_key) for i in range(requests)))
+            return results, requests / (time.perf_counter() - started)
+
+    async def native():
+        async with open_async_traits(*(pool.size for pool in connection_pools)) as t:
+            started = time.perf_counter()
+            results = await asyncio.gather(*(t.get_purchase_history(setup_user) if i % 2 else
+                                             t.get_train_current_status(train_key) for i in range(requests)))
+            return results, requests / (time.perf_counter() - started)
+
+    offloaded_results, offloaded_throughput = asyncio.run(offloaded())
+    native_results, native_throughput = asyncio.run(native())
+    record_property("offloaded_requests_per_second", round(offloaded_throughput, 1))
+    record_property("async_requests_per_second", round(native_throughput, 1))
+    # the concurrent calls answer like the offloaded sync ones
+    assert native_results == offloaded_results and native_results[0] == TrainStatus.OPERATIONAL
+
+    async def features():
+        async with open_async_traits() as t:
+            await t.buy_ticket(setup_user, setup_connection, True)
+            assert len(await t.get_purchase_history(setup_user)) == 2
+            assert await t.get_train_capacities([train_key, TraitsKey(1234)]) == [98, None]
+            assert await t.get_train_current_status(TraitsKey(1234)) is None
+
+            # same validation and errors as Traits
+            with pytest.raises(ValueError, match="User does not exist"):
+                await t.buy_ticket("non_registered_user@example.com", setup_connection)
+            with pytest.raises(ValueError, match="Capacity cannot be decreased"):
+                await t.update_train_details(train_key, train_capacity=1)
+            with pytest.raises(ValueError, match="Station already exists"):
+                await t.add_train_station(TraitsKey(1), None)
+
+            # the timetable is written to Neo4j and searched from the snapshot of the async driver
+            await t.add_train_station(TraitsKey(4), None)
+            await t.connect_train_stations(TraitsKey(3), TraitsKey(4), 10)
+            await t.add_schedule(train_key, 8, 0, [(TraitsKey(station), 5) for station in (1, 2, 3, 4)],
+                                 1, 1, 2024, 31, 12, 2024)
+            assert await t.search_connections(TraitsKey(1), TraitsKey(4))
+
+            await t.delete_train(train_key)
+            assert await t.get_train_current_status(train_key) is None
+            with pytest.raises(ValueError, match="Train does not exist"):
+                await t.buy_ticket(setup_user, setup_connection)
+
+    asyncio.run(features())
+    assert TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db).get_all_schedules() == []
+
+
 def test_get_purchase_history(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_connection):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -260,6 +883,60 @@ def test_get_purchase_history(rdbms_connection, rdbms_admin_connection, neo4j_db
     assert len(purchase_history) == 0, "Purchase history found for non-registered user"
 
 
+def test_get_purchase_history_pages(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    for _ in range(5):  # bought within the same second: the ticket_id decides the order
+        t.buy_ticket(setup_user, setup_connection, False)
+    history = t.get_purchase_history(setup_user)
+
+    pages, cursor = [], None
+    while True:
+        page = t.get_purchase_history(setup_user, page_size=2, cursor=cursor)
+        pages.append(page)
+        cursor = page.next_cursor
+        if cursor is None:
+            break
+
+    assert [len(page) for page in pages] == [2, 2, 1]
+    assert [ticket for page in pages for ticket in page] == history  # same tickets, same order
+    assert t.get_purchase_history("non_registered_user@example.com", page_size=2) == []
+
+    with pytest.raises(ValueError):
+        t.get_purchase_history(setup_user, page_size=2, cursor="not a cursor")
+    with pytest.raises(ValueError):
+        t.get_purchase_history(setup_user, page_size=0)
+
+
+def test_read_replicas(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_connection):
+    now = [0.0]
+    # the admin connection sees the same data as the primary and is not replicating: no lag
+    router = ReplicaRouter([rdbms_admin_connection], max_lag=1.0, pin_seconds=5.0, clock=lambda: now[0])
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, replicas=router)
+
+    assert t.get_purchase_history(setup_user) == []
+    assert router.stats()['replica_reads'] == 1
+
+    # the buyer reads their ticket from the primary right after buying it
+    t.buy_ticket(setup_user, setup_connection, True)
+    assert router.is_pinned(setup_user.lower())
+    assert len(t.get_purchase_history(setup_user)) == 1
+    assert router.stats()['pinned_reads'] == 1
+
+    # then from the replica again
+    now[0] = 10.0
+    assert len(t.get_purchase_history(setup_user)) == 1
+    assert router.stats()['replica_reads'] == 3  # with the first read and the validation of buy_ticket
+
+    # the lag of the base user connection cannot be checked (no privilege): the reads go to the primary
+    lagging = ReplicaRouter([rdbms_connection])
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db, replicas=lagging)
+    assert len(t.get_purchase_history(setup_user)) == 1
+    assert lagging.stats()['lagging_reads'] == 1
+
+    with pytest.raises(ValueError):
+        ReplicaRouter([rdbms_admin_connection], max_lag=-1)
+
+
     ########################################################################
     # Admin Features:
     ########################################################################
@@ -299,6 +976,39 @@ def test_delete_non_existent_user(rdbms_connection, rdbms_admin_connection, neo4
         t.delete_user(non_existent_user_email)
 
 
+def test_delete_users(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection, setup_purchase_history):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    train_id = setup_train.to_int()
+    emails = [f"user{i}@email.org" for i in range(5)]
+    for email in emails:
+        t.add_user(email, None)
+        t.buy_ticket(email, setup_connection, True)  # one seat each
+    t.buy_ticket(setup_user, setup_connection, False)  # no seat
+
+    def capacity():
+        with rdbms_admin_connection.cursor() as cursor:
+            cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (train_id,))
+            return cursor.fetchone()[0]
+
+    # setup_purchase_history inserted a reserved ticket without legs (and without taking the seat)
+    before = capacity()
+    assert t.delete_users(emails + [setup_user, "non_registered_user@example.com"], chunk_size=2) == 6
+    assert capacity() == before + 5 + 1
+
+    with rdbms_admin_connection.cursor() as cursor:
+        for table in ["Users", "Tickets", "PurchaseHistory", "TicketLegs"]:
+            cursor.execute(f"SELECT COUNT(*) FROM {table}")
+            assert cursor.fetchone()[0] == 0, f"{table} was not emptied"
+
+    # single user: same set-based deletion
+    t.add_user(setup_user, None)
+    t.buy_ticket(setup_user, setup_connection, True)
+    before = capacity()
+    t.delete_user(setup_user)
+    assert capacity() == before + 1
+    assert t.get_purchase_history(setup_user) == []
+
+
 def test_add_train(rdbms_connection, rdbms_admin_connection, neo4j_db):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -353,6 +1063,28 @@ def test_update_train_details_with_lower_capacity(rdbms_connection, rdbms_admin_
         t.update_train_details(train_key, lower_capacity)
 
 
+def test_update_train_details_error_releases_the_train(connection_factory, rdbms_connection, rdbms_admin_connection, neo4j_db,
+                                                       setup_user, setup_train, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    with pytest.raises(ValueError, match="Capacity cannot be decreased"):
+        t.update_train_details(setup_train, 1)
+
+    # the lock on the train was released: a purchase on another connection does not wait for it
+    with connection_factory(BASE_USER_NAME, BASE_USER_PASS) as connection:
+        with connection.cursor() as cursor:
+            cursor.execute("SET SESSION innodb_lock_wait_timeout = 2")
+        Traits(connection, rdbms_admin_connection, neo4j_db).buy_ticket(setup_user, setup_connection, True)
+
+    # a change made before the error is rolled back, not committed by the next commit on the connection
+    with pytest.raises(ValueError, match="Invalid train status"):
+        t.update_train_details(setup_train, 200, "broken")
+    rdbms_admin_connection.commit()
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (setup_train.to_int(),))
+        assert cursor.fetchone()[0] == 99, "Capacity change of the failed update was committed"
+
+
 def test_update_train_details_with_broken_status(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -375,6 +1107,36 @@ def test_update_train_details_with_broken_status(rdbms_connection, rdbms_admin_c
         assert len(reserved_tickets) == 0, "Not all reservations were cancelled"
 
 
+def test_broken_train_refund_queue(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    train_id = setup_train.to_int()
+    for _ in range(3):
+        t.buy_ticket(setup_user, setup_connection, True)
+    t.buy_ticket(setup_user, setup_connection, False)
+
+    t.update_train_details(setup_train, train_status=TrainStatus.BROKEN)
+
+    # the seats are given back and no reservation is left, on the tickets nor on their legs
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (train_id,))
+        assert cursor.fetchone()[0] == 100
+        cursor.execute("SELECT COUNT(*) FROM TicketLegs WHERE reserved_seat = TRUE")
+        assert cursor.fetchone()[0] == 0
+    assert not any(ticket['reserved_seat'] for ticket in t.get_purchase_history(setup_user))
+
+    # a failing handler leaves the batch in the queue
+    def failing_handler(batch):
+        raise RuntimeError("refund service unavailable")
+    with pytest.raises(RuntimeError):
+        t.drain_refund_queue(failing_handler)
+
+    batches = []
+    assert t.drain_refund_queue(batches.append, batch_size=2) == 3
+    assert [len(batch) for batch in batches] == [2, 1]
+    assert {row['user_email'] for batch in batches for row in batch} == {setup_user}
+    assert t.drain_refund_queue(batches.append) == 0  # the queue is empty
+
+
 def test_delete_train(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -403,6 +1165,50 @@ def test_delete_train(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_
         assert len(schedules) == 0, "Train's schedules were not deleted"
 
 
+def test_delete_train_schedules(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_schedule, setup_connection):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    second_train = t.add_train(TraitsKey(2), 10, TrainStatus.OPERATIONAL)
+    t.add_schedule(second_train, 9, 0, setup_schedule, 1, 1, 2024, 31, 12, 2024)
+
+    # a ticket using both trains: its seat on the second train is given back
+    t.buy_ticket(setup_user, [setup_connection[0], dict(setup_connection[1], train_id=second_train.to_int())], True)
+
+    def schedules(train_id):
+        with neo4j_db.session() as session:
+            return session.run("""
+                MATCH (s:Schedule {train_id: $train_id}) OPTIONAL MATCH (s)-[:Has_Stops]->(stop:Stop)
+                RETURN count(DISTINCT s) AS schedules, count(stop) AS stops
+            """, train_id=train_id).single().data()
+
+    assert schedules(setup_train.to_int()) == {'schedules': 1, 'stops': 3}
+    t.delete_train(setup_train, batch_size=1)
+
+    assert schedules(setup_train.to_int()) == {'schedules': 0, 'stops': 0}
+    assert schedules(second_train.to_int()) == {'schedules': 1, 'stops': 3}
+    assert t.get_purchase_history(setup_user) == []
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("SELECT capacity FROM Trains WHERE train_id = %s", (second_train.to_int(),))
+        assert cursor.fetchone()[0] == 10
+
+    # an invalid batch size is rejected before anything is deleted
+    with pytest.raises(ValueError, match="The batch size must be positive"):
+        t.delete_train(second_train, batch_size=0)
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("SELECT COUNT(*) FROM Trains WHERE train_id = %s", (second_train.to_int(),))
+        assert cursor.fetchone()[0] == 1
+        cursor.execute("SELECT COUNT(*) FROM Outbox")
+        assert cursor.fetchone()[0] == 0
+
+    # the process stopped after the commit in MariaDB: the deletion in Neo4j is applied on reconciliation
+    with rdbms_admin_connection.cursor() as cursor:
+        cursor.execute("INSERT INTO Outbox (operation, payload, created_at) VALUES ('delete_train_schedules', %s, NOW())",
+                       ('{"train_id": %d}' % second_train.to_int(),))
+    rdbms_admin_connection.commit()
+    assert t.reconcile_outbox() == 1
+    assert schedules(second_train.to_int()) == {'schedules': 0, 'stops': 0}
+    assert t.reconcile_outbox() == 0
+
+
 def test_add_train_station(rdbms_connection, rdbms_admin_connection, neo4j_db):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -446,6 +1252,44 @@ def test_connect_already_connected_train_stations(neo4j_db, rdbms_connection, rd
         t.connect_train_stations(starting_train_station_key, ending_train_station_key, travel_time_in_minutes)
 
 
+def test_station_graph_snapshot(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_station_connections):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    graph = t.station_graph
+
+    # The snapshot is shared with the instances used by the fixtures and already contains their stations and connections
+    assert graph is Traits(rdbms_connection, rdbms_admin_connection, neo4j_db).station_graph, "Snapshot is not shared"
+    assert all(graph.has_station(key.to_int()) for key in setup_station_connections), "Stations missing in the snapshot"
+    assert graph.get_connection(setup_station_connections[0].to_int(), setup_station_connections[1].to_int()) == (30, 15), "Wrong connection"
+
+    # Writes patch the snapshot and increment its version
+    version = graph.version
+    t.add_train_station(TraitsKey(4), None)
+    t.connect_train_stations(setup_station_connections[-1], TraitsKey(4), 10)
+    assert graph.is_stale(version), "Version was not incremented"
+    assert graph.has_station(4), "Added station missing in the snapshot"
+    assert graph.get_connection(setup_station_connections[-1].to_int(), 4) == (10, 5), "Added connection missing in the snapshot"
+
+    # A reload from Neo4j gives the same content
+    adjacency = graph.adjacency
+    graph.invalidate()
+    assert graph.ensure_loaded().adjacency == adjacency, "Snapshot differs from Neo4j"
+
+
+def test_station_graph_duplicate_schedules(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train, setup_schedule):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    graph = t.station_graph
+
+    # A second schedule of the same train with the same start and validity is a separate trip, also after a reload
+    t.add_schedule(setup_train, 8, 0, setup_schedule, 1, 1, 2024, 31, 12, 2024)
+    assert len(graph.get_schedules()) == 2, "Duplicate schedule missing in the snapshot"
+    schedules = graph.schedules
+    graph.invalidate()
+    assert graph.ensure_loaded().schedules == schedules, "Snapshot differs from Neo4j"
+
+    t.delete_train(setup_train)
+    assert graph.get_schedules() == [], "Schedules of the deleted train left in the snapshot"
+
+
 def test_add_schedule_with_invalid_parameters(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train):
     t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
 
@@ -493,3 +1337,53 @@ def test_add_schedule_with_invalid_parameters(rdbms_connection, rdbms_admin_conn
     assert str(exc_info.value) == "One or both stations do not exist", "Wrong error message"
 
     # Test with unconnected consecutive stops done in public tests
+
+
+def test_add_schedules(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_train, setup_station_connections):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+    utils = TraitsUtility(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    stops = [(station_key, 2) for station_key in setup_station_connections]
+    schedule = dict(train_key=setup_train, starting_hours_24_h=8, starting_minutes=0, stops=stops,
+                    valid_from_day=1, valid_from_month=1, valid_from_year=2024,
+                    valid_until_day=31, valid_until_month=12, valid_until_year=2024)
+
+    # Add two schedules at once
+    t.add_schedules([schedule, dict(schedule, starting_hours_24_h=9)])
+    assert len(utils.get_all_schedules()) == 2, "Schedules not inserted"
+
+    # One invalid schedule (stops in the wrong direction are not connected) rejects the whole batch
+    with pytest.raises(ValueError) as exc_info:
+        t.add_schedules([dict(schedule, starting_hours_24_h=10), dict(schedule, stops=stops[::-1])])
+    assert str(exc_info.value) == "Consecutive stops must be connected stations", "Wrong error message"
+    assert len(utils.get_all_schedules()) == 2, "Schedules of an invalid batch were inserted"
+
+    # All the stops are stored in order
+    with neo4j_db.session() as session:
+        result = session.run("MATCH (:Schedule)-[:Has_Stops]->(stop:Stop) RETURN stop.station_id AS station_id, stop.order AS order ORDER BY stop.order")
+        orders = [(record['order'], record['station_id']) for record in result]
+    assert sorted(set(orders)) == [(i, key.to_int()) for i, key in enumerate(setup_station_connections)], "Stops not stored correctly"
+
+
+def test_existence_validator(rdbms_connection, rdbms_admin_connection, neo4j_db, setup_user, setup_train, setup_stations):
+    t = Traits(rdbms_connection, rdbms_admin_connection, neo4j_db)
+
+    # Existing keys do not raise
+    t.validator.check(rdbms_connection, stations=[key.to_int() for key in setup_stations], trains=[setup_train.to_int()], users=[setup_user])
+
+    # All the missing keys are reported at once
+    with pytest.raises(MissingKeysError) as exc_info:
+        t.validator.check(rdbms_connection, stations=[setup_stations[0].to_int(), 98, 99], trains=[setup_train.to_int(), 9999],
+                          users=[setup_user, "missing@email.org"])
+    assert str(exc_info.value) == "User does not exist", "Wrong error message"
+    assert exc_info.value.missing_stations == [98, 99], "Wrong missing stations"
+    assert exc_info.value.missing_trains == [9999], "Wrong missing trains"
+    assert exc_info.value.missing_users == ["missing@email.org"], "Wrong missing users"
+
+    # Train ids given as strings are compared as ints
+    t.validator.check(rdbms_connection, trains=[str(setup_train.to_int())])
+
+    # Methods use it: a ticket on a missing train reports the train
+    with pytest.raises(ValueError) as exc_info:
+        t.buy_ticket(setup_user, [{'train_id': 9999, 'starting_station_key': 1, 'ending_station_key': 2, 'travel_time': 10}])
+    assert exc_info.value.missing_trains == [9999], "Missing train not reported"
@@ -0,0 +1,376 @@
+import json
+from datetime import datetime
+from typing import List, Optional, Tuple
+
+import aiomysql
+
+from public.traits.interface import TraitsKey, TrainStatus, SortingCriteria
+from traits.cache import SearchCache, TrainStatusCache
+from traits.fares import FareTable
+from traits.implementation import (Traits, INSERT_TICKET_LEGS, PURCHASE_HISTORY_QUERY, LOCK_TRAIN, QUEUE_REFUNDS,
+                                   CLEAR_RESERVATIONS_STATEMENTS, RETURN_SEATS, LOCK_DELETED_TRAIN,
+                                   DELETE_TRAIN_STATEMENTS, INSERT_OUTBOX, CREATE_STATION, CREATE_CONNECTION,
+                                   DELETE_SCHEDULES_BATCH, CHECK_SCHEDULE_STOPS, CREATE_SCHEDULES)
+from traits.routing import JourneyResults
+from traits.statements import STATEMENTS
+from traits.transactions import run_async_transaction
+
+
+class AsyncTraits:
+    """
+    Awaitable versions of every TraitsInterface method (and of the batch methods of Traits), for asyncio applications.
+
+    MariaDB is used through two async pools (aiomysql.create_pool, one per role: user and admin), Neo4j through the
+    sessions of an async driver (neo4j.AsyncGraphDatabase.driver): a call waiting on a database holds neither a thread
+    nor, between its transactions, a connection, so as many calls run at the same time as the pools can serve.
+    The searches read the in-memory snapshot of the station graph: once it is loaded (with the async driver) they are
+    answered by the same code as Traits, without I/O.
+    Validation and errors are the ones of Traits (e.g. ValueError is raised by the awaited call). Read replicas and
+    server-side prepared statements are not used; Outbox entries left by an interrupted delete_train are applied by
+    Traits.reconcile_outbox.
+    """
+
+    def __init__(self, rdbms_pool, rdbms_admin_pool, neo4j_driver, search_cache: Optional[SearchCache] = None,
+                 status_cache: Optional[TrainStatusCache] = None) -> None:
+        self.rdbms_pool = rdbms_pool
+        self.rdbms_admin_pool = rdbms_admin_pool
+        self.neo4j_driver = neo4j_driver
+        # a Traits without MariaDB connections holds the in-memory parts: the station graph snapshot of the driver,
+        # the routing, the fare table and the caches
+        self.traits = Traits(None, None, neo4j_driver, search_cache, status_cache=status_cache)
+        self.station_graph = self.traits.station_graph
+        self.validator = self.traits.validator
+
+    async def _fares(self) -> FareTable:
+        await self.station_graph.ensure_loaded_async()
+        return self.traits.fares
+
+    ########################################################################
+    # Basic Features
+    ########################################################################
+
+    async def search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                                 travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
+                                 travel_time_hour: int = None, travel_time_minute: int = None,
+                                 is_departure_time=True,
+                                 sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME, is_ascending: bool = True,
+                                 limit: int = 5) -> List:
+        await self.station_graph.ensure_loaded_async()
+        return self.traits.search_connections(starting_station_key, ending_station_key, travel_time_day,
+                                              travel_time_month, travel_time_year, travel_time_hour, travel_time_minute,
+                                              is_departure_time, sort_by, is_ascending, limit)
+
+    async def search_journeys(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                              travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
+                              travel_time_hour: int = None, travel_time_minute: int = None,
+                              is_departure_time=True) -> JourneyResults:
+        await self.station_graph.ensure_loaded_async()
+        return self.traits.search_journeys(starting_station_key, ending_station_key, travel_time_day, travel_time_month,
+                                           travel_time_year, travel_time_hour, travel_time_minute, is_departure_time)
+
+    async def search_pareto_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                                        travel_time_day: int = None, travel_time_month: int = None,
+                                        travel_time_year: int = None, travel_time_hour: int = None,
+                                        travel_time_minute: int = None, is_departure_time=True,
+                                        max_changes: int = 5) -> List[dict]:
+        await self.station_graph.ensure_loaded_async()
+        return self.traits.search_pareto_connections(starting_station_key, ending_station_key, travel_time_day,
+                                                     travel_time_month, travel_time_year, travel_time_hour,
+                                                     travel_time_minute, is_departure_time, max_changes)
+
+    async def shortest_route(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                             sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME) -> Optional[dict]:
+        await self.station_graph.ensure_loaded_async()
+        return self.traits.shortest_route(starting_station_key, ending_station_key, sort_by)
+
+    async def quote_prices(self, connections: List[list], also_reserve_seats: bool = False) -> List[float]:
+        return (await self._fares()).price_many(connections, [also_reserve_seats] * len(connections))
+
+    async def get_train_current_status(self, train_key: TraitsKey) -> Optional[TrainStatus]:
+        return (await self.get_train_statuses([train_key]))[0]
+
+    async def get_train_statuses(self, train_keys: List[TraitsKey]) -> List[Optional[TrainStatus]]:
+        states = await self._train_states([train_key.to_int() for train_key in train_keys])
+        return [None if states[train_key.to_int()][0] is None else TrainStatus(states[train_key.to_int()][0])
+                for train_key in train_keys]
+
+    async def get_train_capacities(self, train_keys: List[TraitsKey]) -> List[Optional[int]]:
+        states = await self._train_states([train_key.to_int() for train_key in train_keys])
+        return [states[train_key.to_int()][1] for train_key in train_keys]
+
+    async def _train_states(self, train_ids: List[int]) -> dict:
+        states, misses = self.traits._cached_train_states(train_ids)
+        if not misses:
+            return states
+
+        async def read(cursor):
+            await cursor.execute(f"SELECT train_id, status, capacity FROM Trains WHERE train_id IN ({', '.join(['%s'] * len(misses))})",
+                                 tuple(misses))
+            return await cursor.fetchall()
+
+        # admin pool, like Traits.get_train_current_status
+        states.update(self.traits._read_train_states(misses, await run_async_transaction(self.rdbms_admin_pool, read)))
+        return states
+
+    async def buy_ticket(self, user_email: str, connection, also_reserve_seats=True):
+        connection = Traits._normalize_connection(connection)
+        train_ids = [c['train_id'] for c in connection]
+        reserved_trains = list(dict.fromkeys(train_ids))  # one seat per train, even if the user stays on it for several legs
+        fares = await self._fares()
+
+        async def reserve_and_insert(cursor):
+            # same checks (and order) as Traits.buy_ticket, then the purchase in the same transaction
+            await self.validator.check_async(cursor, trains=train_ids, users=[user_email])
+            if not connection:
+                raise ValueError("The connection must contain at least one train")
+            legs, total_price = fares.price_legs(connection, also_reserve_seats)
+
+            if also_reserve_seats:
+                reserved = await cursor.execute(f"UPDATE Trains SET capacity = capacity - 1 WHERE train_id IN ({', '.join(['%s'] * len(reserved_trains))}) AND capacity > 0",
+                                                tuple(reserved_trains))
+                if reserved != len(reserved_trains):  # at least one train is full, the whole purchase is rolled back
+                    raise ValueError("No seats available for reservation")
+
+            purchase_date = datetime.now().isoformat()
+            await cursor.execute(STATEMENTS['insert_ticket'], (
+                user_email, train_ids[-1], also_reserve_seats, total_price, purchase_date,
+                connection[0]['starting_station_key'], connection[-1]['ending_station_key']))
+            ticket_id = cursor.lastrowid
+            await cursor.executemany(INSERT_TICKET_LEGS, [(ticket_id,) + leg for leg in legs])
+            await cursor.execute(STATEMENTS['insert_purchase_history'], (user_email, ticket_id, purchase_date))
+
+        await run_async_transaction(self.rdbms_pool, reserve_and_insert)
+        if also_reserve_seats:
+            self.traits._forget_train_states(reserved_trains)
+
+    async def buy_tickets(self, requests: List[dict]) -> List[dict]:
+        requests = Traits._normalize_requests(requests)
+        outcomes = [{'ticket_id': None, 'error': None} for _ in requests]
+        all_trains = {c['train_id'] for r in requests for c in r['connection']}
+        all_users = {r['user_email'] for r in requests}
+        fares = await self._fares()
+
+        async def allocate_and_insert(cursor):
+            for outcome in outcomes:  # reset what a previous (retried) attempt allocated
+                outcome.update(ticket_id=None, error=None)
+            missing_trains, missing_users = await self.validator.missing_rows_async(cursor, all_trains, all_users)
+            valid = Traits._valid_requests(requests, missing_trains, missing_users, fares, outcomes)
+            if not valid:
+                return []
+
+            # lock the trains of the batch and allocate their free seats in request order
+            trains = sorted({c['train_id'] for index in valid for c in requests[index]['connection']})
+            await cursor.execute(f"SELECT train_id, capacity FROM Trains WHERE train_id IN ({', '.join(['%s'] * len(trains))}) FOR UPDATE",
+                                 tuple(trains))
+            bought, taken = Traits._allocate_seats(requests, valid, dict(await cursor.fetchall()), outcomes)
+            if not bought:
+                return []
+            if taken:
+                await cursor.execute(*Traits._take_seats(taken))
+
+            purchase_date = datetime.now().isoformat()
+            tickets, legs = Traits._ticket_rows(requests, bought, fares, purchase_date)
+            ticket_ids = await self._insert_tickets(cursor, tickets)
+            await cursor.executemany(INSERT_TICKET_LEGS, [(ticket_id,) + leg for ticket_id, ticket_legs in zip(ticket_ids, legs)
+                                                          for leg in ticket_legs])
+            await cursor.executemany(STATEMENTS['insert_purchase_history'],
+                                     [(requests[index]['user_email'], ticket_id, purchase_date) for index, ticket_id in zip(bought, ticket_ids)])
+
+            for index, ticket_id in zip(bought, ticket_ids):
+                outcomes[index]['ticket_id'] = ticket_id
+            return list(taken)  # the trains whose seats were taken
+
+        # One transaction and one commit for the whole batch
+        self.traits._forget_train_states(await run_async_transaction(self.rdbms_pool, allocate_and_insert))
+        return outcomes
+
+    async def _insert_tickets(self, cursor, tickets: List[tuple]) -> List[int]:
+        """
+        Insert the Tickets rows like Traits._insert_tickets, the consecutive ids with one explicit multi-row INSERT
+        (executemany may split the rows into several statements)
+        """
+        if self.traits._autoinc_step is None:  # shared with the Traits methods: read once
+            await cursor.execute("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+            lock_mode, increment = await cursor.fetchone()
+            self.traits._autoinc_step = int(increment) if int(lock_mode) in (0, 1) else 0
+
+        if self.traits._autoinc_step:
+            head, values = STATEMENTS['insert_ticket'].split(' VALUES ')
+            await cursor.execute(f"{head} VALUES {', '.join([values] * len(tickets))}",
+                                 tuple(value for ticket in tickets for value in ticket))
+            return [cursor.lastrowid + i * self.traits._autoinc_step for i in range(len(tickets))]
+        ticket_ids = []
+        for ticket in tickets:
+            await cursor.execute(STATEMENTS['insert_ticket'], ticket)
+            ticket_ids.append(cursor.lastrowid)
+        return ticket_ids
+
+    async def get_purchase_history(self, user_email: str, page_size: Optional[int] = None, cursor: Optional[str] = None) -> List:
+        params = Traits._history_parameters(user_email, page_size, cursor)
+
+        async def read(db_cursor):
+            await db_cursor.execute(PURCHASE_HISTORY_QUERY, params)
+            return Traits._history_page(await db_cursor.fetchall(), page_size)
+
+        return await run_async_transaction(self.rdbms_pool, read, cursor_class=aiomysql.DictCursor)
+
+    ########################################################################
+    # Admin Features:
+    ########################################################################
+
+    async def add_user(self, user_email: str, user_details) -> None:
+        async def insert(cursor):
+            try:
+                await cursor.execute("INSERT INTO Users (email, user_details) VALUES (%s, %s);",
+                                     (user_email, "NULL" if user_details is None else user_details))
+            except Exception:
+                # the email is not in a valid format (CHECK failed) or already exists (UNIQUE constraint failed)
+                raise ValueError("Invalid email format or user already exists")
+
+        await run_async_transaction(self.rdbms_admin_pool, insert)
+
+    async def delete_user(self, user_email: str) -> None:
+        async def delete(cursor):
+            await self.validator.check_async(cursor, users=[user_email])
+            for statement, params in Traits._delete_users_statements([user_email]):
+                await cursor.execute(statement, params)
+
+        await run_async_transaction(self.rdbms_admin_pool, delete)
+        self.traits._forget_train_states()  # the seats of the user were given back
+
+    async def add_train(self, train_key: TraitsKey, train_capacity: int, train_status: TrainStatus) -> TraitsKey:
+        async def insert(cursor):
+            if train_key is None:  # a new key is generated
+                await cursor.execute("INSERT INTO Trains (capacity, status) VALUES (%s, %s);",
+                                     (train_capacity, train_status.value))
+                return cursor.lastrowid
+            try:
+                await cursor.execute("INSERT INTO Trains (train_id, capacity, status) VALUES (%s, %s, %s);",
+                                     (train_key.to_int(), train_capacity, train_status.value))
+            except Exception:
+                # the train already exists (UNIQUE constraint failed) or the status is not valid (CHECK failed)
+                raise ValueError("Invalid input or train already exists")
+            return train_key.to_int()
+
+        train_id = await run_async_transaction(self.rdbms_admin_pool, insert)
+        self.traits._cache_train_state(train_id, train_status.value, train_capacity)
+        return TraitsKey(train_id) if train_key is None else train_key
+
+    async def update_train_details(self, train_key: TraitsKey, train_capacity: Optional[int] = None,
+                                   train_status: Optional[TrainStatus] = None) -> None:
+        train_id = train_key.to_int()
+
+        async def update(cursor):
+            await cursor.execute(LOCK_TRAIN, (train_id,))
+            train = await cursor.fetchone()
+            for statement, params in Traits._train_changes(train, train_id, train_capacity, train_status):
+                await cursor.execute(statement, params)
+
+            capacity = train_capacity if train_capacity is not None else train['capacity']
+            if train_status == TrainStatus.BROKEN:
+                capacity += await self._cancel_reservations(cursor, train_id)
+            return train_status.value if train_status is not None else train['status'], capacity
+
+        status, capacity = await run_async_transaction(self.rdbms_admin_pool, update, cursor_class=aiomysql.DictCursor)
+        self.traits._cache_train_state(train_id, status, capacity)
+        self.traits._invalidate_search_cache()
+
+    @staticmethod
+    async def _cancel_reservations(cursor, train_id: int) -> int:
+        # like Traits._cancel_reservations
+        cancelled = await cursor.execute(QUEUE_REFUNDS, (train_id,) * QUEUE_REFUNDS.count('%s'))
+        for statement in CLEAR_RESERVATIONS_STATEMENTS:
+            await cursor.execute(statement, (train_id,) * statement.count('%s'))
+        await cursor.execute(RETURN_SEATS, (cancelled, train_id))
+        return cancelled
+
+    async def delete_train(self, train_key: TraitsKey, batch_size: int = 1000) -> None:
+        train_id = train_key.to_int()
+        if batch_size < 1:  # checked before anything is deleted
+            raise ValueError("The batch size must be positive")
+
+        async def delete_rows(cursor):
+            await cursor.execute(LOCK_DELETED_TRAIN, (train_id,))
+            await cursor.fetchall()
+            for statement in DELETE_TRAIN_STATEMENTS:
+                await cursor.execute(statement, (train_id,) * statement.count('%s'))
+            await cursor.execute(INSERT_OUTBOX, ('delete_train_schedules', json.dumps({'train_id': train_id})))
+            return cursor.lastrowid
+
+        outbox_id = await run_async_transaction(self.rdbms_admin_pool, delete_rows)
+        self.traits._forget_train_states()  # seats were given back on the other trains of the deleted tickets
+        self.traits._cache_train_state(train_id, None, None)
+
+        # then the schedules in Neo4j, batch_size per transaction, and the outbox entry recording it
+        async with self.neo4j_driver.session() as session:
+            while True:
+                deleted = await session.execute_write(self._delete_schedules_batch, train_id, batch_size)
+                if deleted < batch_size:
+                    break
+        self.station_graph.remove_train(train_id)
+        self.traits._invalidate_search_cache()
+
+        async def remove_entry(cursor):
+            await cursor.execute("DELETE FROM Outbox WHERE outbox_id = %s", (outbox_id,))
+
+        await run_async_transaction(self.rdbms_admin_pool, remove_entry)
+
+    @staticmethod
+    async def _delete_schedules_batch(tx, train_id: int, batch_size: int) -> int:
+        result = await tx.run(DELETE_SCHEDULES_BATCH, train_id=train_id, batch_size=batch_size)
+        return (await result.single())['deleted']
+
+    async def add_train_station(self, train_station_key: TraitsKey, train_station_details) -> None:
+        async with self.neo4j_driver.session() as session:
+            result = await session.run(CREATE_STATION, station_id=train_station_key.to_int(),
+                                       details=train_station_details)
+            if (await result.consume()).counters.nodes_created == 0:
+                raise ValueError("Station already exists")
+        self.station_graph.add_station(train_station_key.to_int(), train_station_details)
+
+    async def connect_train_stations(self, starting_train_station_key: TraitsKey, ending_train_station_key: TraitsKey,
+                                     travel_time_in_minutes: int) -> None:
+        await self.station_graph.ensure_loaded_async()
+        start_id, end_id, travel_price = self.traits._check_new_connection(starting_train_station_key,
+                                                                           ending_train_station_key,
+                                                                           travel_time_in_minutes)
+        async with self.neo4j_driver.session() as session:
+            result = await session.run(CREATE_CONNECTION, start_id=start_id, end_id=end_id,
+                                       travel_time=travel_time_in_minutes, price=travel_price)
+            await result.consume()
+        self.station_graph.add_connection(start_id, end_id, travel_time_in_minutes, travel_price)
+        self.traits._invalidate_search_cache()
+
+    async def add_schedule(self, train_key: TraitsKey,
+                           starting_hours_24_h: int, starting_minutes: int,
+                           stops: List[Tuple[TraitsKey, int]],  # [station_key, waiting_time]
+                           valid_from_day: int, valid_from_month: int, valid_from_year: int,
+                           valid_until_day: int, valid_until_month: int, valid_until_year: int) -> None:
+        await self.add_schedules([dict(train_key=train_key, starting_hours_24_h=starting_hours_24_h,
+                                       starting_minutes=starting_minutes, stops=stops,
+                                       valid_from_day=valid_from_day, valid_from_month=valid_from_month,
+                                       valid_from_year=valid_from_year, valid_until_day=valid_until_day,
+                                       valid_until_month=valid_until_month, valid_until_year=valid_until_year)])
+
+    async def add_schedules(self, schedules: List[dict]) -> None:
+        schedules = [Traits._prepare_schedule(**schedule) for schedule in schedules]
+        if not schedules:
+            return
+
+        async def check_trains(cursor):
+            await self.validator.check_async(cursor, trains=[schedule['train_id'] for schedule in schedules])
+
+        await run_async_transaction(self.rdbms_admin_pool, check_trains)
+        async with self.neo4j_driver.session() as session:
+            schedule_ids = await session.execute_write(self._write_schedules, schedules)
+        self.traits._add_schedules_to_snapshot(schedule_ids, schedules)
+
+    @staticmethod
+    async def _write_schedules(tx, schedules: List[dict]) -> List[int]:
+        # like Traits._write_schedules
+        pairs = Traits._schedule_pairs(schedules)
+        result = await tx.run(CHECK_SCHEDULE_STOPS, pairs=pairs)
+        Traits._check_schedule_pairs(pairs, [record async for record in result])
+
+        result = await tx.run(CREATE_SCHEDULES, schedules=schedules)
+        return [record['schedule_id'] async for record in result]
@@ -0,0 +1,103 @@
+import time
+from collections import OrderedDict
+from threading import RLock
+from typing import Callable, Dict, Hashable, Iterable, List, Optional, Tuple
+
+
+class SearchCache:
+    """
+    Bounded cache for the results of search_connections: least recently used entries are evicted when the cache is full
+    and entries older than ttl seconds are not returned anymore.
+    The cache can be shared by several Traits instances (it is thread-safe), every write on the timetable clears it.
+    """
+
+    def __init__(self, max_size: int = 1024, ttl: float = 300.0, clock: Callable[[], float] = time.monotonic) -> None:
+        if max_size < 1:
+            raise ValueError("The cache must hold at least one entry")
+        if ttl <= 0:
+            raise ValueError("The time to live must be positive")
+
+        self.max_size = max_size
+        self.ttl = ttl
+        self.clock = clock
+        self._entries = OrderedDict()  # key -> (expires_at, value), least recently used first
+        self._lock = RLock()
+
+        # counters
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0  # entries dropped because the cache was full
+        self.expirations = 0  # entries dropped because they were too old
+
+    def get(self, key: Hashable) -> Optional[object]:
+        """
+        Return the cached value, None if the key is not cached or expired
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and entry[0] <= self.clock():
+                del self._entries[key]
+                self.expirations += 1
+                entry = None
+
+            if entry is None:
+                self.misses += 1
+                return None
+
+            self._entries.move_to_end(key)  # most recently used
+            self.hits += 1
+            return entry[1]
+
+    def put(self, key: Hashable, value) -> None:
+        with self._lock:
+            self._entries[key] = (self.clock() + self.ttl, value)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_size:
+                self._entries.popitem(last=False)  # least recently used
+                self.evictions += 1
+
+    def discard(self, *keys: Hashable) -> None:
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+
+    def clear(self) -> None:
+        """
+        Drop all the entries (called when the data the results depend on changes)
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses,
+                    'evictions': self.evictions, 'expirations': self.expirations}
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class TrainStatusCache(SearchCache):
+    """
+    Write-through cache of the status and free capacity of the trains by train_id, as (status, capacity) with
+    (None, None) for trains that do not exist, so polling get_train_current_status and get_train_statuses rarely
+    reaches MariaDB.
+    add_train, update_train_details and delete_train write the new values, the methods reserving or giving back seats
+    drop the entries of their trains; ttl bounds how long the changes made by other processes go unseen.
+    """
+
+    def __init__(self, max_size: int = 65536, ttl: float = 5.0, clock: Callable[[], float] = time.monotonic) -> None:
+        super().__init__(max_size, ttl, clock)
+
+    def get_many(self, train_ids: Iterable[int]) -> Tuple[Dict[int, tuple], List[int]]:
+        """
+        Return the cached entries of the trains and the (distinct) train ids that are not cached
+        """
+        found, misses = {}, []
+        for train_id in dict.fromkeys(train_ids):
+            entry = self.get(train_id)
+            if entry is None:
+                misses.append(train_id)
+            else:
+                found[train_id] = entry
+        return found, misses
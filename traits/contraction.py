@@ -0,0 +1,253 @@
+import hashlib
+import heapq
+import json
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple, Union
+
+# Contraction hierarchies over the CONNECTION graph (the station graph without schedules), for point-to-point queries.
+# Preprocessing contracts the stations one by one (least important first) and adds shortcut edges keeping the distances
+# between the remaining stations; a query is then a bidirectional Dijkstra only following edges to more important
+# stations, which settles a few dozen stations instead of most of the network.
+
+# the metrics of the edges: adjacency[start_id][end_id] = (travel_time, price)
+METRICS = {
+    'travel_time': lambda edge: edge[0],
+    'price': lambda edge: round(edge[1], 2),  # priced to the cent, like by the fare engine
+}
+
+FORMAT_VERSION = 1
+
+
+def graph_fingerprint(adjacency: Dict[int, Dict[int, Tuple[int, float]]]) -> str:
+    """
+    Digest of all the edges with their travel time and price: a hierarchy is stale when the fingerprint it was built
+    for differs from the one of the current graph
+    """
+    digest = hashlib.sha256()
+    for start_id in sorted(adjacency):
+        for end_id in sorted(adjacency[start_id]):
+            travel_time, price = adjacency[start_id][end_id]
+            digest.update(f"{start_id}>{end_id}:{travel_time}:{price!r};".encode())
+    return digest.hexdigest()
+
+
+def dijkstra(adjacency: Dict[int, Dict[int, Tuple[int, float]]], metric: str, source: int,
+             target: int) -> Optional[Tuple[float, List[int]]]:
+    """
+    Plain Dijkstra on the station graph: (cost, stations of the path) or None if target cannot be reached
+    """
+    weight = METRICS[metric]
+    distances, parents, queue = {source: 0}, {}, [(0, source)]
+    while queue:
+        distance, station = heapq.heappop(queue)
+        if station == target:
+            path = [target]
+            while path[-1] != source:
+                path.append(parents[path[-1]])
+            return distance, path[::-1]
+        if distance > distances[station]:
+            continue
+        for neighbor, edge in adjacency.get(station, {}).items():
+            candidate = distance + weight(edge)
+            if candidate < distances.get(neighbor, float('inf')):
+                distances[neighbor], parents[neighbor] = candidate, station
+                heapq.heappush(queue, (candidate, neighbor))
+    return None
+
+
+class ContractionHierarchy:
+    """
+    Contraction hierarchy of the (directed) CONNECTION graph for one metric ('travel_time' or 'price').
+    Build it with build (or load a persisted one with load) and check is_fresh_for before querying: a hierarchy built
+    for another version of the graph gives wrong answers.
+    """
+
+    def __init__(self, metric: str, fingerprint: str, rank: Dict[int, int],
+                 edges: Dict[Tuple[int, int], Tuple[float, Optional[int]]]) -> None:
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+
+        self.metric = metric
+        self.fingerprint = fingerprint
+        self.rank = rank  # contraction order of the stations (the higher, the more important)
+        self.edges = edges  # (start, end) -> (cost, contracted station of the shortcut or None for original edges)
+        self.upward: Dict[int, List[Tuple[int, float]]] = {}  # forward search: edges to more important stations
+        self.downward: Dict[int, List[Tuple[int, float]]] = {}  # backward search: reversed edges from more important ones
+        for (start, end), (cost, _) in edges.items():
+            if rank[end] > rank[start]:
+                self.upward.setdefault(start, []).append((end, cost))
+            else:
+                self.downward.setdefault(end, []).append((start, cost))
+
+    ########################################################################
+    # Preprocessing
+    ########################################################################
+
+    @classmethod
+    def build(cls, adjacency: Dict[int, Dict[int, Tuple[int, float]]], metric: str = 'travel_time',
+              witness_limit: int = 500) -> "ContractionHierarchy":
+        """
+        Contract the stations of the graph in the order of their edge difference (shortcuts added - edges removed),
+        updated lazily. Witness searches settle at most witness_limit stations (more shortcuts, never wrong answers).
+        """
+        if metric not in METRICS:
+            raise ValueError(f"Unknown metric {metric}")
+        weight = METRICS[metric]
+
+        outgoing: Dict[int, Dict[int, float]] = {}
+        incoming: Dict[int, Dict[int, float]] = {}
+        edges: Dict[Tuple[int, int], Tuple[float, Optional[int]]] = {}
+        for start, ends in adjacency.items():
+            for end, edge in ends.items():
+                if start == end:
+                    continue
+                outgoing.setdefault(start, {})[end] = incoming.setdefault(end, {})[start] = weight(edge)
+                edges[(start, end)] = (weight(edge), None)
+        stations = set(outgoing) | set(incoming)
+        for station in stations:
+            outgoing.setdefault(station, {})
+            incoming.setdefault(station, {})
+
+        def shortcuts(station: int) -> List[Tuple[int, int, float]]:
+            # the shortcuts needed to keep the distances if station is removed from the remaining graph
+            needed = []
+            for start, to_station in incoming[station].items():
+                targets = {end: to_station + cost for end, cost in outgoing[station].items() if end != start}
+                if not targets:
+                    continue
+                witnesses = cls._witness_search(outgoing, start, station, max(targets.values()), witness_limit)
+                needed.extend((start, end, cost) for end, cost in targets.items() if witnesses.get(end, float('inf')) > cost)
+            return needed
+
+        contracted_neighbors = dict.fromkeys(stations, 0)
+
+        def priority(station: int) -> int:
+            return len(shortcuts(station)) - len(incoming[station]) - len(outgoing[station]) + contracted_neighbors[station]
+
+        queue = [(priority(station), station) for station in stations]
+        heapq.heapify(queue)
+        rank: Dict[int, int] = {}
+        while queue:
+            _, station = heapq.heappop(queue)
+            if station in rank:
+                continue
+            current = priority(station)  # lazy update: contract it only if it is still the least important
+            if queue and current > queue[0][0]:
+                heapq.heappush(queue, (current, station))
+                continue
+
+            for start, end, cost in shortcuts(station):
+                if cost < outgoing[start].get(end, float('inf')):
+                    outgoing[start][end] = incoming[end][start] = cost
+                    edges[(start, end)] = (cost, station)
+            for neighbor in set(incoming[station]) | set(outgoing[station]):
+                contracted_neighbors[neighbor] += 1
+                outgoing[neighbor].pop(station, None)
+                incoming[neighbor].pop(station, None)
+            rank[station] = len(rank)
+            # the edges of the contracted station stay in edges (they lead to more important stations)
+            outgoing[station], incoming[station] = {}, {}
+
+        return cls(metric, graph_fingerprint(adjacency), rank, edges)
+
+    @staticmethod
+    def _witness_search(outgoing, source: int, excluded: int, limit: float, witness_limit: int) -> Dict[int, float]:
+        # distances from source in the remaining graph without the excluded station, up to limit
+        distances, queue, settled = {source: 0}, [(0, source)], 0
+        while queue and settled < witness_limit:
+            distance, station = heapq.heappop(queue)
+            if distance > distances[station]:
+                continue
+            if distance > limit:
+                break
+            settled += 1
+            for neighbor, cost in outgoing[station].items():
+                if neighbor == excluded:
+                    continue
+                candidate = distance + cost
+                if candidate < distances.get(neighbor, float('inf')):
+                    distances[neighbor] = candidate
+                    heapq.heappush(queue, (candidate, neighbor))
+        return distances
+
+    ########################################################################
+    # Queries
+    ########################################################################
+
+    def is_fresh_for(self, adjacency: Dict[int, Dict[int, Tuple[int, float]]]) -> bool:
+        return self.fingerprint == graph_fingerprint(adjacency)
+
+    def query(self, source: int, target: int) -> Optional[Tuple[float, List[int]]]:
+        """
+        Return (cost, stations of the path) of the shortest path, None if target cannot be reached
+        """
+        if source == target:
+            return 0, [source]
+        if source not in self.rank or target not in self.rank:
+            return None
+
+        distances = ({source: 0}, {target: 0})  # forward, backward
+        parents = ({}, {})
+        queues = ([(0, source)], [(0, target)])
+        graphs = (self.upward, self.downward)
+        best, meeting = float('inf'), None
+        while any(queues):
+            for side in (0, 1):
+                queue = queues[side]
+                if not queue:
+                    continue
+                if queue[0][0] >= best:  # nothing shorter can be found on this side
+                    queue.clear()
+                    continue
+                distance, station = heapq.heappop(queue)
+                if distance > distances[side][station]:
+                    continue
+                other = distances[1 - side].get(station)
+                if other is not None and distance + other < best:
+                    best, meeting = distance + other, station
+                for neighbor, cost in graphs[side].get(station, []):
+                    candidate = distance + cost
+                    if candidate < distances[side].get(neighbor, float('inf')):
+                        distances[side][neighbor], parents[side][neighbor] = candidate, station
+                        heapq.heappush(queue, (candidate, neighbor))
+
+        if meeting is None:
+            return None
+        forward = [meeting]
+        while forward[-1] != source:
+            forward.append(parents[0][forward[-1]])
+        backward = [meeting]
+        while backward[-1] != target:
+            backward.append(parents[1][backward[-1]])
+        hops = forward[::-1] + backward[1:]
+
+        path = [source]
+        for start, end in zip(hops, hops[1:]):
+            path.extend(self._unpack(start, end))
+        return best, path
+
+    def _unpack(self, start: int, end: int) -> List[int]:
+        # the stations after start on the original edges a (shortcut) edge stands for
+        via = self.edges[(start, end)][1]
+        if via is None:
+            return [end]
+        return self._unpack(start, via) + self._unpack(via, end)
+
+    ########################################################################
+    # Persistence
+    ########################################################################
+
+    def save(self, path: Union[str, Path]) -> None:
+        Path(path).write_text(json.dumps({
+            'format': FORMAT_VERSION, 'metric': self.metric, 'fingerprint': self.fingerprint,
+            'rank': [[station, rank] for station, rank in self.rank.items()],
+            'edges': [[start, end, cost, via] for (start, end), (cost, via) in self.edges.items()],
+        }))
+
+    @classmethod
+    def load(cls, path: Union[str, Path]) -> "ContractionHierarchy":
+        data = json.loads(Path(path).read_text())
+        if data.get('format') != FORMAT_VERSION:
+            raise ValueError("Unsupported contraction hierarchy format")
+        return cls(data['metric'], data['fingerprint'], {station: rank for station, rank in data['rank']},
+                   {(start, end): (cost, via) for start, end, cost, via in data['edges']})
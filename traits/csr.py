@@ -0,0 +1,170 @@
+import heapq
+from array import array
+from bisect import bisect_left
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from public.traits.interface import TraitsKey
+
+INFINITY = float("inf")
+
+
+class CSRGraph:
+    """
+    Compressed sparse row representation of the station graph: the CONNECTION edges of station i are the positions
+    offsets[i] to offsets[i + 1] of the contiguous neighbors, travel_times and prices arrays (a few bytes per edge,
+    instead of the hundreds of bytes of a dict of dicts).
+    Stations are renumbered densely: index i stands for station_ids[i] (sorted, so a station id is mapped back to its
+    index with a binary search, without a dict).
+    """
+
+    def __init__(self, station_ids: array, offsets: array, neighbors: array, travel_times: array, prices: array) -> None:
+        self.station_ids = station_ids
+        self.offsets = offsets
+        self.neighbors = neighbors
+        self.travel_times = travel_times
+        self.prices = prices
+        self._cents = None  # the prices rounded to the cent (the price metric), computed on first use
+
+    ########################################################################
+    # Building
+    ########################################################################
+
+    @classmethod
+    def from_records(cls, station_ids: Iterable[int], edges: Iterable[Tuple[int, int, int, float]]) -> "CSRGraph":
+        """
+        Build the graph from the station ids and the edges (start_id, end_id, travel_time, price) sorted by start_id,
+        in one pass over the edges (e.g. streamed from a Neo4j export)
+        """
+        ids = array('q', sorted(set(station_ids)))
+        offsets, neighbors, travel_times, prices = array('i', [0]), array('i'), array('i'), array('d')
+
+        def position(station_id: int) -> int:
+            index = bisect_left(ids, station_id)
+            if index == len(ids) or ids[index] != station_id:
+                raise ValueError(f"Unknown station {station_id}")
+            return index
+
+        current = 0  # the station whose edges are being added
+        for start_id, end_id, travel_time, price in edges:
+            start = position(start_id)
+            if start < current:
+                raise ValueError("The edges must be sorted by start station")
+            while current < start:  # close the rows of the stations before (some without edges)
+                offsets.append(len(neighbors))
+                current += 1
+            neighbors.append(position(end_id))
+            travel_times.append(travel_time)
+            prices.append(price)
+        while len(offsets) <= len(ids):
+            offsets.append(len(neighbors))
+        return cls(ids, offsets, neighbors, travel_times, prices)
+
+    @classmethod
+    def from_adjacency(cls, adjacency: Dict[int, Dict[int, Tuple[int, float]]]) -> "CSRGraph":
+        """
+        Build the graph from adjacency[start_id][end_id] = (travel_time, price) (see StationGraph)
+        """
+        station_ids = set(adjacency) | {end_id for ends in adjacency.values() for end_id in ends}
+        return cls.from_records(station_ids, ((start_id, end_id, travel_time, price)
+                                              for start_id in sorted(adjacency)
+                                              for end_id, (travel_time, price) in sorted(adjacency[start_id].items())))
+
+    @classmethod
+    def from_neo4j(cls, neo4j_driver) -> "CSRGraph":
+        """
+        Build the graph straight from Neo4j, streaming the edges (no intermediate dict of dicts)
+        """
+        with neo4j_driver.session() as session:  # automatically closes the session
+            station_ids = [record['station_id'] for record in
+                           session.run("MATCH (s:Station) RETURN s.station_id AS station_id")]
+            edges = session.run("""
+                MATCH (a:Station)-[c:CONNECTION]->(b:Station)
+                RETURN a.station_id AS start_id, b.station_id AS end_id, c.travel_time AS travel_time, c.price AS price
+                ORDER BY start_id
+            """)
+            return cls.from_records(station_ids, ((record['start_id'], record['end_id'], record['travel_time'],
+                                                   record['price']) for record in edges))
+
+    ########################################################################
+    # Reading
+    ########################################################################
+
+    def __len__(self) -> int:
+        return len(self.station_ids)
+
+    @property
+    def edge_count(self) -> int:
+        return len(self.neighbors)
+
+    @property
+    def nbytes(self) -> int:
+        """
+        Memory used by the arrays
+        """
+        return sum(a.itemsize * len(a) for a in (self.station_ids, self.offsets, self.neighbors, self.travel_times,
+                                                  self.prices))
+
+    def index(self, station: Union[TraitsKey, int]) -> Optional[int]:
+        """
+        Return the dense index of the station (a TraitsKey or a station id), None if it is not in the graph
+        """
+        station_id = station.to_int() if isinstance(station, TraitsKey) else station
+        index = bisect_left(self.station_ids, station_id)
+        return index if index < len(self.station_ids) and self.station_ids[index] == station_id else None
+
+    def position(self, start: Union[TraitsKey, int], end: Union[TraitsKey, int]) -> Optional[int]:
+        """
+        Return the position of the edge from start to end in the edge arrays, None if the stations are not connected
+        """
+        start, end = self.index(start), self.index(end)
+        if start is None or end is None:
+            return None
+        for position in range(self.offsets[start], self.offsets[start + 1]):
+            if self.neighbors[position] == end:
+                return position
+        return None
+
+    def edges(self, station: Union[TraitsKey, int]) -> Iterator[Tuple[int, int, float]]:
+        """
+        Yield (end_id, travel_time, price) of the edges leaving the station
+        """
+        index = self.index(station)
+        if index is None:
+            return
+        for position in range(self.offsets[index], self.offsets[index + 1]):
+            yield self.station_ids[self.neighbors[position]], self.travel_times[position], self.prices[position]
+
+    def shortest_path(self, source: Union[TraitsKey, int], target: Union[TraitsKey, int],
+                      metric: str = 'travel_time') -> Optional[Tuple[float, List[int]]]:
+        """
+        Dijkstra by travel_time or price (to the cent, like the fare engine): (cost, station ids of the path) or None
+        """
+        if metric not in ('travel_time', 'price'):
+            raise ValueError(f"Unknown metric {metric}")
+        source, target = self.index(source), self.index(target)
+        if source is None or target is None:
+            return None
+
+        if metric == 'price' and self._cents is None:
+            self._cents = array('d', (round(price, 2) for price in self.prices))
+        weights = self.travel_times if metric == 'travel_time' else self._cents
+        offsets, neighbors = self.offsets, self.neighbors
+        distances = array('d', [INFINITY]) * len(self.station_ids)
+        parents = array('i', [-1]) * len(self.station_ids)
+        distances[source] = 0
+        queue = [(0, source)]
+        while queue:
+            distance, index = heapq.heappop(queue)
+            if index == target:
+                path = [target]
+                while path[-1] != source:
+                    path.append(parents[path[-1]])
+                return distance, [self.station_ids[i] for i in reversed(path)]
+            if distance > distances[index]:
+                continue
+            for position in range(offsets[index], offsets[index + 1]):
+                neighbor, candidate = neighbors[position], distance + weights[position]
+                if candidate < distances[neighbor]:
+                    distances[neighbor], parents[neighbor] = candidate, index
+                    heapq.heappush(queue, (candidate, neighbor))
+        return None
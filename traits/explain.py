@@ -0,0 +1,83 @@
+import ast
+import re
+from pathlib import Path
+from typing import Iterable, List, Sequence, Tuple
+
+# the modules whose SQL statements are checked by default
+IMPLEMENTATION_PATH = Path(__file__).with_name("implementation.py")
+STATEMENTS_PATH = Path(__file__).with_name("statements.py")
+VALIDATION_PATH = Path(__file__).with_name("validation.py")  # the existence check run by every purchase
+
+# the tables whose full scans are reported by default
+CHECKED_TABLES = ('Tickets', 'PurchaseHistory', 'Trains', 'Users')
+
+# statements with a query plan (INSERTs without SELECT and DDL have none worth checking)
+EXPLAINABLE = re.compile(r"^\s*(SELECT|UPDATE|DELETE)\b", re.IGNORECASE)
+
+
+def extract_sql_statements(paths: Iterable[Path] = (IMPLEMENTATION_PATH, STATEMENTS_PATH,
+                                                    VALIDATION_PATH)) -> Tuple[List[str], List[str]]:
+    """
+    Return the SELECT, UPDATE and DELETE statements written as string literals in the given Python modules, as
+    (statements, dynamic statements).
+    In f-strings, expressions building lists of placeholders (e.g. ', '.join(['%s'] * n)) are replaced by a single %s;
+    statements with any other expression cannot be rebuilt and are returned as dynamic (not explained).
+    """
+    statements, dynamic = [], []
+    for path in paths:
+        tree = ast.parse(Path(path).read_text())
+        # docstrings and the literal parts of f-strings are not statements of their own
+        skipped = {id(node.value) for node in ast.walk(tree) if isinstance(node, ast.Expr)}
+        skipped |= {id(value) for node in ast.walk(tree) if isinstance(node, ast.JoinedStr) for value in node.values}
+        for node in ast.walk(tree):
+            if id(node) in skipped:
+                continue
+            if isinstance(node, ast.Constant) and isinstance(node.value, str):
+                if EXPLAINABLE.match(node.value):
+                    statements.append(node.value.strip())
+            elif isinstance(node, ast.JoinedStr):
+                parts, rebuilt = [], True
+                for value in node.values:
+                    if isinstance(value, ast.Constant):
+                        parts.append(value.value)
+                    elif "'%s'" in ast.unparse(value.value):
+                        parts.append('%s')
+                    else:
+                        parts.append('{' + ast.unparse(value.value) + '}')
+                        rebuilt = False
+                statement = ''.join(parts).strip()
+                if EXPLAINABLE.match(statement):
+                    (statements if rebuilt else dynamic).append(statement)
+    return statements, dynamic
+
+
+def sample_parameters(statement: str) -> tuple:
+    """
+    Values for the placeholders of statement: LIMIT needs a number, a string is used everywhere else
+    (comparing an indexed string column to a number would prevent the use of the index)
+    """
+    pieces = statement.split('%s')
+    return tuple(1 if re.search(r"LIMIT\s*$", piece, re.IGNORECASE) else '1' for piece in pieces[:-1])
+
+
+def full_table_scans(rdbms_connection, statements: Iterable[str], tables: Sequence[str] = CHECKED_TABLES,
+                     min_rows: int = 1000) -> List[Tuple[str, str]]:
+    """
+    EXPLAIN every statement and return (statement, table) for each full scan of one of the given tables: the scans no
+    index could have avoided, and on non-trivial tables (at least min_rows rows estimated) every scan, also the ones
+    ignoring an available index (on smaller tables the optimizer rightly prefers a scan).
+    Statements without a WHERE clause read the whole table by design and are not reported.
+    """
+    tables = {table.lower() for table in tables}
+    scans = []
+    with rdbms_connection.cursor(dictionary=True) as cursor:
+        for statement in statements:
+            if not re.search(r"\bWHERE\b", statement, re.IGNORECASE):
+                continue
+            cursor.execute("EXPLAIN " + statement, sample_parameters(statement))
+            for row in cursor.fetchall():
+                if (row['table'] or '').lower() in tables and row['type'] == 'ALL' and \
+                        (not row['possible_keys'] or (row['rows'] or 0) >= min_rows):
+                    scans.append((statement, row['table']))
+    rdbms_connection.rollback()  # EXPLAIN UPDATE/DELETE do not change anything, just end the read transaction
+    return scans
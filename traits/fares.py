@@ -0,0 +1,89 @@
+from threading import RLock
+from typing import Dict, List, Sequence, Tuple, Union
+from weakref import WeakKeyDictionary
+
+from traits.csr import CSRGraph
+
+# the tariff: the price of a CONNECTION edge is set from its travel time when the stations are connected
+PRICE_PER_MINUTE = 0.5
+RESERVATION_SURCHARGE = 2.0  # per leg with a reserved seat
+
+
+def edge_price(travel_time: int) -> float:
+    return travel_time * PRICE_PER_MINUTE
+
+
+class FareTable:
+    """
+    Server-side fare engine: the prices of all the CONNECTION edges are the contiguous prices array of the CSR graph
+    of the stations (shared with the routing, not copied), so pricing a leg is a binary search of its start station and
+    a scan of its few edges, and pricing many tickets is a single pass over their legs.
+    A leg is priced from the edge between its stations (the travel time sent by the caller is never used), a leg between
+    stations without an edge raises a ValueError. Reserved legs cost RESERVATION_SURCHARGE more.
+    """
+
+    # one table per station graph, rebuilt when the graph changes (see for_graph)
+    _tables = WeakKeyDictionary()
+    _tables_lock = RLock()
+
+    @classmethod
+    def for_graph(cls, station_graph) -> "FareTable":
+        """
+        Return the fare table of the current version of the station graph (shared by the Traits instances using it)
+        """
+        station_graph.ensure_loaded()
+        with cls._tables_lock:
+            table = cls._tables.get(station_graph)
+            if table is None or station_graph.is_stale(table.version):
+                version = station_graph.version  # read before the CSR graph: a concurrent change makes the table stale
+                table = cls(station_graph.csr(), version)
+                cls._tables[station_graph] = table
+            return table
+
+    def __init__(self, graph: Union[CSRGraph, Dict[int, Dict[int, Tuple[int, float]]]], version: int = 0) -> None:
+        # a CSRGraph, or an adjacency (adjacency[start_id][end_id] = (travel_time, price)) to build one from
+        self.version = version
+        self.graph = graph if isinstance(graph, CSRGraph) else CSRGraph.from_adjacency(graph)
+        self.prices = self.graph.prices
+
+    def __len__(self) -> int:
+        return self.graph.edge_count
+
+    def connects(self, connection: Sequence[dict]) -> bool:
+        """
+        Return if every leg of the connection is between stations with an edge (i.e. if it can be priced)
+        """
+        return all(self.graph.position(c['starting_station_key'], c['ending_station_key']) is not None for c in connection)
+
+    def _position(self, start_id: int, end_id: int) -> int:
+        position = self.graph.position(start_id, end_id)
+        if position is None:
+            raise ValueError("Stations are not connected")
+        return position
+
+    def leg_price(self, start_id: int, end_id: int, also_reserve_seats: bool = False) -> float:
+        return round(self.prices[self._position(start_id, end_id)], 2) + (RESERVATION_SURCHARGE if also_reserve_seats else 0)
+
+    def price_legs(self, connection: Sequence[dict], also_reserve_seats: bool) -> Tuple[list, float]:
+        """
+        Return the TicketLegs rows (without ticket_id) of the connection and the total price of the ticket
+        """
+        legs = [(order, c['train_id'], c['starting_station_key'], c['ending_station_key'],
+                 self.leg_price(c['starting_station_key'], c['ending_station_key'], also_reserve_seats),
+                 also_reserve_seats)
+                for order, c in enumerate(connection)]
+        return legs, round(sum(leg[4] for leg in legs), 2)
+
+    def price_many(self, connections: Sequence[Sequence[dict]], also_reserve_seats: Sequence[bool]) -> List[float]:
+        """
+        Return the total price of each connection (e.g. of all the journeys of a search), in one pass over their legs
+        """
+        prices = self.prices
+        totals = []
+        for connection, reserve in zip(connections, also_reserve_seats):
+            surcharge = RESERVATION_SURCHARGE if reserve else 0
+            total = 0.0
+            for c in connection:  # same arithmetic as price_legs, so quotes and charges agree to the cent
+                total += round(prices[self._position(c['starting_station_key'], c['ending_station_key'])], 2) + surcharge
+            totals.append(round(total, 2))
+        return totals
@@ -0,0 +1,184 @@
+from datetime import datetime
+from threading import RLock
+from typing import Dict, List, Optional, Tuple
+from weakref import WeakKeyDictionary
+
+from traits.csr import CSRGraph
+
+# the queries loading the snapshot
+STATIONS_QUERY = "MATCH (s:Station) RETURN s.station_id AS station_id, s.details AS details"
+CONNECTIONS_QUERY = """
+    MATCH (a:Station)-[c:CONNECTION]->(b:Station)
+    RETURN a.station_id AS start_id, b.station_id AS end_id, c.travel_time AS travel_time, c.price AS price
+"""
+SCHEDULES_QUERY = """
+    MATCH (s:Schedule)-[:Has_Stops]->(stop:Stop)
+    WITH s, stop ORDER BY stop.order
+    RETURN id(s) AS schedule_id, s.train_id AS train_id, s.starting_hours_24_h AS starting_hours_24_h,
+           s.starting_minutes AS starting_minutes, s.valid_from AS valid_from, s.valid_until AS valid_until,
+           collect([stop.station_id, stop.waiting_time]) AS stops
+"""
+
+
+class StationGraph:
+    """
+    Process-local snapshot of the station graph stored in Neo4j: the stations, the CONNECTION edges (travel_time and
+    price) and the schedules with their stops.
+    The snapshot is loaded once (lazily) and then patched in place by the Traits methods writing to Neo4j.
+    Every change increments version, so callers holding data derived from the snapshot can see when it is stale.
+    The snapshot of an async driver (see AsyncTraits) is loaded with ensure_loaded_async before it is read.
+    """
+
+    # one snapshot per Neo4j driver (all the Traits instances using the same driver share it)
+    _snapshots = WeakKeyDictionary()
+    _snapshots_lock = RLock()
+
+    @classmethod
+    def for_driver(cls, neo4j_driver) -> "StationGraph":
+        with cls._snapshots_lock:
+            graph = cls._snapshots.get(neo4j_driver)
+            if graph is None:
+                graph = cls(neo4j_driver)
+                cls._snapshots[neo4j_driver] = graph
+            return graph
+
+    def __init__(self, neo4j_driver) -> None:
+        self.neo4j_driver = neo4j_driver
+        self.version = 0
+        self.loaded = False
+        self.stations: Dict[int, object] = {}  # station_id -> details
+        self.adjacency: Dict[int, Dict[int, Tuple[int, float]]] = {}  # start_id -> {end_id: (travel_time, price)}
+        self.schedules: Dict[int, dict] = {}  # schedule_id (Neo4j node id) -> schedule (stops as [station_id, waiting_time])
+        self._csr = None  # (version, CSRGraph) of the adjacency
+        self._lock = RLock()
+
+    ########################################################################
+    # Loading
+    ########################################################################
+
+    def load(self) -> None:
+        """
+        (Re)load the whole snapshot from Neo4j
+        """
+        stations, adjacency, schedules = {}, {}, {}
+        with self.neo4j_driver.session() as session:  # automatically closes the session
+            for record in session.run(STATIONS_QUERY):
+                stations[record['station_id']] = record['details']
+
+            for record in session.run(CONNECTIONS_QUERY):
+                adjacency.setdefault(record['start_id'], {})[record['end_id']] = (record['travel_time'], record['price'])
+
+            for record in session.run(SCHEDULES_QUERY):
+                # one row per Schedule node: schedules of the same train with the same start and validity stay apart
+                schedules[record['schedule_id']] = record.data()
+        self._replace(stations, adjacency, schedules)
+
+    async def load_async(self) -> None:
+        """
+        (Re)load the whole snapshot like load, with an async driver (neo4j.AsyncGraphDatabase)
+        """
+        stations, adjacency, schedules = {}, {}, {}
+        async with self.neo4j_driver.session() as session:
+            async for record in await session.run(STATIONS_QUERY):
+                stations[record['station_id']] = record['details']
+
+            async for record in await session.run(CONNECTIONS_QUERY):
+                adjacency.setdefault(record['start_id'], {})[record['end_id']] = (record['travel_time'], record['price'])
+
+            async for record in await session.run(SCHEDULES_QUERY):
+                schedules[record['schedule_id']] = record.data()
+        self._replace(stations, adjacency, schedules)
+
+    def _replace(self, stations, adjacency, schedules) -> None:
+        with self._lock:
+            self.stations, self.adjacency, self.schedules = stations, adjacency, schedules
+            self.loaded = True
+            self.version += 1
+
+    def ensure_loaded(self) -> "StationGraph":
+        if not self.loaded:
+            with self._lock:
+                if not self.loaded:  # another thread may have loaded it in the meantime
+                    self.load()
+        return self
+
+    async def ensure_loaded_async(self) -> "StationGraph":
+        # concurrent loads of the same snapshot simply replace each other
+        if not self.loaded:
+            await self.load_async()
+        return self
+
+    def invalidate(self) -> None:
+        """
+        Drop the snapshot (e.g. after changes made outside of Traits), it is reloaded on the next access
+        """
+        with self._lock:
+            self.loaded = False
+            self.version += 1
+
+    def is_stale(self, version: int) -> bool:
+        return version != self.version
+
+    ########################################################################
+    # Reading
+    ########################################################################
+
+    def has_station(self, station_id: int) -> bool:
+        return station_id in self.ensure_loaded().stations
+
+    def get_connection(self, start_id: int, end_id: int) -> Optional[Tuple[int, float]]:
+        """
+        Return (travel_time, price) of the CONNECTION edge between the two stations, None if they are not connected
+        """
+        return self.ensure_loaded().adjacency.get(start_id, {}).get(end_id)
+
+    def csr(self) -> CSRGraph:
+        """
+        Return the CONNECTION edges as a compact CSRGraph for routing (rebuilt after changes)
+        """
+        self.ensure_loaded()
+        with self._lock:
+            if self._csr is None or self.is_stale(self._csr[0]):
+                self._csr = (self.version, CSRGraph.from_adjacency(self.adjacency))
+            return self._csr[1]
+
+    def get_schedules(self, travel_date: Optional[datetime] = None) -> List[dict]:
+        """
+        Return all the schedules, or only the ones valid on travel_date if given
+        """
+        self.ensure_loaded()
+        with self._lock:
+            schedules = list(self.schedules.values())
+        if travel_date is None:
+            return schedules
+        day = travel_date.isoformat()  # same format used to store valid_from/valid_until
+        return [s for s in schedules if s['valid_from'] <= day <= s['valid_until']]
+
+    ########################################################################
+    # Write-through patches (called after the change is stored in Neo4j)
+    ########################################################################
+
+    def add_station(self, station_id: int, details) -> None:
+        with self._lock:
+            if self.loaded:
+                self.stations[station_id] = details
+            self.version += 1
+
+    def add_connection(self, start_id: int, end_id: int, travel_time: int, price: float) -> None:
+        with self._lock:
+            if self.loaded:
+                self.adjacency.setdefault(start_id, {})[end_id] = (travel_time, price)
+            self.version += 1
+
+    def add_schedule(self, schedule: dict) -> None:
+        with self._lock:
+            if self.loaded:
+                self.schedules[schedule['schedule_id']] = schedule
+            self.version += 1
+
+    def remove_train(self, train_id: int) -> None:
+        with self._lock:
+            if self.loaded:
+                self.schedules = {schedule_id: schedule for schedule_id, schedule in self.schedules.items()
+                                  if schedule['train_id'] != train_id}
+            self.version += 1
@@ -0,0 +1,30 @@
+import base64
+import json
+from datetime import datetime
+from typing import Optional, Tuple
+
+
+class PurchaseHistoryPage(list):
+    """
+    One page of the purchase history (a list of tickets, most recent first).
+    next_cursor is the opaque cursor to pass to get_purchase_history for the next page, None on the last page.
+    """
+
+    def __init__(self, tickets=(), next_cursor: Optional[str] = None) -> None:
+        super().__init__(tickets)
+        self.next_cursor = next_cursor
+
+
+def encode_cursor(purchase_date: datetime, ticket_id: int) -> str:
+    """
+    Return the cursor pointing after the ticket with the given purchase_date and ticket_id (the keyset of the page)
+    """
+    return base64.urlsafe_b64encode(json.dumps([purchase_date.isoformat(), ticket_id]).encode()).decode()
+
+
+def decode_cursor(cursor: str) -> Tuple[datetime, int]:
+    try:
+        purchase_date, ticket_id = json.loads(base64.urlsafe_b64decode(cursor.encode()))
+        return datetime.fromisoformat(purchase_date), int(ticket_id)
+    except (ValueError, TypeError, AttributeError):
+        raise ValueError("Invalid cursor") from None
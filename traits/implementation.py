@@ -1,7 +1,9 @@
+import json
 from datetime import datetime, timedelta
+from pathlib import Path
 
 # from neo4j import GraphDatabase
-from typing import List, Optional, Tuple
+from typing import Callable, Dict, List, Optional, Sequence, Tuple, Union
 
 # import all the necessary classes from the public submodule:
 from public.traits.interface import TraitsInterface, TraitsUtilityInterface, TraitsKey, TrainStatus, SortingCriteria
@@ -9,13 +11,161 @@ from public.traits.interface import TraitsInterface, TraitsUtilityInterface, Tra
 # import all the necessary default configurations
 from public.traits.interface import BASE_USER_NAME, BASE_USER_PASS, ADMIN_USER_NAME, ADMIN_USER_PASS
 
+# routing engine used by search_connections
+from traits.routing import ConnectionScan, JourneyResults, build_connections
+from traits.raptor import Raptor
+from traits.contraction import ContractionHierarchy, METRICS
+from traits.graph import StationGraph
+from traits.cache import SearchCache, TrainStatusCache
+from traits.importer import SCHEDULE_TRIP_ID_CONSTRAINT, TimetableImporter
+from traits.fares import FareTable, edge_price
+from traits.validation import ExistenceValidator, MissingKeysError
+from traits.transactions import run_transaction
+from traits.pool import PooledConnections, checks_out_connections
+from traits.history import PurchaseHistoryPage, encode_cursor, decode_cursor
+from traits.explain import CHECKED_TABLES, extract_sql_statements, full_table_scans
+from traits.statements import STATEMENTS, PreparedStatements, prepared_statements
+from traits.replicas import ReplicaRouter
+
+# statements shared by Traits and AsyncTraits (traits/async_implementation.py)
+INSERT_TICKET_LEGS = "INSERT INTO TicketLegs (ticket_id, leg_order, train_id, start_station_key, end_station_key, price, reserved_seat) VALUES (%s, %s, %s, %s, %s, %s, %s)"
+
+# tickets with their legs in one query; tickets bought before legs were stored have no legs
+# the page of tickets is selected on PurchaseHistory alone (served by the index on user_email, purchase_date and
+# ticket_id in the right order, no sort), then joined with the tickets and their legs
+PURCHASE_HISTORY_QUERY = """
+SELECT t.ticket_id, ph.purchase_date, t.price, t.reserved_seat, t.start_station_key, t.end_station_key,
+       l.train_id, l.start_station_key AS leg_start_station_key, l.end_station_key AS leg_end_station_key,
+       l.price AS leg_price, l.reserved_seat AS leg_reserved_seat
+FROM (
+    SELECT ticket_id, purchase_date FROM PurchaseHistory
+    WHERE user_email = %s AND (purchase_date < %s OR (purchase_date = %s AND ticket_id < %s))
+    ORDER BY purchase_date DESC, ticket_id DESC
+    LIMIT %s
+) ph
+JOIN Tickets t ON ph.ticket_id = t.ticket_id
+LEFT JOIN TicketLegs l ON l.ticket_id = t.ticket_id
+ORDER BY ph.purchase_date DESC, t.ticket_id DESC, l.leg_order
+"""  # DESC: most recent trips at the top
+
+# lock the train: no seat can be sold nor given back until the changes of update_train_details are committed
+LOCK_TRAIN = "SELECT * FROM Trains WHERE train_id = %s FOR UPDATE;"
+
+# lock the train first in delete_train: no ticket can be bought on it (the foreign key check waits) until it is deleted
+LOCK_DELETED_TRAIN = "SELECT train_id FROM Trains WHERE train_id = %s FOR UPDATE"
+# the statements of delete_train, in order, each taking the train_id for every placeholder
+DELETE_TRAIN_STATEMENTS = (
+    # the deleted tickets (derived table "deleted"): the tickets of the train and the ones having a leg on it
+    # give back the seats they reserved on the other trains of their connections
+    """
+    UPDATE Trains tr
+    JOIN (
+        SELECT l.train_id, COUNT(DISTINCT l.ticket_id) AS seats
+        FROM TicketLegs l JOIN (
+            SELECT ticket_id FROM Tickets WHERE train_id = %s
+            UNION
+            SELECT ticket_id FROM TicketLegs WHERE train_id = %s
+        ) deleted ON deleted.ticket_id = l.ticket_id
+        WHERE l.reserved_seat = TRUE AND l.train_id <> %s
+        GROUP BY l.train_id
+    ) r ON r.train_id = tr.train_id
+    SET tr.capacity = tr.capacity + r.seats
+    """,
+    # foreign key order: purchase history, tickets (their legs and refunds are deleted by the cascade)
+    """
+    DELETE ph FROM PurchaseHistory ph JOIN (
+        SELECT ticket_id FROM Tickets WHERE train_id = %s
+        UNION
+        SELECT ticket_id FROM TicketLegs WHERE train_id = %s
+    ) deleted ON deleted.ticket_id = ph.ticket_id
+    """,
+    """
+    DELETE t FROM Tickets t JOIN (
+        SELECT ticket_id FROM Tickets WHERE train_id = %s
+        UNION
+        SELECT ticket_id FROM TicketLegs WHERE train_id = %s
+    ) deleted ON deleted.ticket_id = t.ticket_id
+    """,
+    "DELETE FROM Trains WHERE train_id = %s",
+)
+# the schedules are deleted from Neo4j after the commit: recording it in the same transaction makes sure it happens
+# even if the process stops in between (see reconcile_outbox)
+INSERT_OUTBOX = "INSERT INTO Outbox (operation, payload, created_at) VALUES (%s, %s, NOW())"
+
+# the statements of _cancel_reservations, each taking the train_id for every placeholder
+# queue the reserved tickets: the ones with a reserved leg on the train and the ones bought before legs were stored
+QUEUE_REFUNDS = """
+    INSERT INTO RefundQueue (ticket_id, train_id, queued_at)
+    SELECT ticket_id, %s, NOW() FROM (
+        SELECT ticket_id FROM TicketLegs WHERE train_id = %s AND reserved_seat = TRUE
+        UNION
+        SELECT ticket_id FROM Tickets t WHERE train_id = %s AND reserved_seat = TRUE
+          AND NOT EXISTS (SELECT 1 FROM TicketLegs l WHERE l.ticket_id = t.ticket_id)
+    ) reserved
+"""
+CLEAR_RESERVATIONS_STATEMENTS = (
+    # clear the reservations of the same tickets (the train is locked, so none was added meanwhile): a ticket keeps
+    # its reservation if it still has a reserved leg on another train; then its legs on the train are cleared
+    """
+    UPDATE Tickets t JOIN (
+        SELECT ticket_id FROM TicketLegs WHERE train_id = %s AND reserved_seat = TRUE
+        UNION
+        SELECT ticket_id FROM Tickets t WHERE train_id = %s AND reserved_seat = TRUE
+          AND NOT EXISTS (SELECT 1 FROM TicketLegs l WHERE l.ticket_id = t.ticket_id)
+    ) reserved ON reserved.ticket_id = t.ticket_id
+    SET t.reserved_seat = FALSE
+    WHERE NOT EXISTS (SELECT 1 FROM TicketLegs l
+                      WHERE l.ticket_id = t.ticket_id AND l.train_id <> %s AND l.reserved_seat = TRUE)
+    """,
+    "UPDATE TicketLegs SET reserved_seat = FALSE WHERE train_id = %s AND reserved_seat = TRUE",
+)
+# one seat back per cancelled ticket
+RETURN_SEATS = "UPDATE Trains SET capacity = capacity + %s WHERE train_id = %s"
+
+# Cypher statements shared by Traits and AsyncTraits
+CREATE_STATION = "MERGE (s:Station {station_id: $station_id}) ON CREATE SET s.details = $details"
+CREATE_CONNECTION = """
+    MATCH (a:Station {station_id: $start_id}), (b:Station {station_id: $end_id})
+    CREATE (a)-[:CONNECTION {travel_time: $travel_time,  price: $price}]->(b)
+"""
+DELETE_SCHEDULES_BATCH = """
+    MATCH (s:Schedule {train_id: $train_id})
+    WITH s LIMIT $batch_size
+    OPTIONAL MATCH (s)-[:Has_Stops]->(stop:Stop)
+    DETACH DELETE s, stop
+    RETURN count(DISTINCT s) AS deleted
+"""
+CHECK_SCHEDULE_STOPS = """
+    UNWIND $pairs AS pair
+    OPTIONAL MATCH (a:Station {station_id: pair[0]})
+    OPTIONAL MATCH (b:Station {station_id: pair[1]})
+    OPTIONAL MATCH (a)-[c:CONNECTION]->(b)
+    RETURN pair, a IS NOT NULL AS start_exists, b IS NOT NULL AS end_exists, count(c) > 0 AS connected
+"""
+# the schedules, a Stop node for each stop and the edges connecting them (one row per schedule)
+CREATE_SCHEDULES = """
+    UNWIND $schedules AS schedule
+    CREATE (s:Schedule {train_id: schedule.train_id,
+        starting_hours_24_h: schedule.starting_hours_24_h,
+        starting_minutes: schedule.starting_minutes,
+        valid_from: schedule.valid_from,
+        valid_until: schedule.valid_until})
+    FOREACH (i IN range(0, size(schedule.stops) - 1) |
+        CREATE (s)-[:Has_Stops]->(:Stop {station_id: schedule.stops[i].station_id,
+                                         waiting_time: schedule.stops[i].waiting_time, order: i}))
+    RETURN id(s) AS schedule_id
+"""
+
 
 # implement the utility class (any additional methods needed can be added)
 class TraitsUtility(TraitsUtilityInterface):
-    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver) -> None:
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver,
+                 replicas: Optional[Union[ReplicaRouter, Sequence]] = None) -> None:
         self.rdbms_connection = rdbms_connection
         self.rdbms_admin_connection = rdbms_admin_connection
         self.neo4j_driver = neo4j_driver
+        # read replicas (connections with admin rights or a ReplicaRouter) for the read-only features
+        self.replicas = replicas if isinstance(replicas, ReplicaRouter) else ReplicaRouter(replicas or ())
 
     @staticmethod
     def generate_sql_initialization_code() -> List[str]:
@@ -57,7 +207,9 @@ class TraitsUtility(TraitsUtilityInterface):
                 start_station_key INT NOT NULL,
                 end_station_key INT NOT NULL,
                 FOREIGN KEY (user_email) REFERENCES Users(email),
-                FOREIGN KEY (train_id) REFERENCES Trains(train_id)
+                FOREIGN KEY (train_id) REFERENCES Trains(train_id),
+                INDEX tickets_by_user (user_email, reserved_seat),
+                INDEX tickets_by_train (train_id, reserved_seat)
             );
             """,
             """
@@ -67,20 +219,99 @@ class TraitsUtility(TraitsUtilityInterface):
                 purchase_date DATETIME NOT NULL,
                 FOREIGN KEY (user_email) REFERENCES Users(email),
                 FOREIGN KEY (ticket_id) REFERENCES Tickets(ticket_id),
-                PRIMARY KEY (user_email, ticket_id)
+                PRIMARY KEY (user_email, ticket_id),
+                INDEX purchase_history_by_date (user_email, purchase_date DESC, ticket_id DESC)
+                );
+            """,
+            """
+            CREATE TABLE IF NOT EXISTS TicketLegs (
+                ticket_id INT NOT NULL,
+                leg_order INT NOT NULL,
+                train_id INT NOT NULL,
+                start_station_key INT NOT NULL,
+                end_station_key INT NOT NULL,
+                price FLOAT NOT NULL,
+                reserved_seat BIT NOT NULL DEFAULT 0,
+                FOREIGN KEY (ticket_id) REFERENCES Tickets(ticket_id) ON DELETE CASCADE,
+                FOREIGN KEY (train_id) REFERENCES Trains(train_id),
+                PRIMARY KEY (ticket_id, leg_order),
+                INDEX ticket_legs_by_train (train_id, reserved_seat)
+                );
+            """,  # one row per train of the connection, the ticket holds the totals
+            """
+            CREATE TABLE IF NOT EXISTS RefundQueue (
+                queue_id INT AUTO_INCREMENT PRIMARY KEY,
+                ticket_id INT NOT NULL,
+                train_id INT NOT NULL,
+                queued_at DATETIME NOT NULL,
+                FOREIGN KEY (ticket_id) REFERENCES Tickets(ticket_id) ON DELETE CASCADE,
+                INDEX refund_queue_by_train (train_id)
                 );
+            """,  # tickets whose reservation was cancelled (a train broke), drained by drain_refund_queue
             """
+            CREATE TABLE IF NOT EXISTS Outbox (
+                outbox_id INT AUTO_INCREMENT PRIMARY KEY,
+                operation VARCHAR(64) NOT NULL,
+                payload VARCHAR(1024) NOT NULL,
+                created_at DATETIME NOT NULL
+                );
+            """  # changes of Neo4j to apply after a MariaDB commit (see Traits.reconcile_outbox)
+        ]
+
+    @staticmethod
+    def generate_neo4j_initialization_code() -> List[str]:
+        """
+        Returns the Cypher statements creating the constraints and indexes of the graph database
+        (the Neo4j counterpart of generate_sql_initialization_code)
+        """
+        return [
+            # station keys are unique (this also creates the index used by every MATCH on station_id)
+            "CREATE CONSTRAINT station_id_unique IF NOT EXISTS FOR (s:Station) REQUIRE s.station_id IS UNIQUE",
+            "CREATE INDEX schedule_train_id IF NOT EXISTS FOR (s:Schedule) ON (s.train_id)",
+            "CREATE INDEX schedule_validity IF NOT EXISTS FOR (s:Schedule) ON (s.valid_from, s.valid_until)",
+            "CREATE INDEX stop_station_id IF NOT EXISTS FOR (s:Stop) ON (s.station_id)",
+            # trips of an imported timetable are unique (and looked up by the importer to skip the imported ones)
+            SCHEDULE_TRIP_ID_CONSTRAINT,
         ]
 
+    def initialize_neo4j(self, timeout_in_seconds: int = 300) -> None:
+        """
+        Create the constraints and indexes of the graph database (if they do not exist yet) and wait until they are online
+        """
+        with self.neo4j_driver.session() as session:
+            for statement in self.generate_neo4j_initialization_code():
+                session.run(statement).consume()
+            session.run("CALL db.awaitIndexes($timeout)", timeout=timeout_in_seconds).consume()
+
+    def import_timetable(self, stations_path: str, edges_path: str, trips_path: str, stop_times_path: str,
+                         batch_size: int = 5000, checkpoint_path: Optional[str] = None, progress=None) -> dict:
+        """
+        Import a GTFS-like timetable (see traits/importer.py for the format of the CSV files) in batches.
+        If checkpoint_path is given, an interrupted import is resumed from the last written batch.
+        Returns the statistics of the import (rows and entities written, batches, rows per second)
+        Raise a ValueError (with file and line) for invalid rows
+        """
+        importer = TimetableImporter(self.rdbms_admin_connection, self.neo4j_driver, batch_size, checkpoint_path, progress)
+        return importer.run(stations_path, edges_path, trips_path, stop_times_path)
+
+    def find_full_table_scans(self, tables: Sequence[str] = CHECKED_TABLES) -> List[Tuple[str, str]]:
+        """
+        EXPLAIN the SQL statements of Traits and of the existence checks and return (statement, table) for every full
+        scan of the given tables (see full_table_scans), empty if the indexes cover all the access paths
+        """
+        statements, _ = extract_sql_statements()
+        return full_table_scans(self.rdbms_admin_connection, statements, tables)  # admin: EXPLAIN DELETE needs the DELETE privilege
+
     def get_all_users(self) -> List:
         """
         Return all the users stored in the database
         """
         # using with statement to automatically close the cursor when done
-        with self.rdbms_admin_connection.cursor() as cursor:  # admin features
-            cursor.execute("SELECT * FROM Users;")
-            users = cursor.fetchall()
-            return users
+        with self.replicas.connection() as replica:
+            with (replica or self.rdbms_admin_connection).cursor() as cursor:  # admin features
+                cursor.execute("SELECT * FROM Users;")
+                users = cursor.fetchall()
+                return users
 
     def get_all_schedules(self) -> List:
         """
@@ -94,10 +325,47 @@ class TraitsUtility(TraitsUtilityInterface):
 # implementing the main class we need to implement
 class Traits(TraitsInterface):
 
-    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver) -> None:
-        self.rdbms_connection = rdbms_connection
-        self.rdbms_admin_connection = rdbms_admin_connection
+    def __init__(self, rdbms_connection, rdbms_admin_connection, neo4j_driver,
+                 search_cache: Optional[SearchCache] = None, statements: Optional[PreparedStatements] = None,
+                 replicas: Optional[Union[ReplicaRouter, Sequence]] = None,
+                 status_cache: Optional[TrainStatusCache] = None) -> None:
+        # each of the MariaDB connections can also be a ConnectionPool: then every call checks out its own connection,
+        # so one instance can serve many threads
+        self.connections = PooledConnections(user=rdbms_connection, admin=rdbms_admin_connection)
+        # the hot statements are prepared once per connection (registry shared by all instances by default)
+        self.statements = statements if statements is not None else prepared_statements
+        for pool in self.connections.pools().values():
+            self.statements.follow_resets(pool)
+        # read replicas (connections, ConnectionPools or a ReplicaRouter) serving the read-only methods; users are
+        # pinned to the primary for a while after their writes, so they read them
+        self.replicas = replicas if isinstance(replicas, ReplicaRouter) else ReplicaRouter(replicas or ())
         self.neo4j_driver = neo4j_driver
+        # stations, connections and schedules are read from a snapshot kept in memory (shared by all instances using the same driver)
+        self.station_graph = StationGraph.for_driver(neo4j_driver)
+        # optional cache for the results of search_connections (cleared by every change of the timetable)
+        self.search_cache = search_cache
+        # optional write-through cache of the status and free capacity of the trains (for polling clients)
+        self.status_cache = status_cache
+        # existence checks of stations, trains and users (one query per database for any number of keys)
+        self.validator = ExistenceValidator(neo4j_driver, self.station_graph, self.statements)
+        # optional contraction hierarchies of the station graph by metric (see prepare_hierarchies)
+        self.hierarchies: Dict[str, ContractionHierarchy] = {}
+        self._fresh_hierarchies: Dict[str, int] = {}  # metric -> version of the station graph it was checked against
+        self._autoinc_step: Optional[int] = None  # id step of the multi-row Tickets INSERT, 0 if not consecutive
+
+    @property
+    def rdbms_connection(self):
+        return self.connections.get('user')
+
+    @property
+    def rdbms_admin_connection(self):
+        return self.connections.get('admin')
+
+    def pool_stats(self) -> dict:
+        """
+        Return the metrics (wait times, utilisation, ...) of the connection pools by role ('user', 'admin')
+        """
+        return {role: pool.stats() for role, pool in self.connections.pools().items()}
 
     ########################################################################
     # Basic Features
@@ -105,6 +373,7 @@ class Traits(TraitsInterface):
 
     def search_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
                            travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
+                           travel_time_hour: int = None, travel_time_minute: int = None,
                            is_departure_time=True,
                            sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME, is_ascending: bool = True,
                            limit: int = 5) -> List:
@@ -116,66 +385,300 @@ class Traits(TraitsInterface):
         Returns an empty list if no connections are possible
         Raise a ValueError in case of errors and if the starting or ending stations are the same
         """
+        # Sort the journeys (empty list if no connections are possible)
+        return self.search_journeys(starting_station_key, ending_station_key, travel_time_day, travel_time_month,
+                                    travel_time_year, travel_time_hour, travel_time_minute,
+                                    is_departure_time).sort(sort_by, is_ascending, limit)
+
+    def search_journeys(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                        travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
+                        travel_time_hour: int = None, travel_time_minute: int = None,
+                        is_departure_time=True) -> JourneyResults:
+        """
+        Search the connections like search_connections, but return all of them as a JourneyResults: its sort method
+        ranks them by any sorting criteria, direction and limit without searching again (e.g. when the user switches
+        the sorting of the results).
+        """
 
         # Check if the starting and ending stations are the same
         if starting_station_key.to_string() == ending_station_key.to_string():
             raise ValueError("Starting and ending stations cannot be the same")
 
-        # Check if the starting and ending stations exist
-        with self.neo4j_driver.session() as session:
-            result_start = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s",
-                                       station_id=starting_station_key.to_int())
-            result_end = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s",
-                                     station_id=ending_station_key.to_int())
-            if result_start.single() is None or result_end.single() is None:
-                raise ValueError("One or both stations do not exist")
+        # Check if the starting and ending stations exist (in the in-memory snapshot of the station graph)
+        self.validator.check(stations=[starting_station_key.to_int(), ending_station_key.to_int()])
+
+        # Return the cached result if the same search was done recently
+        # (the version of the snapshot is part of the key, so changes made by other instances or by imports are seen)
+        cache_key = (self.station_graph.version, starting_station_key.to_int(), ending_station_key.to_int(),
+                     travel_time_day, travel_time_month, travel_time_year, travel_time_hour, travel_time_minute,
+                     is_departure_time)  # not the sorting: every sorting is answered from the same results
+        if self.search_cache is not None:
+            cached = self.search_cache.get(cache_key)
+            if cached is not None:
+                return cached  # sort returns copies, so callers cannot change the cached result
+
+        # No journey is possible if the stations are not connected at all (answered by the hierarchy, if prepared)
+        hierarchy = self._hierarchy('travel_time')
+        if hierarchy is not None and hierarchy.query(starting_station_key.to_int(), ending_station_key.to_int()) is None:
+            results = JourneyResults([])
+            if self.search_cache is not None:
+                self.search_cache.put(cache_key, results)
+            return results
+
+        # Build the departure events of the timetable and scan them once (instead of enumerating every path in Cypher)
+        connections, departure_after, arrival_before = self._timetable(travel_time_day, travel_time_month, travel_time_year,
+                                                                       travel_time_hour, travel_time_minute, is_departure_time)
+        journeys = ConnectionScan(connections).search(starting_station_key.to_int(), ending_station_key.to_int(),
+                                                      departure_after, arrival_before)
+
+        results = JourneyResults(self._price_journeys(journeys))
+        if self.search_cache is not None:
+            self.search_cache.put(cache_key, results)
+        return results
+
+    def search_pareto_connections(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                                  travel_time_day: int = None, travel_time_month: int = None, travel_time_year: int = None,
+                                  travel_time_hour: int = None, travel_time_minute: int = None,
+                                  is_departure_time=True, max_changes: int = 5) -> List[dict]:
+        """
+        Search the connections between two stations by arrival time, number of changes and price at the same time:
+        return the Pareto-optimal journeys (the fastest, the one with fewest changes, the cheapest and every trade-off
+        between them that is not worse in all three), by arrival time. Besides the keys of search_connections the
+        journeys have departure_time and arrival_time (minutes after midnight).
+        Raise a ValueError in case of errors and if the starting or ending stations are the same
+        """
+        if starting_station_key.to_string() == ending_station_key.to_string():
+            raise ValueError("Starting and ending stations cannot be the same")
+        if max_changes < 0:
+            raise ValueError("The number of changes cannot be negative")
+        self.validator.check(stations=[starting_station_key.to_int(), ending_station_key.to_int()])
+
+        connections, departure_after, arrival_before = self._timetable(travel_time_day, travel_time_month, travel_time_year,
+                                                                       travel_time_hour, travel_time_minute, is_departure_time)
+        journeys = Raptor(connections).search(starting_station_key.to_int(), ending_station_key.to_int(),
+                                              departure_after, arrival_before, max_changes)
+        return self._price_journeys(journeys)
+
+    def shortest_route(self, starting_station_key: TraitsKey, ending_station_key: TraitsKey,
+                       sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME) -> Optional[dict]:
+        """
+        Return the shortest (OVERALL_TRAVEL_TIME) or cheapest (ESTIMATED_PRICE) route over the connections of the
+        stations, regardless of the schedules: the stations of the route with its travel time and price, None if the
+        stations are not connected.
+        Answered by the contraction hierarchy of the metric if it was prepared for the current station graph, by a full
+        Dijkstra search on the compact (CSR) station graph otherwise.
+        Raise a ValueError in case of errors and if the starting or ending stations are the same
+        """
+        metrics = {SortingCriteria.OVERALL_TRAVEL_TIME: 'travel_time', SortingCriteria.ESTIMATED_PRICE: 'price'}
+        if sort_by not in metrics:
+            raise ValueError("Routes can only be sorted by travel time or price")
+        if starting_station_key.to_string() == ending_station_key.to_string():
+            raise ValueError("Starting and ending stations cannot be the same")
+        start_id, end_id = starting_station_key.to_int(), ending_station_key.to_int()
+        self.validator.check(stations=[start_id, end_id])
+
+        hierarchy = self._hierarchy(metrics[sort_by])
+        if hierarchy is not None:
+            route = hierarchy.query(start_id, end_id)
+        else:
+            route = self.station_graph.csr().shortest_path(start_id, end_id, metrics[sort_by])
+        if route is None:
+            return None
+
+        stations = route[1]
+        edges = [self.station_graph.adjacency[start][end] for start, end in zip(stations, stations[1:])]
+        return {
+            'start_key': start_id,
+            'end_key': end_id,
+            'stations': stations,
+            'travel_time': sum(edge[0] for edge in edges),
+            'estimated_price': round(sum(METRICS['price'](edge) for edge in edges), 2),
+        }
+
+    def prepare_hierarchies(self, directory: Optional[Union[str, Path]] = None,
+                            metrics: Sequence[str] = ('travel_time', 'price')) -> None:
+        """
+        Preprocess the station graph into contraction hierarchies (travel time and price), used by shortest_route and
+        search_connections until the graph changes. If directory is given they are saved there too (see load_hierarchies).
+        """
+        adjacency = self.station_graph.ensure_loaded().adjacency
+        version = self.station_graph.version
+        for metric in metrics:
+            hierarchy = ContractionHierarchy.build(adjacency, metric)
+            if directory is not None:
+                hierarchy.save(Path(directory) / f"contraction_{metric}.json")
+            self.hierarchies[metric] = hierarchy
+            self._fresh_hierarchies[metric] = version
+
+    def load_hierarchies(self, directory: Union[str, Path]) -> List[str]:
+        """
+        Load the contraction hierarchies saved by prepare_hierarchies, return the metrics of the ones that are still
+        fresh (built for the current station graph, the stale ones are not used)
+        """
+        for path in Path(directory).glob("contraction_*.json"):
+            hierarchy = ContractionHierarchy.load(path)
+            self.hierarchies[hierarchy.metric] = hierarchy
+            self._fresh_hierarchies.pop(hierarchy.metric, None)
+        return [metric for metric in self.hierarchies if self._hierarchy(metric) is not None]
 
-        # If a travel date is provided, convert it to a datetime object
+    def _hierarchy(self, metric: str) -> Optional[ContractionHierarchy]:
+        """
+        Return the hierarchy of the metric if it was built for the current station graph, None otherwise
+        """
+        hierarchy = self.hierarchies.get(metric)
+        if hierarchy is None:
+            return None
+        version = self.station_graph.ensure_loaded().version
+        if self._fresh_hierarchies.get(metric) != version:
+            if not hierarchy.is_fresh_for(self.station_graph.adjacency):  # the graph changed since it was built
+                return None
+            self._fresh_hierarchies[metric] = version  # the graph changed back or only stations/schedules changed
+        return hierarchy
+
+    def _timetable(self, travel_time_day, travel_time_month, travel_time_year, travel_time_hour, travel_time_minute,
+                   is_departure_time):
+        """
+        Return the connections of the timetable valid on the travel date and the time window of the journeys
+        (departure_after, arrival_before)
+        """
+        # If a travel date is provided, convert it to a datetime object (only the schedules valid on that day are used)
         travel_date = None
         if travel_time_day and travel_time_month and travel_time_year:
             travel_date = datetime(travel_time_year, travel_time_month, travel_time_day)
 
-        # Define the sorting criteria (using list comprehension in neo4j to avoid multiple ORDER BY statements)
-        sorting = "reduce(time = 0, x in connection | time + x.travel_time)"  # default to overall travel time (sum of travel times)
-        if sort_by == SortingCriteria.NUMBER_OF_TRAIN_CHANGES:
-            sorting = "size(connection) - 1 "  # number of train changes (number of connections - 1)
-        elif sort_by == SortingCriteria.OVERALL_WAITING_TIME:
-            sorting = "reduce(time = 0, x in range(1, size(connection)) | time + (connection[x].departure_time - connection[x-1].arrival_time))"  # overall waiting time (difference between arrival and departure times)
-        elif sort_by == SortingCriteria.ESTIMATED_PRICE:
-            sorting = "reduce(price = 0, x in connection | price + x.price)"  # estimated price (sum of prices)
-
-        # Build the query
-        #  finds all possible paths between the starting and ending stations and calculates the overall travel time, number of train changes, waiting time, and estimated price
-        query = f"""
-            MATCH path=(start:Station {{station_id: $start_id}})-[connection:CONNECTION*]->(end:Station {{station_id: $end_id}})
-            WHERE 1=1 {f" AND connection.date = '{travel_date.strftime('%Y-%m-%dT%H:%M')}'" if travel_date else ""}
-            WITH path, connection, start, end
-            RETURN start.station_id AS start_key, end.station_id AS end_key, reduce(price = 0, r in connection | price + r.price) AS estimated_price, reduce(time = 0, x in connection | time + x.travel_time) AS travel_time, size(connection) - 1 AS changes, reduce(time = 0, x in range(1, size(connection)) | time + (connection[x].departure_time - connection[x-1].arrival_time)) AS waiting_time
-            ORDER BY {sorting} {"ASC" if is_ascending else "DESC"}
-            LIMIT $limit
-        """
-
-        # Run the query and return the result (empty list if no connections are possible)
-        with self.neo4j_driver.session() as session:
-            result = session.run(query, start_id=starting_station_key.to_int(), end_id=ending_station_key.to_int(), limit=limit)
-            return result.data()
+        connections = build_connections(self.station_graph.get_schedules(travel_date), self.station_graph.adjacency)
+
+        # If a travel time is provided, keep the journeys departing after (or arriving before) it
+        departure_after = arrival_before = None
+        if travel_time_hour is not None:
+            time = travel_time_hour * 60 + (travel_time_minute or 0)
+            if is_departure_time:
+                departure_after = time
+            else:
+                arrival_before = time
+        return connections, departure_after, arrival_before
+
+    def _price_journeys(self, journeys: List[dict]) -> List[dict]:
+        # Price the journeys with the fare engine, so the estimated price is what buy_ticket charges for their legs
+        prices = self.fares.price_many([journey['legs'] for journey in journeys], [False] * len(journeys))
+        for journey, price in zip(journeys, prices):
+            journey['estimated_price'] = price
+        return journeys
+
+    @property
+    def fares(self) -> FareTable:
+        # the prices of the CONNECTION edges, rebuilt when the station graph changes
+        return FareTable.for_graph(self.station_graph)
+
+    def quote_prices(self, connections: List[list], also_reserve_seats: bool = False) -> List[float]:
+        """
+        Return the price buy_ticket would charge for each connection (same format as for buy_ticket), in one pass.
+        Raise a ValueError if a leg is between stations that are not connected.
+        """
+        return self.fares.price_many(connections, [also_reserve_seats] * len(connections))
+
+    def _invalidate_search_cache(self) -> None:
+        # called by every method changing the data search_connections depends on
+        if self.search_cache is not None:
+            self.search_cache.clear()
 
+    def _check_on_replica(self, pin_key, trains=(), users=()) -> None:
+        """
+        Check the existence of the trains and users on a replica; keys missing there may just not be replicated yet,
+        so a failed check is repeated on the primary (the common case, all keys existing, never reaches the primary)
+        """
+        with self.replicas.connection(pin_key) as replica:
+            if replica is not None:
+                try:
+                    self.validator.check(replica, trains=trains, users=users)
+                    return
+                except MissingKeysError:
+                    pass
+        self.validator.check(self.rdbms_connection, trains=trains, users=users)
+
+    @checks_out_connections
     def get_train_current_status(self, train_key: TraitsKey) -> Optional[TrainStatus]:
         """
         Check the status of a train. If the train does not exist returns None
         """
-        with self.rdbms_admin_connection.cursor() as cursor:  # using admin connection on purpose, as this is an admin feature (and tests would fail without it)
-            cursor.execute("SELECT status FROM Trains WHERE train_id = %s;", (train_key.to_int(),))  # %s is a placeholder
-            status = cursor.fetchone()
+        if self.status_cache is not None:
+            return self.get_train_statuses([train_key])[0]
 
-            if status is None:  # train does not exist
-                return None
-            return TrainStatus(status[0])  # 0 operational, 1 delayed, 2 broken (status[0] because status is a tuple)
+        # using admin connection on purpose, as this is an admin feature (and tests would fail without it)
+        with self.replicas.connection(('train', train_key.to_int())) as replica:
+            rows = self.statements.query(replica or self.rdbms_admin_connection, 'train_status', (train_key.to_int(),))
+
+        if not rows:  # train does not exist
+            return None
+        return TrainStatus(rows[0][0])  # 0 operational, 1 delayed, 2 broken (rows[0][0]: status of the first row)
+
+    @checks_out_connections
+    def get_train_statuses(self, train_keys: List[TraitsKey]) -> List[Optional[TrainStatus]]:
+        """
+        Return the status of each train (None if it does not exist), in the order of train_keys.
+        Trains in the status cache are answered from it, all the others are read with a single query.
+        """
+        states = self._train_states([train_key.to_int() for train_key in train_keys])
+        return [None if states[train_key.to_int()][0] is None else TrainStatus(states[train_key.to_int()][0])
+                for train_key in train_keys]
+
+    @checks_out_connections
+    def get_train_capacities(self, train_keys: List[TraitsKey]) -> List[Optional[int]]:
+        """
+        Return the number of free seats of each train (None if it does not exist), in the order of train_keys,
+        like get_train_statuses
+        """
+        states = self._train_states([train_key.to_int() for train_key in train_keys])
+        return [states[train_key.to_int()][1] for train_key in train_keys]
+
+    def _train_states(self, train_ids: List[int]) -> Dict[int, tuple]:
+        """
+        Return (status, capacity) by train_id, (None, None) for the trains that do not exist
+        """
+        states, misses = self._cached_train_states(train_ids)
+        if not misses:
+            return states
+
+        # admin connection, like get_train_current_status
+        with self.replicas.connection(*(('train', train_id) for train_id in misses)) as replica:
+            rows = self.statements.query(replica or self.rdbms_admin_connection, 'train_states', misses,
+                                         sql=f"SELECT train_id, status, capacity FROM Trains WHERE train_id IN ({', '.join(['%s'] * len(misses))})")
+        states.update(self._read_train_states(misses, rows))
+        return states
+
+    def _cached_train_states(self, train_ids: List[int]) -> Tuple[Dict[int, tuple], List[int]]:
+        # the states found in the status cache and the train ids to read
+        if self.status_cache is not None:
+            return self.status_cache.get_many(train_ids)
+        return {}, list(dict.fromkeys(train_ids))
+
+    def _read_train_states(self, train_ids: List[int], rows) -> Dict[int, tuple]:
+        # the states of the trains from the (train_id, status, capacity) rows read for them, stored in the status cache
+        read = dict.fromkeys(train_ids, (None, None))
+        read.update((train_id, (status, capacity)) for train_id, status, capacity in rows)
+        if self.status_cache is not None:
+            for train_id, state in read.items():
+                self.status_cache.put(train_id, state)
+        return read
+
+    def _cache_train_state(self, train_id: int, status: Optional[int], capacity: Optional[int]) -> None:
+        # called after the commit of every change of a train (None, None: the train was deleted)
+        if self.status_cache is not None:
+            self.status_cache.put(train_id, (status, capacity))
+
+    def _forget_train_states(self, train_ids: Optional[Sequence[int]] = None) -> None:
+        # called after seats were taken or given back (None: on trains that are not known)
+        if self.status_cache is not None:
+            if train_ids is None:
+                self.status_cache.clear()
+            else:
+                self.status_cache.discard(*train_ids)
 
     ########################################################################
     # Advanced Features
     ########################################################################
 
+    @checks_out_connections
     def buy_ticket(self, user_email: str, connection, also_reserve_seats=True):
         """
         Given a train connection instance (e.g., on a given date/time), registered users can book tickets and optionally reserve seats. When the user decides to reserve seats, the system will try to reserve all the available seats automatically.
@@ -189,55 +692,216 @@ class Traits(TraitsInterface):
         If the user does not exist, the method must raise a ValueError
         """
 
-        # Check if the user exists (is registered)
-        with self.rdbms_connection.cursor(dictionary=True) as cursor:  # dictionary=True to get the results as dictionaries
-            cursor.execute("SELECT * FROM Users WHERE email = %s", (user_email,))
-            user = cursor.fetchone()
-            if user is None:
-                raise ValueError("User does not exist")
-
-            # get connection details:
-            # looping through the connections to calculate the total price and reserve seats
-            distance_price = 0
-            # assuming that the connection is a list of dictionaries with the following keys: train_id, starting_station_key, ending_station_key, travel_time
-            for c in connection:
-                # Check if the train exists
-                train_id = c['train_id']
-                cursor.execute("SELECT * FROM Trains WHERE train_id = %s", (train_id,))
-                train = cursor.fetchone()
-                if train is None:
-                    raise ValueError("Train does not exist")
-
-                # Check if the train has enough capacity if the user wants to reserve a seat
-                if train['capacity'] <= 0 and also_reserve_seats:  # no seats available, but user wants to reserve
-                    raise ValueError("No seats available for reservation")
+        # assuming that the connection is a list of dictionaries with the following keys: train_id, starting_station_key, ending_station_key, travel_time
+        connection = self._normalize_connection(connection)
+
+        # Check if the user exists (is registered) and if the trains exist, with a single query
+        train_ids = [c['train_id'] for c in connection]
+        self._check_on_replica(user_email.lower(), trains=train_ids, users=[user_email])
+        if not connection:
+            raise ValueError("The connection must contain at least one train")
 
-                # Calculate the travel price
-                distance_price += c['travel_time']   # summing up the travel time
+        legs, total_price = self.fares.price_legs(connection, also_reserve_seats)  # priced on the server, from the edges
+        reserved_trains = list(dict.fromkeys(train_ids))  # one seat per train, even if the user stays on it for several legs
 
-            total_price = round(distance_price / 2, 2)  # price per minute
+        db = self.rdbms_connection
+
+        def reserve_and_insert(cursor):
+            # If also_reserve_seats is True, take a seat on every train of the connection with a single conditional
+            # decrement: only trains with free seats are updated, so the affected row count proves that all legs got a seat
+            # (the rows stay locked until the commit, concurrent buyers cannot overbook)
             if also_reserve_seats:
-                total_price += len(connection) * 2  # 2 euros per reserved seat
+                if len(reserved_trains) == 1:
+                    reserved = self.statements.execute(db, 'reserve_seat', reserved_trains).rowcount
+                else:
+                    reserved = self.statements.execute(db, 'reserve_seats', reserved_trains,
+                                                       sql=f"UPDATE Trains SET capacity = capacity - 1 WHERE train_id IN ({', '.join(['%s'] * len(reserved_trains))}) AND capacity > 0").rowcount
+                if reserved != len(reserved_trains):  # at least one train is full, the whole purchase is rolled back
+                    raise ValueError("No seats available for reservation")
 
-            # Insert a new row into the Tickets table
-            cursor.execute("INSERT INTO Tickets (user_email, train_id, reserved_seat, price, purchase_date, start_station_key, end_station_key ) VALUES (%s, %s, %s, %s, %s, %s, %s)",
-                           (user_email, train_id, also_reserve_seats, total_price, datetime.now().isoformat(), connection[0]['starting_station_key'], connection[-1]['ending_station_key']))
+            # Insert a new row into the Tickets table (train_id is the train of the last leg)
+            purchase_date = datetime.now().isoformat()
+            ticket_id = self.statements.execute(db, 'insert_ticket', (
+                user_email, train_ids[-1], also_reserve_seats, total_price, purchase_date,
+                connection[0]['starting_station_key'], connection[-1]['ending_station_key'])).lastrowid
 
-            # Get the ticket_id of the newly inserted ticket
-            ticket_id = cursor.lastrowid
+            # Insert all the legs at once
+            cursor.executemany(INSERT_TICKET_LEGS, [(ticket_id,) + leg for leg in legs])
 
             # Insert a new row into the PurchaseHistory table
-            cursor.execute("INSERT INTO PurchaseHistory (user_email, ticket_id, purchase_date) VALUES (%s, %s, %s)",
-                           (user_email, ticket_id, datetime.now().isoformat()))
+            self.statements.execute(db, 'insert_purchase_history', (user_email, ticket_id, purchase_date))
 
-            # If also_reserve_seats is True, decrement the train's capacity by 1
-            if also_reserve_seats:
-                cursor.execute("UPDATE Trains SET capacity = capacity - 1 WHERE train_id = %s", (train_id,))
+        # One transaction (committed at the end, rolled back on errors and retried on deadlocks or lock wait timeouts)
+        run_transaction(db, reserve_and_insert)
+        self.replicas.pin(user_email.lower())  # the user reads the new ticket from the primary until it is replicated
+        if also_reserve_seats:
+            self._forget_train_states(reserved_trains)
 
-            # Commit the changes
-            self.rdbms_connection.commit()
+    @checks_out_connections
+    def buy_tickets(self, requests: List[dict]) -> List[dict]:
+        """
+        Buy many tickets at once (e.g. group and agency bookings).
+        Every request is a dictionary with the keys user_email, connection and optionally also_reserve_seats (default True),
+        with the same meaning as the arguments of buy_ticket.
+
+        Users and trains are validated with one query, the seats are allocated in request order on the locked trains and
+        all the rows are written in bulk in a single transaction.
+        Instead of raising, the method returns one outcome per request (in the same order): a dictionary with the
+        ticket_id (None if the request failed) and the error message (None if the ticket was bought).
+        A request asking for seats fails alone if one of its trains has no seats left (partial success).
+        """
+        requests = self._normalize_requests(requests)
+        outcomes = [{'ticket_id': None, 'error': None} for _ in requests]
+
+        # validate all the users and trains at once
+        all_trains = {c['train_id'] for r in requests for c in r['connection']}
+        all_users = {r['user_email'] for r in requests}
+        with self.replicas.connection(*{email.lower() for email in all_users}) as replica:
+            missing_trains, missing_users = self.validator.missing_rows(replica or self.rdbms_connection, all_trains,
+                                                                        all_users, self.statements)
+            if replica is not None and (missing_trains or missing_users):  # maybe not replicated yet: ask the primary
+                missing_trains, missing_users = self.validator.missing_rows(self.rdbms_connection, missing_trains,
+                                                                            missing_users, self.statements)
+        fares = self.fares  # loaded before the transaction starts (it may read the station graph from Neo4j)
+        valid = self._valid_requests(requests, missing_trains, missing_users, fares, outcomes)
+        if not valid:
+            return outcomes
+
+        def allocate_and_insert(cursor):
+            for index in valid:  # reset what a previous (retried) attempt allocated
+                outcomes[index].update(ticket_id=None, error=None)
+
+            # lock the trains of the batch and allocate their free seats in request order
+            trains = sorted({c['train_id'] for index in valid for c in requests[index]['connection']})
+            cursor.execute(f"SELECT train_id, capacity FROM Trains WHERE train_id IN ({', '.join(['%s'] * len(trains))}) FOR UPDATE",
+                           tuple(trains))
+            bought, taken = self._allocate_seats(requests, valid, dict(cursor.fetchall()), outcomes)
+            if not bought:
+                return
+
+            # one grouped UPDATE for all the reserved seats
+            if taken:
+                cursor.execute(*self._take_seats(taken))
+
+            purchase_date = datetime.now().isoformat()
+            tickets, legs = self._ticket_rows(requests, bought, fares, purchase_date)
+            ticket_ids = self._insert_tickets(cursor, tickets)
+
+            cursor.executemany(INSERT_TICKET_LEGS, [(ticket_id,) + leg for ticket_id, ticket_legs in zip(ticket_ids, legs)
+                                                    for leg in ticket_legs])
+            cursor.executemany(STATEMENTS['insert_purchase_history'],
+                               [(requests[index]['user_email'], ticket_id, purchase_date) for index, ticket_id in zip(bought, ticket_ids)])
+
+            for index, ticket_id in zip(bought, ticket_ids):
+                outcomes[index]['ticket_id'] = ticket_id
+            return list(taken)  # the trains whose seats were taken
+
+        # One transaction and one commit for the whole batch
+        reserved_trains = run_transaction(self.rdbms_connection, allocate_and_insert)
+        self._forget_train_states(reserved_trains or [])
+        self.replicas.pin(*{requests[index]['user_email'].lower() for index in valid})
+        return outcomes
+
+    @classmethod
+    def _normalize_requests(cls, requests: List[dict]) -> List[dict]:
+        # the requests of buy_tickets with normalized connections and the default of also_reserve_seats
+        return [dict(r, connection=cls._normalize_connection(r.get('connection')),
+                     also_reserve_seats=r.get('also_reserve_seats', True))
+                for r in requests]
 
-    def get_purchase_history(self, user_email: str) -> List:
+    @staticmethod
+    def _valid_requests(requests: List[dict], missing_trains, missing_users, fares: FareTable,
+                        outcomes: List[dict]) -> List[int]:
+        """
+        Set the error of the buy_tickets requests that cannot be bought, return the indexes of the others
+        """
+        valid = []
+        for index, r in enumerate(requests):
+            # same messages (and precedence) as buy_ticket
+            if r['user_email'] in missing_users:
+                outcomes[index]['error'] = "User does not exist"
+            elif any(c['train_id'] in missing_trains for c in r['connection']):
+                outcomes[index]['error'] = "Train does not exist"
+            elif not r['connection']:
+                outcomes[index]['error'] = "The connection must contain at least one train"
+            elif not fares.connects(r['connection']):
+                outcomes[index]['error'] = "Stations are not connected"
+            else:
+                valid.append(index)
+        return valid
+
+    @staticmethod
+    def _allocate_seats(requests: List[dict], valid: List[int], free_seats: Dict[int, int],
+                        outcomes: List[dict]) -> Tuple[List[int], Dict[int, int]]:
+        """
+        Allocate the free seats of the locked trains to the valid requests in request order; return the indexes of the
+        requests to buy and the seats taken by train (requests asking for a full train get an error instead)
+        """
+        taken = dict.fromkeys(free_seats, 0)
+        bought = []
+        for index in valid:
+            r = requests[index]
+            if r['also_reserve_seats']:
+                reserved_trains = set(c['train_id'] for c in r['connection'])  # one seat per train
+                if any(free_seats[train_id] - taken[train_id] <= 0 for train_id in reserved_trains):
+                    outcomes[index]['error'] = "No seats available for reservation"
+                    continue
+                for train_id in reserved_trains:
+                    taken[train_id] += 1
+            bought.append(index)
+        return bought, {train_id: seats for train_id, seats in taken.items() if seats}
+
+    @staticmethod
+    def _take_seats(taken: Dict[int, int]) -> Tuple[str, tuple]:
+        # the grouped UPDATE taking the seats of several trains, with its parameters
+        cases = ' '.join(['WHEN %s THEN %s'] * len(taken))
+        return (f"UPDATE Trains SET capacity = capacity - CASE train_id {cases} END WHERE train_id IN ({', '.join(['%s'] * len(taken))})",
+                tuple(value for item in taken.items() for value in item) + tuple(taken))
+
+    @staticmethod
+    def _ticket_rows(requests: List[dict], bought: List[int], fares: FareTable,
+                     purchase_date: str) -> Tuple[List[tuple], List[List[tuple]]]:
+        # the Tickets rows and the legs (without ticket_id) of the bought requests
+        tickets, legs = [], []
+        for index in bought:
+            r = requests[index]
+            ticket_legs, total_price = fares.price_legs(r['connection'], r['also_reserve_seats'])
+            tickets.append((r['user_email'], r['connection'][-1]['train_id'], r['also_reserve_seats'], total_price,
+                            purchase_date, r['connection'][0]['starting_station_key'], r['connection'][-1]['ending_station_key']))
+            legs.append(ticket_legs)
+        return tickets, legs
+
+    @staticmethod
+    def _normalize_connection(connection) -> List[dict]:
+        """
+        Return the legs of the connection with int train and station ids: they are compared with the ids read back from
+        the databases (e.g. the missing trains, the free seats by train and the edges of the fare table)
+        """
+        return [dict(c, train_id=int(c['train_id']), starting_station_key=int(c['starting_station_key']),
+                     ending_station_key=int(c['ending_station_key'])) for c in connection or []]
+
+    def _insert_tickets(self, cursor, tickets: List[tuple]) -> List[int]:
+        """
+        Insert the Tickets rows of buy_tickets and return their ticket ids, in the same order.
+        The ids of a multi-row INSERT are consecutive (lastrowid is the first one, then every auto_increment_increment)
+        only with innodb_autoinc_lock_mode 0 or 1: with 2 (interleaved) the rows are inserted one at a time instead.
+        """
+        if self._autoinc_step is None:  # the lock mode cannot change while the server runs: read it once
+            cursor.execute("SELECT @@innodb_autoinc_lock_mode, @@auto_increment_increment")
+            lock_mode, increment = cursor.fetchone()
+            self._autoinc_step = int(increment) if int(lock_mode) in (0, 1) else 0
+
+        if self._autoinc_step:
+            cursor.executemany(STATEMENTS['insert_ticket'], tickets)
+            return [cursor.lastrowid + i * self._autoinc_step for i in range(len(tickets))]
+        ticket_ids = []
+        for ticket in tickets:
+            cursor.execute(STATEMENTS['insert_ticket'], ticket)
+            ticket_ids.append(cursor.lastrowid)
+        return ticket_ids
+
+    @checks_out_connections
+    def get_purchase_history(self, user_email: str, page_size: Optional[int] = None, cursor: Optional[str] = None) -> List:
         """
         Access Purchase History
 
@@ -245,23 +909,56 @@ class Traits(TraitsInterface):
         The purchase history is always represented in descending starting time (at the top the most recent trips).
 
         If the user is not registered, the list is empty
-        """
 
-        query = f"""
-        SELECT ph.purchase_date, t.price, t.reserved_seat, tr.status, t.start_station_key, t.end_station_key
-        FROM Users u
-        JOIN PurchaseHistory ph ON u.email = ph.user_email
-        JOIN Tickets t ON ph.ticket_id = t.ticket_id
-        JOIN Trains tr ON t.train_id = tr.train_id
-        WHERE u.email = %s
-        ORDER BY ph.purchase_date DESC
-        """  # DESC: most recent trips at the top
+        If page_size is given, at most page_size tickets are returned as a PurchaseHistoryPage, whose next_cursor is
+        passed as cursor to get the next page (keyset pagination on purchase_date and ticket_id).
+        """
+        params = self._history_parameters(user_email, page_size, cursor)
 
         # empty list if the user is not registered
-        with self.rdbms_connection.cursor() as cursor:  # user connection (only read)
-            cursor.execute(query, (user_email,))
-            history = cursor.fetchall()
+        with self.replicas.connection(user_email.lower()) as replica:  # read from a replica if possible
+            with (replica or self.rdbms_connection).cursor(dictionary=True) as db_cursor:  # user connection (only read)
+                db_cursor.execute(PURCHASE_HISTORY_QUERY, params)
+                return self._history_page(db_cursor, page_size)
+
+    @staticmethod
+    def _history_parameters(user_email: str, page_size: Optional[int], cursor: Optional[str]) -> tuple:
+        # the parameters of PURCHASE_HISTORY_QUERY
+        if page_size is not None and page_size < 1:
+            raise ValueError("The page size must be positive")
+
+        # the query text is always the same: the first page starts after the largest possible keyset
+        purchase_date, ticket_id = decode_cursor(cursor) if cursor is not None else (datetime.max, 2 ** 31)
+        limit = page_size + 1 if page_size is not None else 2 ** 64 - 1  # one more ticket to know if there is a next page
+        return user_email, purchase_date, purchase_date, ticket_id, limit
+
+    @staticmethod
+    def _history_page(rows, page_size: Optional[int]) -> List:
+        """
+        Group the rows of PURCHASE_HISTORY_QUERY (dictionaries) by ticket, return the history (a PurchaseHistoryPage if
+        page_size is given)
+        """
+        history, tickets = [], {}
+        for row in rows:
+            ticket = tickets.get(row['ticket_id'])
+            if ticket is None:
+                ticket = {'ticket_id': row['ticket_id'], 'purchase_date': row['purchase_date'],
+                          'start_station_key': row['start_station_key'], 'end_station_key': row['end_station_key'],
+                          'price': row['price'], 'reserved_seat': bool(row['reserved_seat']), 'connections': []}
+                tickets[row['ticket_id']] = ticket
+                history.append(ticket)
+            if row['train_id'] is not None:
+                ticket['connections'].append({'train_id': row['train_id'],
+                                              'start_station_key': row['leg_start_station_key'],
+                                              'end_station_key': row['leg_end_station_key'],
+                                              'price': row['leg_price'], 'reserved_seat': bool(row['leg_reserved_seat'])})
+
+        if page_size is None:
             return history
+        if len(history) <= page_size:
+            return PurchaseHistoryPage(history)
+        last = history[page_size - 1]
+        return PurchaseHistoryPage(history[:page_size], encode_cursor(last['purchase_date'], last['ticket_id']))
 
     ########################################################################
     # Admin Features:
@@ -269,6 +966,7 @@ class Traits(TraitsInterface):
     # using only the admin connection for these features
     # Add and remove users
 
+    @checks_out_connections
     def add_user(self, user_email: str, user_details) -> None:
         """
         Add a new user to the system with given email and details.
@@ -293,47 +991,79 @@ class Traits(TraitsInterface):
                 raise ValueError("Invalid email format or user already exists")
 
             self.rdbms_admin_connection.commit()
+        self.replicas.pin(user_email.lower())  # read-your-writes: the user is read from the primary for a while
 
+    @checks_out_connections
     def delete_user(self, user_email: str) -> None:
         """
         Delete the user from the db if the user exists.
         The method should also delete any data related to the user (past/future tickets and seat reservations)
         """
-        with self.rdbms_admin_connection.cursor() as cursor:  # admin connection (read/write)
-
-            # Check if the user exists
-            cursor.execute("SELECT * FROM Users WHERE email = %s", (user_email,))
-            user = cursor.fetchone()
-            if user is None:
-                raise ValueError("User does not exist")
-
-            # Find reserved tickets for the user
-            cursor.execute("""
-                SELECT train_id FROM Tickets 
-                WHERE user_email = %s AND reserved_seat = TRUE
-            """, (user_email,))
-            reserved_tickets = cursor.fetchall()
-
-            # Increment train capacity for each reserved ticket
-            for (train_id,) in reserved_tickets:
-                cursor.execute("""
-                    UPDATE Trains SET capacity = capacity + 1 
-                    WHERE id = %s
-                """, (train_id,))
-
-            # Delete user's tickets
-            cursor.execute("DELETE FROM Tickets WHERE user_email = %s", (user_email,))
+        # Check if the user exists
+        self.validator.check(self.rdbms_admin_connection, users=[user_email])
 
-            # Delete user's purchase history
-            cursor.execute("DELETE FROM PurchaseHistory WHERE user_email = %s", (user_email,))
+        # admin connection (read/write), all in one transaction
+        run_transaction(self.rdbms_admin_connection, lambda cursor: self._delete_users(cursor, [user_email]))
+        self.replicas.pin(user_email.lower())
+        self._forget_train_states()  # the seats of the user were given back
 
-            # Delete the user
-            cursor.execute("DELETE FROM Users WHERE email = %s", (user_email,))
+    @checks_out_connections
+    def delete_users(self, user_emails: List[str], chunk_size: int = 1000) -> int:
+        """
+        Delete many users (e.g. GDPR purges) with all their data, like delete_user.
+        The users are deleted chunk_size at a time, one transaction per chunk (so a large purge does not lock the tables
+        for long); users that do not exist are skipped. Return the number of deleted users.
+        """
+        if chunk_size < 1:
+            raise ValueError("The chunk size must be positive")
+
+        user_emails = list(dict.fromkeys(user_emails))
+        deleted = 0
+        for start in range(0, len(user_emails), chunk_size):
+            chunk = user_emails[start:start + chunk_size]
+            deleted += run_transaction(self.rdbms_admin_connection, lambda cursor: self._delete_users(cursor, chunk))
+            self.replicas.pin(*(email.lower() for email in chunk))
+        self._forget_train_states()  # the seats of the users were given back
+        return deleted
+
+    @classmethod
+    def _delete_users(cls, cursor, user_emails: List[str]) -> int:
+        """
+        Delete the users and their data with set-based statements, return the number of deleted users
+        """
+        for statement, params in cls._delete_users_statements(user_emails):
+            cursor.execute(statement, params)
+        return cursor.rowcount
 
-            # Commit the changes and close the cursor
-            self.rdbms_admin_connection.commit()
+    @staticmethod
+    def _delete_users_statements(user_emails: List[str]) -> List[Tuple[str, tuple]]:
+        # the statements of _delete_users with their parameters, in order (the last one deletes the users)
+        return [
+            # give the reserved seats back to the trains with a single UPDATE: one seat per train and reserved ticket
+            # (tickets bought before legs were stored have only the train of the ticket)
+            (f"""
+            UPDATE Trains tr
+            JOIN (
+                SELECT train_id, COUNT(*) AS seats FROM (
+                    SELECT DISTINCT l.ticket_id, l.train_id FROM TicketLegs l JOIN Tickets t ON t.ticket_id = l.ticket_id
+                    WHERE t.user_email IN ({', '.join(['%s'] * len(user_emails))}) AND l.reserved_seat = TRUE
+                    UNION ALL
+                    SELECT t.ticket_id, t.train_id FROM Tickets t
+                    WHERE t.user_email IN ({', '.join(['%s'] * len(user_emails))}) AND t.reserved_seat = TRUE
+                      AND NOT EXISTS (SELECT 1 FROM TicketLegs l WHERE l.ticket_id = t.ticket_id)
+                ) reserved
+                GROUP BY train_id
+            ) r ON r.train_id = tr.train_id
+            SET tr.capacity = tr.capacity + r.seats
+            """, (*user_emails, *user_emails)),
+            # delete in foreign key order: purchase history, tickets (their legs are deleted by the cascade), users
+            (f"DELETE FROM PurchaseHistory WHERE user_email IN ({', '.join(['%s'] * len(user_emails))})", tuple(user_emails)),
+            (f"DELETE FROM Tickets WHERE user_email IN ({', '.join(['%s'] * len(user_emails))})", tuple(user_emails)),
+            (f"DELETE FROM Users WHERE email IN ({', '.join(['%s'] * len(user_emails))})", tuple(user_emails)),
+        ]
 
     # Deleting a train should ensure consistency! Reservations are cancelled, schedules/trips are cancelled, etc.
+    @checks_out_connections
     def add_train(self, train_key: TraitsKey, train_capacity: int, train_status: TrainStatus) -> None:
         """
         Add new trains to the system with given code.
@@ -352,6 +1082,8 @@ class Traits(TraitsInterface):
 
                 # Get the ID of the newly inserted train
                 train_id = cursor.lastrowid
+                self.replicas.pin(('train', train_id))  # read-your-writes: the train is read from the primary for a while
+                self._cache_train_state(train_id, train_status.value, train_capacity)
 
                 return TraitsKey(train_id)
 
@@ -367,67 +1099,179 @@ class Traits(TraitsInterface):
                 # the train status is not valid (CHECK failed)
                 raise ValueError("Invalid input or train already exists")
             self.rdbms_admin_connection.commit()
+            self.replicas.pin(('train', train_key.to_int()))
+            self._cache_train_state(train_key.to_int(), train_status.value, train_capacity)
 
             return train_key  # Return the train_key of the newly created train
 
 
+    @checks_out_connections
     def update_train_details(self, train_key: TraitsKey, train_capacity: Optional[int] = None,
                              train_status: Optional[TrainStatus] = None) -> None:
         """
         Update the details of existing train if specified (i.e., not None), otherwise do nothing.
         """
 
-        with self.rdbms_admin_connection.cursor(dictionary=True) as cursor:
-            cursor.execute("SELECT * FROM Trains WHERE train_id = %s;", (train_key.to_int(),))
+        train_id = train_key.to_int()
+
+        def update(cursor):
+            # lock the train: no seat can be sold nor given back until the changes are committed
+            cursor.execute(LOCK_TRAIN, (train_id,))
             train = cursor.fetchone()
-            if train is None:
-                raise ValueError("Train does not exist")
-
-            if train_capacity is not None:
-                # requirement:
-                if train_capacity < train['capacity']:
-                    raise ValueError("Capacity cannot be decreased")
-                # update the train's capacity
-                cursor.execute("UPDATE Trains SET capacity = %s WHERE train_id = %s;",
-                               (train_capacity, train_key.to_int()))
-
-            if train_status is not None:
-                if train_status not in [TrainStatus.OPERATIONAL, TrainStatus.DELAYED, TrainStatus.BROKEN]:
-                    raise ValueError("Invalid train status")
-                cursor.execute("UPDATE Trains SET status = %s WHERE train_id = %s;",
-                               (train_status.value, train_key.to_int()))  # value: 0 operational, 1 delayed, 2 broken
+            for statement, params in self._train_changes(train, train_id, train_capacity, train_status):
+                cursor.execute(statement, params)
 
+            capacity = train_capacity if train_capacity is not None else train['capacity']
             if train_status == TrainStatus.BROKEN:
-                # If the train is broken, cancel all reservations for the train
-                cursor.execute("SELECT ticket_id FROM Tickets WHERE train_id = %s AND reserved_seat = TRUE", (train_key.to_int(),))
-                reserved_tickets = cursor.fetchall()
-                for (ticket_id,) in reserved_tickets:
-                    cursor.execute("UPDATE Tickets SET reserved_seat = FALSE WHERE ticket_id = %s", (ticket_id,))
+                # If the train is broken, cancel all reservations for the train with a fixed number of statements
+                capacity += self._cancel_reservations(cursor, train_id)
+            return train_status.value if train_status is not None else train['status'], capacity
 
-            self.rdbms_admin_connection.commit()
+        # a ValueError rolls the transaction back, so the lock on the train is released and no half-done change is left
+        status, capacity = run_transaction(self.rdbms_admin_connection, update, dictionary=True)
+        self.replicas.pin(('train', train_id))
+        self._cache_train_state(train_id, status, capacity)
+        self._invalidate_search_cache()
+
+    @staticmethod
+    def _train_changes(train: Optional[dict], train_id: int, train_capacity: Optional[int],
+                       train_status: Optional[TrainStatus]) -> List[Tuple[str, tuple]]:
+        """
+        Validate the changes of update_train_details against the locked row of the train, return the UPDATEs to run
+        """
+        if train is None:
+            raise ValueError("Train does not exist")
+
+        statements = []
+        if train_capacity is not None:
+            # requirement:
+            if train_capacity < train['capacity']:
+                raise ValueError("Capacity cannot be decreased")
+            # update the train's capacity
+            statements.append(("UPDATE Trains SET capacity = %s WHERE train_id = %s;", (train_capacity, train_id)))
+
+        if train_status is not None:
+            if train_status not in [TrainStatus.OPERATIONAL, TrainStatus.DELAYED, TrainStatus.BROKEN]:
+                raise ValueError("Invalid train status")
+            statements.append(("UPDATE Trains SET status = %s WHERE train_id = %s;",
+                               (train_status.value, train_id)))  # value: 0 operational, 1 delayed, 2 broken
+        return statements
+
+    @staticmethod
+    def _cancel_reservations(cursor, train_id: int) -> int:
+        """
+        Cancel all the seat reservations on the train, give the seats back and queue the tickets for the refund
+        (notified by drain_refund_queue). Return the number of cancelled reservations.
+        """
+        cursor.execute(QUEUE_REFUNDS, (train_id,) * QUEUE_REFUNDS.count('%s'))
+        cancelled = cursor.rowcount
+        for statement in CLEAR_RESERVATIONS_STATEMENTS:
+            cursor.execute(statement, (train_id,) * statement.count('%s'))
+        cursor.execute(RETURN_SEATS, (cancelled, train_id))
+        return cancelled
+
+    @checks_out_connections
+    def drain_refund_queue(self, handler: Callable[[List[dict]], None], batch_size: int = 100,
+                           max_batches: Optional[int] = None) -> int:
+        """
+        Pass the cancelled reservations waiting in the refund queue to handler (e.g. to notify the users and refund them),
+        batch_size at a time, oldest first. A batch is removed from the queue only if handler returns without errors;
+        rows locked by another worker are skipped, so several workers can drain the queue at the same time.
+        Stop when the queue is empty (or after max_batches batches) and return the number of handled reservations.
+        """
+        if batch_size < 1:
+            raise ValueError("The batch size must be positive")
 
-    def delete_train(self, train_key: TraitsKey) -> None:
+        def drain_batch(cursor):
+            cursor.execute("""
+                SELECT q.queue_id, q.ticket_id, q.train_id, q.queued_at, t.user_email, t.price
+                FROM RefundQueue q JOIN Tickets t ON t.ticket_id = q.ticket_id
+                ORDER BY q.queue_id
+                LIMIT %s
+                FOR UPDATE SKIP LOCKED
+            """, (batch_size,))
+            batch = cursor.fetchall()
+            if batch:
+                handler(batch)
+                cursor.execute(f"DELETE FROM RefundQueue WHERE queue_id IN ({', '.join(['%s'] * len(batch))})",
+                               tuple(row['queue_id'] for row in batch))
+            return len(batch)
+
+        handled, batches = 0, 0
+        while max_batches is None or batches < max_batches:
+            size = run_transaction(self.rdbms_admin_connection, drain_batch, dictionary=True)  # one transaction per batch
+            handled += size
+            batches += 1
+            if size < batch_size:
+                break
+        return handled
+
+    @checks_out_connections
+    def delete_train(self, train_key: TraitsKey, batch_size: int = 1000) -> None:
         """
         Drop the train from the system. Note that all its schedules, reservations, etc. must be also dropped.
         """
-        # Delete Train Schedules from Neo4j
-        delete_schedules_cypher = """
-               MATCH (t:Train {id: $train_id})-[r:SCHEDULE]->()
-               DELETE r
-               """
-        with self.neo4j_driver.session() as session:
-            session.run(delete_schedules_cypher, train_id=train_key.to_string())
+        train_id = train_key.to_int()
+        if batch_size < 1:  # checked before anything is deleted
+            raise ValueError("The batch size must be positive")
+
+        def delete_rows(cursor):
+            cursor.execute(LOCK_DELETED_TRAIN, (train_id,))
+            cursor.fetchall()
+            for statement in DELETE_TRAIN_STATEMENTS:
+                cursor.execute(statement, (train_id,) * statement.count('%s'))
+            cursor.execute(INSERT_OUTBOX, ('delete_train_schedules', json.dumps({'train_id': train_id})))
+            return cursor.lastrowid
+
+        outbox_id = run_transaction(self.rdbms_admin_connection, delete_rows)
+        self.replicas.pin(('train', train_id))
+        self._forget_train_states()  # seats were given back on the other trains of the deleted tickets
+        self._cache_train_state(train_id, None, None)
+        self._apply_outbox_entry(outbox_id, 'delete_train_schedules', {'train_id': train_id}, batch_size)
+
+    @checks_out_connections
+    def reconcile_outbox(self, batch_size: int = 1000) -> int:
+        """
+        Apply the Neo4j changes recorded in the outbox that were not applied yet (e.g. the process stopped between the
+        commit in MariaDB and the change in Neo4j), to be called on start up. Return the number of applied entries.
+        """
+        if batch_size < 1:
+            raise ValueError("The batch size must be positive")
+        with self.rdbms_admin_connection.cursor(dictionary=True) as cursor:
+            cursor.execute("SELECT outbox_id, operation, payload FROM Outbox ORDER BY outbox_id")
+            entries = cursor.fetchall()
+        self.rdbms_admin_connection.commit()
+
+        for entry in entries:
+            self._apply_outbox_entry(entry['outbox_id'], entry['operation'], json.loads(entry['payload']), batch_size)
+        return len(entries)
+
+    def _apply_outbox_entry(self, outbox_id: int, operation: str, payload: dict, batch_size: int) -> None:
+        """
+        Apply an outbox entry to Neo4j and remove it from the outbox (the changes are idempotent, applying an entry
+        twice does no harm)
+        """
+        if operation == 'delete_train_schedules':
+            self._delete_schedules(payload['train_id'], batch_size)
+        else:
+            raise ValueError(f"Unknown outbox operation: {operation}")
 
-        # Delete Train's Tickets from RDBMS
         with self.rdbms_admin_connection.cursor() as cursor:
-            delete_tickets_sql = "DELETE FROM Tickets WHERE train_id = %s"
-            cursor.execute(delete_tickets_sql, (train_key.to_int(),))
-            self.rdbms_admin_connection.commit()
+            cursor.execute("DELETE FROM Outbox WHERE outbox_id = %s", (outbox_id,))
+        self.rdbms_admin_connection.commit()
 
-            # Delete Train from RDBMS
-            delete_train_sql = "DELETE FROM Trains WHERE train_id = %s"
-            cursor.execute(delete_train_sql, (train_key.to_int(),))
-            self.rdbms_admin_connection.commit()
+    def _delete_schedules(self, train_id: int, batch_size: int) -> None:
+        """
+        Detach delete the schedules of the train and their stops, batch_size schedules per transaction
+        """
+        with self.neo4j_driver.session() as session:
+            while True:
+                deleted = session.execute_write(lambda tx: tx.run(DELETE_SCHEDULES_BATCH, train_id=train_id,
+                                                                  batch_size=batch_size).single()['deleted'])
+                if deleted < batch_size:
+                    break
+        self.station_graph.remove_train(train_id)  # keep the in-memory snapshot up to date
+        self._invalidate_search_cache()
 
     def add_train_station(self, train_station_key: TraitsKey, train_station_details) -> None:
         """
@@ -436,13 +1280,13 @@ class Traits(TraitsInterface):
         """
 
         with self.neo4j_driver.session() as session:
-            # check if a station with the given key already exists
-            result = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s", station_id=train_station_key.to_int())
-            if result.single() is not None:
+            # create the station only if no station with the given key exists (a single statement instead of check-then-create,
+            # made atomic by the uniqueness constraint of TraitsUtility.initialize_neo4j)
+            summary = session.run(CREATE_STATION, station_id=train_station_key.to_int(),
+                                  details=train_station_details).consume()
+            if summary.counters.nodes_created == 0:
                 raise ValueError("Station already exists")
-
-            # if the station does not exist, create a new station node
-            session.run("CREATE (s:Station {station_id: $station_id, details: $details})", station_id=train_station_key.to_int(), details=train_station_details)
+        self.station_graph.add_station(train_station_key.to_int(), train_station_details)  # keep the in-memory snapshot up to date
 
     def connect_train_stations(self, starting_train_station_key: TraitsKey, ending_train_station_key: TraitsKey,
                                travel_time_in_minutes: int) -> None:
@@ -451,6 +1295,21 @@ class Traits(TraitsInterface):
         Raise ValueError if any of the stations does not exist
         Raise ValueError for invalid travel_times
         """
+        start_id, end_id, travel_price = self._check_new_connection(starting_train_station_key, ending_train_station_key,
+                                                                    travel_time_in_minutes)
+
+        with self.neo4j_driver.session() as session:  # automatically closes the session
+            # if both stations exist, create a relationship between them with the given travel time
+            session.run(CREATE_CONNECTION, start_id=start_id, end_id=end_id, travel_time=travel_time_in_minutes,
+                        price=travel_price)
+        self.station_graph.add_connection(start_id, end_id, travel_time_in_minutes, travel_price)  # keep the snapshot up to date
+        self._invalidate_search_cache()
+
+    def _check_new_connection(self, starting_train_station_key: TraitsKey, ending_train_station_key: TraitsKey,
+                              travel_time_in_minutes: int) -> Tuple[int, int, float]:
+        """
+        Validate a new connection against the station graph snapshot, return the station ids and the price of the edge
+        """
         # requirements:
         if starting_train_station_key.to_string() == ending_train_station_key.to_string():
             raise ValueError("A station cannot be connected to itself")
@@ -458,33 +1317,19 @@ class Traits(TraitsInterface):
         if not 1 <= travel_time_in_minutes <= 60:  # travel time must be between 1 and 60 minutes
             raise ValueError("Invalid travel time")
 
-        # Calculate the travel price based on the travel time
-        travel_price = travel_time_in_minutes / 2
+        start_id, end_id = starting_train_station_key.to_int(), ending_train_station_key.to_int()
 
-        with self.neo4j_driver.session() as session:  # automatically closes the session
-            # check if the starting and ending stations exist
-            result_start = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s",
-                                        station_id=starting_train_station_key.to_int())
-            result_end = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s",
-                                        station_id=ending_train_station_key.to_int())
-            if result_start.single() is None or result_end.single() is None:
-                raise ValueError("One or both stations do not exist")
+        # check if the starting and ending stations exist (in the in-memory snapshot of the station graph)
+        self.validator.check(stations=[start_id, end_id])
 
-            # check if a connection already exists between the two stations
-            result = session.run("""
-                    MATCH (a:Station {station_id: $start_id})-[:CONNECTION]->(b:Station {station_id: $end_id})
-                    RETURN a, b
-                """, start_id=starting_train_station_key.to_int(), end_id=ending_train_station_key.to_int())
-            if result.single() is not None:
-                raise ValueError("The same two stations cannot be directly connected more than once")
+        # check if a connection already exists between the two stations
+        if self.station_graph.get_connection(start_id, end_id) is not None:
+            raise ValueError("The same two stations cannot be directly connected more than once")
 
-            # if both stations exist, create a relationship between them with the given travel time
-            session.run("""
-                MATCH (a:Station {station_id: $start_id}), (b:Station {station_id: $end_id})
-                CREATE (a)-[:CONNECTION {travel_time: $travel_time,  price: $price}]->(b)
-            """, start_id=starting_train_station_key.to_int(), end_id=ending_train_station_key.to_int(),
-                        travel_time=travel_time_in_minutes, price=travel_price)
+        # Calculate the travel price based on the travel time (the tariff of the fare engine)
+        return start_id, end_id, edge_price(travel_time_in_minutes)
 
+    @checks_out_connections
     def add_schedule(self, train_key: TraitsKey,
                      starting_hours_24_h: int, starting_minutes: int,
                      stops: List[Tuple[TraitsKey, int]],  # [station_key, waiting_time]
@@ -499,6 +1344,48 @@ class Traits(TraitsInterface):
         Validity dates must ensure that valid_from is in the past w.r.t. valid_until
         In case of error, raise ValueError
         """
+        self.add_schedules([dict(train_key=train_key, starting_hours_24_h=starting_hours_24_h,
+                                 starting_minutes=starting_minutes, stops=stops,
+                                 valid_from_day=valid_from_day, valid_from_month=valid_from_month,
+                                 valid_from_year=valid_from_year, valid_until_day=valid_until_day,
+                                 valid_until_month=valid_until_month, valid_until_year=valid_until_year)])
+
+    @checks_out_connections
+    def add_schedules(self, schedules: List[dict]) -> None:
+        """
+        Create many schedules at once, each one given as a dict with the parameters of add_schedule.
+        All the schedules are validated and stored in a single Neo4j transaction: if any of them is invalid,
+        a ValueError is raised and none is stored.
+        """
+        schedules = [self._prepare_schedule(**schedule) for schedule in schedules]
+        if not schedules:
+            return
+
+        # Check if the trains exist (one query for all the schedules)
+        self.validator.check(self.rdbms_admin_connection, trains=[schedule['train_id'] for schedule in schedules])
+
+        # Validate the stops and create the schedules, their stops and Has_Stops edges in one write transaction
+        with self.neo4j_driver.session() as session:
+            schedule_ids = session.execute_write(self._write_schedules, schedules)
+
+        self._add_schedules_to_snapshot(schedule_ids, schedules)
+
+    def _add_schedules_to_snapshot(self, schedule_ids: List[int], schedules: List[dict]) -> None:
+        # keep the in-memory snapshot up to date
+        for schedule_id, schedule in zip(schedule_ids, schedules):
+            self.station_graph.add_schedule({**schedule, 'schedule_id': schedule_id,
+                                             'stops': [[stop['station_id'], stop['waiting_time']] for stop in schedule['stops']]})
+        self._invalidate_search_cache()
+
+    @staticmethod
+    def _prepare_schedule(train_key: TraitsKey,
+                          starting_hours_24_h: int, starting_minutes: int,
+                          stops: List[Tuple[TraitsKey, int]],
+                          valid_from_day: int, valid_from_month: int, valid_from_year: int,
+                          valid_until_day: int, valid_until_month: int, valid_until_year: int) -> dict:
+        """
+        Validate the parameters of a schedule (see add_schedule) and return it in the form stored in Neo4j
+        """
 
         # simplify the input parameters
         valid_from = datetime(valid_from_year, valid_from_month, valid_from_day)
@@ -515,51 +1402,38 @@ class Traits(TraitsInterface):
         elif valid_from >= valid_until:
             raise ValueError("Validity dates must ensure that valid_from is in the past w.r.t. valid_until")
 
-        # Check if the train exists
-        with self.rdbms_admin_connection.cursor() as cursor:
-            cursor.execute("SELECT * FROM Trains WHERE train_id = %s", (train_key.to_int(),))
-            train = cursor.fetchone()
-            if train is None:
-                raise ValueError("Train does not exist")
+        return {'train_id': train_key.to_int(), 'starting_hours_24_h': starting_hours_24_h,
+                'starting_minutes': starting_minutes, 'valid_from': valid_from.isoformat(),
+                'valid_until': valid_until.isoformat(),
+                # Convert TraitsKey objects to integers
+                'stops': [{'station_id': stop[0].to_int(), 'waiting_time': stop[1]} for stop in stops]}
 
-        with self.neo4j_driver.session() as session:
-            # check if the stops correspond to existing stations and if consecutive stops are connected
-            for i in range(len(stops) - 1):  # check all stops except the last one (no connection needed)
-                result_start = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s",
-                                            station_id=stops[i][0].to_int())
-                result_end = session.run("MATCH (s:Station {station_id: $station_id}) RETURN s",
-                                            station_id=stops[i + 1][0].to_int())
-                if result_start.single() is None or result_end.single() is None:
-                    raise ValueError("One or both stations do not exist")
-
-                result_connection = session.run("""
-                    MATCH (a:Station {station_id: $start_id})-[:CONNECTION]->(b:Station {station_id: $end_id})
-                    RETURN a, b
-                """, start_id=stops[i][0].to_int(), end_id=stops[i + 1][0].to_int())
-                if result_connection.single() is None:
-                    raise ValueError("Consecutive stops must be connected stations")
-
-            # Convert TraitsKey objects to integers
-            stops = [(stop[0].to_int(), stop[1]) for stop in stops]
-
-            # create a new schedule for the train with the given parameters
-            result = session.run("""
-                CREATE (s:Schedule {train_id: $train_id,
-                starting_hours_24_h: $starting_hours_24_h,
-                starting_minutes: $starting_minutes,
-                valid_from: $valid_from,
-                valid_until: $valid_until})
-                RETURN id(s)
-            """, train_id=train_key.to_int(), starting_hours_24_h=starting_hours_24_h, starting_minutes=starting_minutes,
-                                 valid_from=valid_from.isoformat(), valid_until=valid_until.isoformat())
-
-            schedule_id = result.single()[0]  # get the ID of the newly created schedule
-
-            # create a new Stop node for each stop and connect it to the Schedule node
-            for i, stop in enumerate(stops):
-                session.run("""
-                    MATCH (s:Schedule) WHERE id(s) = $schedule_id
-                    CREATE (stop:Stop {station_id: $station_id, waiting_time: $waiting_time, order: $order})
-                    CREATE (s)-[:Has_Stops]->(stop)
-                """, schedule_id=schedule_id, station_id=stop[0], waiting_time=stop[1], order=i)
+    @staticmethod
+    def _write_schedules(tx, schedules: List[dict]) -> List[int]:
+        """
+        Transaction function of add_schedules (raising a ValueError rolls the whole transaction back), return the ids of
+        the created Schedule nodes in the order of schedules
+        """
+        # check if the stops correspond to existing stations and if consecutive stops are connected (all pairs at once)
+        pairs = Traits._schedule_pairs(schedules)
+        Traits._check_schedule_pairs(pairs, tx.run(CHECK_SCHEDULE_STOPS, pairs=pairs))
 
+        # create the schedules, a Stop node for each stop and the edges connecting them
+        return [record['schedule_id'] for record in tx.run(CREATE_SCHEDULES, schedules=schedules)]
+
+    @staticmethod
+    def _schedule_pairs(schedules: List[dict]) -> List[list]:
+        # the consecutive stops of the schedules, as [start station_id, end station_id]
+        return [[schedule['stops'][i]['station_id'], schedule['stops'][i + 1]['station_id']]
+                for schedule in schedules for i in range(len(schedule['stops']) - 1)]
+
+    @staticmethod
+    def _check_schedule_pairs(pairs: List[list], records) -> None:
+        # raise a ValueError for the first invalid pair (in the order of the stops) of the CHECK_SCHEDULE_STOPS records
+        checked = {tuple(record['pair']): record for record in records}
+        for pair in pairs:
+            record = checked[tuple(pair)]
+            if not record['start_exists'] or not record['end_exists']:
+                raise ValueError("One or both stations do not exist")
+            if not record['connected']:
+                raise ValueError("Consecutive stops must be connected stations")
@@ -0,0 +1,294 @@
+import csv
+import json
+import os
+import time
+from datetime import datetime
+from itertools import groupby
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+
+from traits.fares import edge_price
+from traits.graph import StationGraph
+
+# The importer reads a GTFS-like timetable made of four CSV files (with header):
+#   stations:   station_id, details
+#   edges:      start_station_id, end_station_id, travel_time
+#   trips:      trip_id, train_id, starting_hours_24_h, starting_minutes, valid_from, valid_until (YYYY-MM-DD)
+#               [, capacity, status]  (trains are created if capacity is given)
+#   stop_times: trip_id, stop_sequence, station_id, waiting_time  (grouped by trip_id, as in GTFS)
+# The files are streamed: memory is bounded by the number of stations, edges and trips, not by the stop times.
+
+PHASES = ['stations', 'edges', 'trips', 'stop_times']
+
+# imported schedules are looked up by trip_id (to skip the ones already imported): the constraint indexes them
+SCHEDULE_TRIP_ID_CONSTRAINT = "CREATE CONSTRAINT schedule_trip_id_unique IF NOT EXISTS FOR (s:Schedule) REQUIRE s.trip_id IS UNIQUE"
+
+
+class TimetableImporter:
+    """
+    Streaming importer of a timetable into Neo4j (stations, connections, schedules) and MariaDB (trains).
+    Rows are validated in Python and written in batches (UNWIND / executemany), one transaction per batch.
+    After every batch the position is saved in the (optional) checkpoint file, so an interrupted import can be resumed.
+    """
+
+    def __init__(self, rdbms_admin_connection, neo4j_driver, batch_size: int = 5000,
+                 checkpoint_path: Optional[str] = None, progress: Optional[Callable[[dict], None]] = None) -> None:
+        if batch_size < 1:
+            raise ValueError("The batch size must be positive")
+        self.rdbms_admin_connection = rdbms_admin_connection
+        self.neo4j_driver = neo4j_driver
+        self.batch_size = batch_size
+        self.checkpoint_path = checkpoint_path
+        self.progress = progress  # called with the statistics after every batch
+
+        self.station_graph = StationGraph.for_driver(neo4j_driver)
+        self.trips: Dict[str, dict] = {}
+        self.stats = {'rows': 0, 'stations': 0, 'edges': 0, 'trains': 0, 'schedules': 0, 'stops': 0,
+                      'batches': 0, 'seconds': 0.0, 'rows_per_second': 0.0}
+        self._started = None
+
+    def run(self, stations_path: str, edges_path: str, trips_path: str, stop_times_path: str) -> dict:
+        """
+        Import the four files (resuming from the checkpoint if there is one) and return the statistics
+        """
+        paths = {'stations': stations_path, 'edges': edges_path, 'trips': trips_path, 'stop_times': stop_times_path}
+        checkpoint = self._read_checkpoint()
+        first_phase = PHASES.index(checkpoint['phase'])
+        self._started = time.monotonic()
+        with self.neo4j_driver.session() as session:  # without it, every schedule of a batch scans all the schedules
+            session.run(SCHEDULE_TRIP_ID_CONSTRAINT).consume()
+            session.run("CALL db.awaitIndexes($timeout)", timeout=300).consume()
+        self.station_graph.ensure_loaded()  # rows are validated against the snapshot (patched with the imported rows)
+
+        try:
+            for index, phase in enumerate(PHASES):
+                skip = checkpoint['rows'] if index == first_phase else 0
+
+                if phase == 'trips':
+                    # the trips are always read (the stop times need them), the trains only written if not done yet
+                    self._import_trips(paths[phase], skip, write_trains=index >= first_phase)
+                elif index < first_phase:
+                    continue  # already imported
+                elif phase == 'stations':
+                    self._import_batches(phase, self._stations(paths[phase], skip), self._write_stations, skip)
+                elif phase == 'edges':
+                    self._import_batches(phase, self._edges(paths[phase], skip), self._write_edges, skip)
+                else:
+                    self._import_batches(phase, self._schedules(paths[phase], skip), self._write_schedules, skip)
+            self._save_checkpoint('done', 0)
+        finally:
+            self.station_graph.invalidate()  # reloaded from Neo4j on the next access (also drops edges of a failed batch)
+        return self.stats
+
+    ########################################################################
+    # Reading and validating
+    ########################################################################
+
+    @staticmethod
+    def _read(path: str, skip: int) -> Iterator[Tuple[int, dict]]:
+        # yields (line number, row), skipping the rows already imported
+        with open(path, newline='') as file:
+            for number, row in enumerate(csv.DictReader(file)):
+                if number >= skip:
+                    yield number + 2, row  # +1 for the header, +1 because lines start at 1
+
+    @staticmethod
+    def _error(path: str, line: int, message: str) -> ValueError:
+        return ValueError(f"{os.path.basename(path)}, line {line}: {message}")
+
+    def _stations(self, path: str, skip: int) -> Iterator[Tuple[int, dict]]:
+        for line, row in self._read(path, skip):
+            try:
+                station = {'station_id': int(row['station_id']), 'details': row.get('details') or None}
+            except (KeyError, TypeError, ValueError):
+                raise self._error(path, line, "invalid station_id")
+            yield 1, station
+
+    def _edges(self, path: str, skip: int) -> Iterator[Tuple[int, dict]]:
+        rows = 0  # rows read since the last edge yielded (counted by the checkpoint)
+        for line, row in self._read(path, skip):
+            rows += 1
+            try:
+                start_id, end_id = int(row['start_station_id']), int(row['end_station_id'])
+                travel_time = int(row['travel_time'])
+            except (KeyError, TypeError, ValueError):
+                raise self._error(path, line, "invalid edge")
+
+            # same rules as Traits.connect_train_stations
+            if start_id == end_id:
+                raise self._error(path, line, "A station cannot be connected to itself")
+            if not 1 <= travel_time <= 60:
+                raise self._error(path, line, "Invalid travel time")
+            if not self.station_graph.has_station(start_id) or not self.station_graph.has_station(end_id):
+                raise self._error(path, line, "One or both stations do not exist")
+            edge = {'start_id': start_id, 'end_id': end_id, 'travel_time': travel_time,
+                    'price': edge_price(travel_time)}  # the tariff of the fare engine, like Traits.connect_train_stations
+            existing = self.station_graph.get_connection(start_id, end_id)
+            if existing == (edge['travel_time'], edge['price']):
+                continue  # already imported (e.g. the batch was written but the checkpoint was not saved)
+            if existing is not None:
+                raise self._error(path, line, "The same two stations cannot be directly connected more than once")
+
+            self.station_graph.add_connection(start_id, end_id, travel_time, edge['price'])  # later rows are validated against it
+            yield rows, edge
+            rows = 0
+
+    def _import_trips(self, path: str, skip: int, write_trains: bool = True) -> None:
+        # the trips are kept in memory (they are needed to build the schedules), the trains are written in batches
+        trains = {}
+        for line, row in self._read(path, 0):
+            try:
+                valid_from = datetime.strptime(row['valid_from'], '%Y-%m-%d')
+                valid_until = datetime.strptime(row['valid_until'], '%Y-%m-%d')
+                trip = {'trip_id': row['trip_id'], 'train_id': int(row['train_id']),
+                        'starting_hours_24_h': int(row['starting_hours_24_h']),
+                        'starting_minutes': int(row['starting_minutes']),
+                        'valid_from': valid_from.isoformat(), 'valid_until': valid_until.isoformat()}
+                if row.get('capacity'):
+                    trains[trip['train_id']] = (trip['train_id'], int(row['capacity']), int(row.get('status') or 0))
+            except (KeyError, TypeError, ValueError):
+                raise self._error(path, line, "invalid trip")
+
+            if valid_from >= valid_until:
+                raise self._error(path, line, "Validity dates must ensure that valid_from is in the past w.r.t. valid_until")
+            if not (0 <= trip['starting_hours_24_h'] < 24 and 0 <= trip['starting_minutes'] < 60):
+                raise self._error(path, line, "invalid starting time")
+            self.trips[trip['trip_id']] = trip
+
+        if write_trains:
+            rows = sorted(trains.values())
+            self._import_batches('trips', ((1, train) for train in rows[skip:]), self._write_trains, skip)
+
+        # every train used by a trip must exist
+        train_ids = sorted({trip['train_id'] for trip in self.trips.values()})
+        with self.rdbms_admin_connection.cursor() as cursor:
+            for i in range(0, len(train_ids), self.batch_size):
+                chunk = train_ids[i:i + self.batch_size]
+                cursor.execute(f"SELECT train_id FROM Trains WHERE train_id IN ({', '.join(['%s'] * len(chunk))})", tuple(chunk))
+                missing = set(chunk) - {train_id for (train_id,) in cursor.fetchall()}
+                if missing:
+                    raise ValueError(f"{os.path.basename(path)}: Train does not exist ({min(missing)})")
+
+    def _schedules(self, path: str, skip: int) -> Iterator[Tuple[int, dict]]:
+        # one schedule per group of consecutive stop times with the same trip_id
+        rows = self._read(path, skip)
+        for trip_id, group in groupby(rows, key=lambda item: item[1].get('trip_id')):
+            group = list(group)
+            line = group[0][0]
+            trip = self.trips.get(trip_id)
+            if trip is None:
+                raise self._error(path, line, f"unknown trip {trip_id}")
+            try:
+                stops = sorted((int(row['stop_sequence']), int(row['station_id']), int(row.get('waiting_time') or 0))
+                               for _, row in group)
+            except (KeyError, TypeError, ValueError):
+                raise self._error(path, line, "invalid stop time")
+
+            # same rules as Traits.add_schedule
+            if len(stops) < 2:
+                raise self._error(path, line, "The schedule must have at least two stops")
+            for (_, start_id, _), (_, end_id, _) in zip(stops, stops[1:]):
+                if not self.station_graph.has_station(start_id) or not self.station_graph.has_station(end_id):
+                    raise self._error(path, line, "One or both stations do not exist")
+                if self.station_graph.get_connection(start_id, end_id) is None:
+                    raise self._error(path, line, "Consecutive stops must be connected stations")
+
+            schedule = dict(trip, stops=[{'station_id': station_id, 'waiting_time': waiting_time}
+                                         for _, station_id, waiting_time in stops])
+            yield len(group), schedule  # the checkpoint counts the stop time rows
+
+    ########################################################################
+    # Writing
+    ########################################################################
+
+    def _import_batches(self, phase: str, items: Iterator[Tuple[int, dict]], write, rows_done: int) -> None:
+        batch, batch_rows = [], 0
+        for rows, item in items:
+            batch.append(item)
+            batch_rows += rows
+            if len(batch) >= self.batch_size:
+                write(batch)
+                rows_done += batch_rows
+                self._batch_done(phase, rows_done, batch_rows)
+                batch, batch_rows = [], 0
+        if batch:
+            write(batch)
+            rows_done += batch_rows
+            self._batch_done(phase, rows_done, batch_rows)
+
+    def _write_stations(self, stations: List[dict]) -> None:
+        with self.neo4j_driver.session() as session:
+            summary = session.execute_write(lambda tx: tx.run("""
+                UNWIND $stations AS station
+                MERGE (s:Station {station_id: station.station_id}) ON CREATE SET s.details = station.details
+            """, stations=stations).consume())
+        for station in stations:
+            self.station_graph.add_station(station['station_id'], station['details'])
+        self.stats['stations'] += summary.counters.nodes_created
+
+    def _write_edges(self, edges: List[dict]) -> None:
+        with self.neo4j_driver.session() as session:
+            summary = session.execute_write(lambda tx: tx.run("""
+                UNWIND $edges AS edge
+                MATCH (a:Station {station_id: edge.start_id}), (b:Station {station_id: edge.end_id})
+                MERGE (a)-[c:CONNECTION]->(b) ON CREATE SET c.travel_time = edge.travel_time, c.price = edge.price
+            """, edges=edges).consume())
+        self.stats['edges'] += summary.counters.relationships_created
+
+    def _write_trains(self, trains: List[tuple]) -> None:
+        with self.rdbms_admin_connection.cursor() as cursor:
+            # existing trains are kept as they are (INSERT IGNORE), so a resumed import does not fail
+            cursor.executemany("INSERT IGNORE INTO Trains (train_id, capacity, status) VALUES (%s, %s, %s)", trains)
+            self.stats['trains'] += cursor.rowcount
+        self.rdbms_admin_connection.commit()
+
+    def _write_schedules(self, schedules: List[dict]) -> None:
+        with self.neo4j_driver.session() as session:
+            summary = session.execute_write(lambda tx: tx.run("""
+                UNWIND $schedules AS schedule
+                OPTIONAL MATCH (existing:Schedule {trip_id: schedule.trip_id})  // index of schedule_trip_id_unique
+                WITH schedule, existing WHERE existing IS NULL
+                CREATE (s:Schedule {trip_id: schedule.trip_id,
+                    train_id: schedule.train_id,
+                    starting_hours_24_h: schedule.starting_hours_24_h,
+                    starting_minutes: schedule.starting_minutes,
+                    valid_from: schedule.valid_from,
+                    valid_until: schedule.valid_until})
+                WITH s, schedule
+                UNWIND range(0, size(schedule.stops) - 1) AS i
+                CREATE (stop:Stop {station_id: schedule.stops[i].station_id, waiting_time: schedule.stops[i].waiting_time, order: i})
+                CREATE (s)-[:Has_Stops]->(stop)
+            """, schedules=schedules).consume())  # schedules already imported (same trip_id) are skipped
+        counters = summary.counters
+        self.stats['schedules'] += counters.nodes_created - counters.relationships_created  # one Has_Stops edge per Stop
+        self.stats['stops'] += counters.relationships_created
+
+    ########################################################################
+    # Progress and checkpoint
+    ########################################################################
+
+    def _batch_done(self, phase: str, rows_done: int, batch_rows: int) -> None:
+        self._save_checkpoint(phase, rows_done)
+        self.stats['rows'] += batch_rows
+        self.stats['batches'] += 1
+        self.stats['seconds'] = time.monotonic() - self._started
+        if self.stats['seconds'] > 0:
+            self.stats['rows_per_second'] = self.stats['rows'] / self.stats['seconds']
+        if self.progress is not None:
+            self.progress(dict(self.stats, phase=phase))
+
+    def _read_checkpoint(self) -> dict:
+        if self.checkpoint_path and os.path.exists(self.checkpoint_path):
+            with open(self.checkpoint_path) as file:
+                checkpoint = json.load(file)
+            if checkpoint['phase'] != 'done':
+                return checkpoint
+        return {'phase': PHASES[0], 'rows': 0}
+
+    def _save_checkpoint(self, phase: str, rows: int) -> None:
+        if not self.checkpoint_path:
+            return
+        # write to a temporary file first, so the checkpoint is never half written
+        temporary_path = self.checkpoint_path + '.tmp'
+        with open(temporary_path, 'w') as file:
+            json.dump({'phase': phase, 'rows': rows}, file)
+        os.replace(temporary_path, self.checkpoint_path)
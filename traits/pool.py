@@ -0,0 +1,220 @@
+import functools
+import time
+from contextlib import contextmanager
+from queue import Empty, LifoQueue
+from threading import RLock, local
+from typing import Callable, Dict
+
+
+class ConnectionPool:
+    """
+    Thread-safe pool of MariaDB connections created on demand with connect() (e.g. a functools.partial of
+    mysql.connector.connect), at most size of them at the same time.
+    Checked out connections are health checked (and reconnected or replaced if dead) and optionally reset, returned
+    connections are rolled back, so no transaction or session state leaks from one user of a connection to the next.
+    """
+
+    def __init__(self, connect: Callable, size: int = 5, timeout: float = 30.0, health_check: bool = True,
+                 reset: bool = True, clock: Callable[[], float] = time.monotonic) -> None:
+        if size < 1:
+            raise ValueError("The pool must hold at least one connection")
+        if timeout <= 0:
+            raise ValueError("The checkout timeout must be positive")
+
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.health_check = health_check
+        self.reset = reset
+        self.clock = clock
+        self._idle = LifoQueue()  # most recently used first (its session is the most likely to be alive)
+        self._lock = RLock()
+        self._created = 0  # connections currently owned by the pool (idle or checked out)
+        self.reset_listeners = []  # called with the connection after its session was reset
+
+        # counters
+        self.checkouts = 0
+        self.waits = 0  # checkouts that had to wait for a connection to be returned
+        self.wait_time = 0.0  # total seconds spent waiting
+        self.max_wait_time = 0.0
+        self.timeouts = 0
+        self.replaced = 0  # dead connections that were closed and replaced
+        self.in_use = 0
+        self.peak_in_use = 0
+
+    def acquire(self):
+        """
+        Check out a connection, wait up to timeout seconds (then raise a TimeoutError) if all of them are in use
+        """
+        started = self.clock()
+        connection = self._take(started)
+        waited = self.clock() - started
+        with self._lock:
+            self.checkouts += 1
+            self.wait_time += waited
+            self.max_wait_time = max(self.max_wait_time, waited)
+            self.in_use += 1
+            self.peak_in_use = max(self.peak_in_use, self.in_use)
+
+        try:
+            if self.health_check:
+                connection = self._healthy(connection)
+            if self.reset:
+                connection.reset_session()
+                for listener in self.reset_listeners:
+                    listener(connection)
+        except Exception:
+            self._discard(connection)
+            raise
+        return connection
+
+    def release(self, connection) -> None:
+        """
+        Return a connection to the pool (rolling back what was not committed)
+        """
+        try:
+            if connection.in_transaction:
+                connection.rollback()
+        except Exception:  # the connection is broken, a new one will be created when needed
+            self._discard(connection)
+            return
+        with self._lock:
+            self.in_use -= 1
+        self._idle.put(connection)
+
+    @contextmanager
+    def connection(self):
+        connection = self.acquire()
+        try:
+            yield connection
+        finally:
+            self.release(connection)
+
+    def close(self) -> None:
+        """
+        Close the idle connections (checked out connections are closed when they are returned)
+        """
+        while True:
+            try:
+                connection = self._idle.get_nowait()
+            except Empty:
+                return
+            with self._lock:
+                self._created -= 1
+            connection.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'size': self.size, 'created': self._created, 'in_use': self.in_use, 'peak_in_use': self.peak_in_use,
+                    'utilisation': self.in_use / self.size, 'checkouts': self.checkouts, 'waits': self.waits,
+                    'wait_time': self.wait_time, 'max_wait_time': self.max_wait_time,
+                    'average_wait_time': self.wait_time / self.checkouts if self.checkouts else 0.0,
+                    'timeouts': self.timeouts, 'replaced': self.replaced}
+
+    def _take(self, started: float):
+        try:
+            return self._idle.get_nowait()
+        except Empty:
+            pass
+
+        with self._lock:
+            if self._created < self.size:  # room for a new connection
+                self._created += 1
+                create = True
+            else:
+                self.waits += 1
+                create = False
+        if create:
+            try:
+                return self.connect()
+            except Exception:
+                with self._lock:
+                    self._created -= 1
+                raise
+
+        try:
+            return self._idle.get(timeout=max(0.0, self.timeout - (self.clock() - started)))
+        except Empty:
+            with self._lock:
+                self.timeouts += 1
+            raise TimeoutError(f"No connection available within {self.timeout} seconds") from None
+
+    def _healthy(self, connection):
+        try:
+            connection.ping(reconnect=True, attempts=1, delay=0)
+            return connection
+        except Exception:
+            pass
+
+        # the connection could not be reconnected: replace it with a new one
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self.replaced += 1
+        return self.connect()
+
+    def _discard(self, connection) -> None:
+        try:
+            connection.close()
+        except Exception:
+            pass
+        with self._lock:
+            self._created -= 1
+            self.in_use -= 1
+
+
+class PooledConnections:
+    """
+    The MariaDB connections of a Traits instance: for each role ('user', 'admin') either a single connection (used
+    as it is) or a ConnectionPool.
+    Pooled connections are checked out lazily on the first use within a call (see checks_out_connections) and returned
+    when the outermost call of the thread ends, so every thread works on its own connection.
+    """
+
+    def __init__(self, **connections) -> None:
+        self.connections = connections
+        self._calls = local()
+
+    def get(self, role: str):
+        connection = self.connections[role]
+        if not isinstance(connection, ConnectionPool):
+            return connection
+
+        checked_out = self._checked_out()
+        if checked_out is None:
+            raise RuntimeError("Pooled connections can only be used within the methods of Traits")
+        if role not in checked_out:
+            checked_out[role] = connection.acquire()
+        return checked_out[role]
+
+    def pools(self) -> Dict[str, ConnectionPool]:
+        return {role: c for role, c in self.connections.items() if isinstance(c, ConnectionPool)}
+
+    @contextmanager
+    def call(self):
+        outermost = self._checked_out() is None
+        if outermost:
+            self._calls.checked_out = {}
+        try:
+            yield
+        finally:
+            if outermost:
+                checked_out, self._calls.checked_out = self._calls.checked_out, None
+                for role, connection in checked_out.items():
+                    self.connections[role].release(connection)
+
+    def _checked_out(self):
+        return getattr(self._calls, 'checked_out', None)
+
+
+def checks_out_connections(method):
+    """
+    Decorator for the methods of Traits using MariaDB: pooled connections used by the method are returned at its end
+    """
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.connections.call():
+            return method(self, *args, **kwargs)
+    return wrapper
@@ -0,0 +1,206 @@
+from bisect import bisect_left
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from traits.routing import Connection
+
+# Round-based multi-criteria routing (McRAPTOR) over the timetable.
+# The trips (the connections of a schedule, see build_connections) are grouped into routes: trips stopping at the same
+# stations in the same order that never overtake each other (the waiting times differ by schedule, so a later trip can
+# arrive first: it then goes to another route of the same stations). Round k scans once every route serving a station improved in round k - 1, so it finds the
+# journeys riding k trains and its work is bounded by the number of routes, not by the number of paths.
+
+
+class Label(NamedTuple):
+    arrival: int  # minutes after midnight
+    price: float
+    ride: Optional[tuple]  # (previous label, route, trip, boarding stop, alighting stop), None at the source
+
+
+class Route:
+    """
+    Trips stopping at the same stations in the same order, none overtaking another: the trip leaving a stop first is
+    the first at every later stop
+    """
+
+    def __init__(self, stations: Tuple[int, ...]) -> None:
+        self.stations = stations
+        self.trips: List[List[Connection]] = []  # the connections of each trip, in stop order
+        self.fares: List[List[float]] = []  # per trip, the price from its first stop to each stop
+        self.departures: List[List[Tuple[int, int]]] = []  # per stop, (departure, trip) sorted by departure
+        self._keys: List[List[int]] = []
+
+    def follows(self, connections: List[Connection]) -> bool:
+        # if the trip leaves and arrives at every stop not before the last added trip (the trips are added by departure)
+        last = self.trips[-1]
+        return all(c.departure_time >= other.departure_time and c.arrival_time >= other.arrival_time
+                   for c, other in zip(connections, last))
+
+    def add_trip(self, connections: List[Connection]) -> None:
+        fares = [0.0]
+        for c in connections:
+            fares.append(fares[-1] + round(c.price, 2))  # every edge is priced to the cent, like by the fare engine
+        self.trips.append(connections)
+        self.fares.append(fares)
+
+    def index(self) -> None:
+        self.departures = [sorted((trip[stop].departure_time, number) for number, trip in enumerate(self.trips))
+                           for stop in range(len(self.stations) - 1)]
+        self._keys = [[departure for departure, _ in departures] for departures in self.departures]
+
+    def earliest_trip(self, stop: int, time: int) -> Optional[int]:
+        # the first trip leaving the stop at/after time
+        position = bisect_left(self._keys[stop], time)
+        return self.departures[stop][position][1] if position < len(self.departures[stop]) else None
+
+
+def build_routes(connections: Iterable[Connection]) -> Tuple[List[Route], Dict[int, List[Tuple[Route, int]]]]:
+    """
+    Group the connections into routes, return (routes, station -> [(route, stop index)])
+    """
+    trips: Dict[int, List[Connection]] = {}
+    for c in connections:
+        trips.setdefault(c.trip, []).append(c)
+
+    for trip in trips.values():
+        trip.sort(key=lambda c: c.stop_index)
+
+    # the trips of the same stations are split into FIFO routes: a trip joins the first route it does not overtake
+    by_stations: Dict[Tuple[int, ...], List[Route]] = {}
+    for trip in sorted(trips.values(), key=lambda trip: (trip[0].departure_time, trip[-1].arrival_time)):
+        stations = tuple(c.departure_station for c in trip) + (trip[-1].arrival_station,)
+        same_stations = by_stations.setdefault(stations, [])
+        route = next((route for route in same_stations if route.follows(trip)), None)
+        if route is None:
+            route = Route(stations)
+            same_stations.append(route)
+        route.add_trip(trip)
+    routes = [route for same_stations in by_stations.values() for route in same_stations]
+
+    serving: Dict[int, List[Tuple[Route, int]]] = {}
+    for route in routes:
+        route.index()
+        for stop, station in enumerate(route.stations[:-1]):  # a route cannot be boarded at its last stop
+            serving.setdefault(station, []).append((route, stop))
+    return routes, serving
+
+
+def _contains(bag: List[Label], label: Label) -> bool:
+    return any(other is label for other in bag)
+
+
+def _dominated(label: Label, bag: List[Label]) -> bool:
+    return any(other.arrival <= label.arrival and other.price <= label.price for other in bag)
+
+
+def _merge(label: Label, bag: List[Label]) -> bool:
+    """
+    Add the label to the Pareto set (arrival, price) unless it is dominated, return if it was added
+    """
+    if _dominated(label, bag):
+        return False
+    bag[:] = [other for other in bag if not (label.arrival <= other.arrival and label.price <= other.price)]
+    bag.append(label)
+    return True
+
+
+class Raptor:
+    """
+    McRAPTOR search returning the Pareto front of the journeys by arrival time, number of changes and price: no journey
+    of the front arrives earlier, changes less and costs less than another one at the same time.
+    """
+
+    def __init__(self, connections: List[Connection]) -> None:
+        self.routes, self.serving = build_routes(connections)
+
+    def search(self, source: int, target: int, departure_after: Optional[int] = None,
+               arrival_before: Optional[int] = None, max_changes: int = 5) -> List[dict]:
+        """
+        Return the Pareto-optimal journeys from source (leaving at/after departure_after) to target, by arrival time
+        """
+        start = Label(departure_after or 0, 0.0, None)
+        previous: Dict[int, List[Label]] = {source: [start]}  # the labels of the last round
+        best: Dict[int, List[Label]] = {source: [start]}  # the labels of all rounds (fewer changes first)
+        front: List[Tuple[int, Label]] = []  # (trains ridden, label) of the journeys reaching the target
+
+        for rounds in range(1, max_changes + 2):  # round k rides k trains
+            # the routes serving an improved station, from the first improved stop
+            queue: Dict[Route, int] = {}
+            for station in previous:
+                for route, stop in self.serving.get(station, []):
+                    queue[route] = min(stop, queue.get(route, stop))
+
+            improved: Dict[int, List[Label]] = {}
+            for route, first_stop in queue.items():
+                riding: Dict[int, Tuple[Label, int]] = {}  # trip -> (cheapest label boarding it, boarding stop)
+                for stop in range(first_stop, len(route.stations)):
+                    station = route.stations[stop]
+
+                    # 1. get off here: the arrival and price of every boarded trip
+                    for trip, (label, boarded) in riding.items():
+                        price = label.price + route.fares[trip][stop] - route.fares[trip][boarded]
+                        arrival = route.trips[trip][stop - 1].arrival_time
+                        candidate = Label(arrival, price, (label, route, trip, boarded, stop))
+                        if station == target:
+                            if _merge(candidate, best.setdefault(target, [])):
+                                front.append((rounds, candidate))
+                        # not worth going on if the target was already reached earlier and cheaper
+                        elif not _dominated(candidate, best.get(target, [])) and _merge(candidate, best.setdefault(station, [])):
+                            improved.setdefault(station, []).append(candidate)
+
+                    # 2. get on here: the labels of the last round board the first trip leaving after their arrival
+                    # (the trips of a route ride the same edges, so a later trip is never cheaper)
+                    if stop < len(route.stations) - 1 and station != target:
+                        for label in previous.get(station, []):
+                            trip = route.earliest_trip(stop, label.arrival)
+                            if trip is None:
+                                continue
+                            current = riding.get(trip)
+                            # on the same trip, the cheapest boarding wins (it reaches the same stops at the same times)
+                            if current is None or label.price - route.fares[trip][stop] < \
+                                    current[0].price - route.fares[trip][current[1]]:
+                                riding[trip] = (label, stop)
+
+            # labels dominated later in the round (by the same number of changes) are not improvements anymore
+            previous = {station: [label for label in labels if _contains(best[station], label)]
+                        for station, labels in improved.items()}
+            previous = {station: labels for station, labels in previous.items() if labels}
+            if not previous:
+                break
+
+        # keep the journeys not dominated by arrival, changes and price (fewer changes first, so dominating ones come first)
+        front.sort(key=lambda entry: (entry[0], entry[1].arrival, entry[1].price))
+        pareto: List[Tuple[int, Label]] = []
+        for rides, label in front:
+            if not any(other_rides <= rides and other.arrival <= label.arrival and other.price <= label.price
+                       for other_rides, other in pareto):
+                pareto.append((rides, label))
+
+        journeys = []
+        for rides, label in pareto:
+            journey = self._journey(label, source, target, rides - 1)
+            if arrival_before is None or journey['arrival_time'] <= arrival_before:
+                journeys.append(journey)
+        journeys.sort(key=lambda j: (j['arrival_time'], j['changes'], j['estimated_price']))
+        return journeys
+
+    def _journey(self, label: Label, source: int, target: int, changes: int) -> dict:
+        rides = []  # the connections ridden on each train
+        while label.ride is not None:
+            label, route, trip, boarded, alighted = label.ride
+            rides.append(route.trips[trip][boarded:alighted])
+        rides.reverse()
+
+        legs = [c for ride in rides for c in ride]
+        return {
+            'start_key': source,
+            'end_key': target,
+            'departure_time': legs[0].departure_time,
+            'arrival_time': legs[-1].arrival_time,
+            'estimated_price': round(sum(round(c.price, 2) for c in legs), 2),
+            'travel_time': legs[-1].arrival_time - legs[0].departure_time,
+            'changes': changes,
+            'waiting_time': sum(rides[i][0].departure_time - rides[i - 1][-1].arrival_time for i in range(1, len(rides))),
+            # the ridden edges, in the format of the connections of buy_ticket
+            'legs': [{'train_id': c.train_id, 'starting_station_key': c.departure_station,
+                      'ending_station_key': c.arrival_station, 'travel_time': c.travel_time} for c in legs],
+        }
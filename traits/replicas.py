@@ -0,0 +1,117 @@
+import time
+from contextlib import contextmanager
+from itertools import count
+from threading import RLock
+from typing import Callable, Hashable, Sequence
+
+from traits.pool import ConnectionPool
+
+
+class ReplicaRouter:
+    """
+    Routes the reads of Traits to MariaDB read replicas (plain connections or ConnectionPools), round robin.
+    A read goes to the primary instead (connection() yields None) when:
+    - its key (e.g. a user email) was pinned by a write in the last pin_seconds, so users read their own writes;
+    - every replica lags more than max_lag seconds behind the primary (or its replication is stopped).
+    The lag of a replica is read from SHOW SLAVE STATUS (the replica user needs the SLAVE MONITOR privilege), at most
+    once every lag_check_interval seconds.
+    """
+
+    def __init__(self, replicas: Sequence = (), max_lag: float = 5.0, pin_seconds: float = 5.0,
+                 lag_check_interval: float = 1.0, clock: Callable[[], float] = time.monotonic) -> None:
+        if max_lag < 0 or pin_seconds < 0 or lag_check_interval < 0:
+            raise ValueError("Lag, pinning and check intervals cannot be negative")
+
+        self.replicas = list(replicas)
+        self.max_lag = max_lag
+        self.pin_seconds = pin_seconds
+        self.lag_check_interval = lag_check_interval
+        self.clock = clock
+        self._pins = {}  # key -> time until which its reads go to the primary
+        self._lags = {}  # replica index -> (checked_at, lag in seconds or None if unknown or replication is stopped)
+        self._next = count()
+        self._lock = RLock()
+
+        # counters
+        self.replica_reads = 0
+        self.pinned_reads = 0  # reads sent to the primary because of a recent write
+        self.lagging_reads = 0  # reads sent to the primary because all the replicas were lagging
+
+    def pin(self, *keys: Hashable) -> None:
+        """
+        Send the reads of the given keys to the primary for the next pin_seconds (call it after writing them)
+        """
+        if not self.replicas:
+            return
+        with self._lock:
+            now = self.clock()
+            if len(self._pins) > 10000:  # drop the expired pins from time to time
+                self._pins = {key: until for key, until in self._pins.items() if until > now}
+            for key in keys:
+                self._pins[key] = now + self.pin_seconds
+
+    def is_pinned(self, key: Hashable) -> bool:
+        with self._lock:
+            return self._pins.get(key, 0) > self.clock()
+
+    @contextmanager
+    def connection(self, *keys: Hashable):
+        """
+        Yield a replica connection for a read of the given keys, None if the read must go to the primary.
+        The read transaction is ended when the context exits (so the next read sees the replicated changes).
+        """
+        if not self.replicas:
+            yield None
+            return
+        if any(self.is_pinned(key) for key in keys):
+            self._count('pinned_reads')
+            yield None
+            return
+
+        start = next(self._next)
+        for offset in range(len(self.replicas)):
+            index = (start + offset) % len(self.replicas)
+            replica = self.replicas[index]
+            pool = replica if isinstance(replica, ConnectionPool) else None
+            connection = pool.acquire() if pool is not None else replica
+            try:
+                if not self._fresh(index, connection):
+                    continue
+                self._count('replica_reads')
+                yield connection
+                return
+            finally:
+                if pool is not None:
+                    pool.release(connection)
+                else:
+                    connection.rollback()
+
+        self._count('lagging_reads')
+        yield None
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {'replicas': len(self.replicas), 'replica_reads': self.replica_reads,
+                    'pinned_reads': self.pinned_reads, 'lagging_reads': self.lagging_reads,
+                    'lags': {index: lag for index, (_, lag) in self._lags.items()}}
+
+    def _fresh(self, index: int, connection) -> bool:
+        with self._lock:
+            checked = self._lags.get(index)
+        if checked is None or self.clock() - checked[0] >= self.lag_check_interval:
+            try:
+                with connection.cursor(dictionary=True) as cursor:
+                    cursor.execute("SHOW SLAVE STATUS")
+                    status = cursor.fetchall()
+                # not configured as a replica: nothing to lag behind
+                lag = status[0]['Seconds_Behind_Master'] if status else 0
+            except Exception:  # e.g. the user lacks the SLAVE MONITOR privilege: the lag is unknown, use the primary
+                lag = None
+            checked = (self.clock(), lag)
+            with self._lock:
+                self._lags[index] = checked
+        return checked[1] is not None and checked[1] <= self.max_lag
+
+    def _count(self, counter: str) -> None:
+        with self._lock:
+            setattr(self, counter, getattr(self, counter) + 1)
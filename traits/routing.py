@@ -0,0 +1,207 @@
+import heapq
+from array import array
+from bisect import bisect_right
+from typing import Dict, Iterable, List, NamedTuple, Optional, Tuple
+
+from public.traits.interface import SortingCriteria
+
+# Connection Scan routing over the timetable.
+# Every schedule (Schedule node + its ordered Stop nodes) is unrolled into "connections": one departure event per pair of
+# consecutive stops. All times are minutes after midnight of the travel day.
+
+INFINITY = float("inf")
+
+
+class Connection(NamedTuple):
+    departure_station: int
+    arrival_station: int
+    departure_time: int
+    arrival_time: int
+    trip: int  # index of the schedule the connection belongs to
+    stop_index: int  # position of the departure stop inside the schedule
+    train_id: int
+    travel_time: int
+    price: float
+
+
+def build_connections(schedules: Iterable[dict], adjacency: Dict[int, Dict[int, Tuple[int, float]]]) -> List[Connection]:
+    """
+    Unroll the given schedules into connections sorted by departure time.
+    schedules: dicts with train_id, starting_hours_24_h, starting_minutes and stops (list of [station_id, waiting_time])
+    adjacency: adjacency[start_id][end_id] = (travel_time, price) of the CONNECTION edge
+    """
+    connections = []
+    for trip, schedule in enumerate(schedules):
+        stops = schedule['stops']
+        time = schedule['starting_hours_24_h'] * 60 + schedule['starting_minutes']  # arrival at the first stop
+        for i in range(len(stops) - 1):
+            station_id, waiting_time = stops[i]
+            next_station_id = stops[i + 1][0]
+            edge = adjacency.get(station_id, {}).get(next_station_id)
+            if edge is None:  # the schedule uses an edge that does not exist (anymore), so it cannot be ridden further
+                break
+            travel_time, price = edge
+            departure_time = time + (waiting_time or 0)  # the train waits at the stop before leaving
+            time = departure_time + travel_time  # arrival at the next stop
+            connections.append(Connection(station_id, next_station_id, departure_time, time, trip, i,
+                                          schedule['train_id'], travel_time, price))
+
+    connections.sort(key=lambda c: (c.departure_time, c.arrival_time))
+    return connections
+
+
+class ConnectionScan:
+    """
+    Profile Connection Scan: a single scan over the connections (in decreasing departure time) computes, for every
+    departure event at the starting station, the earliest possible arrival at the ending station.
+    """
+
+    def __init__(self, connections: List[Connection]) -> None:
+        self.connections = connections  # sorted by departure time (see build_connections)
+
+        # per trip, the indices of its connections in stop order (needed to rebuild the ridden edges of a leg)
+        self.trip_connections: Dict[int, Dict[int, int]] = {}
+        for index, c in enumerate(connections):
+            self.trip_connections.setdefault(c.trip, {})[c.stop_index] = index
+
+    def search(self, source: int, target: int,
+               departure_after: Optional[int] = None, arrival_before: Optional[int] = None) -> List[dict]:
+        """
+        Return one journey for every departure event at source that can reach target.
+        Optionally only the journeys departing at/after departure_after or arriving at/before arrival_before are returned.
+        """
+        trip_best: Dict[int, Tuple[float, Optional[int]]] = {}  # trip -> (arrival at target, connection where to get off)
+        profiles: Dict[int, list] = {}  # station -> Pareto entries (departure, arrival, enter, exit) by decreasing departure
+        keys: Dict[int, list] = {}  # station -> negated departures of the entries (ascending, for bisect)
+        candidates = []
+
+        for index in range(len(self.connections) - 1, -1, -1):
+            c = self.connections[index]
+            if c.departure_station == target:
+                continue  # journeys end at the target
+
+            # 1. getting off at the target
+            best = (c.arrival_time, index) if c.arrival_station == target else (INFINITY, None)
+            # 2. staying on the train (ties are won by staying, so no useless changes are made)
+            stay = trip_best.get(c.trip)
+            if stay is not None and stay[0] <= best[0]:
+                best = stay
+            # 3. changing train at the arrival station
+            transfer = self._earliest_arrival(profiles, keys, c.arrival_station, c.arrival_time)
+            if transfer is not None and transfer[1] < best[0]:
+                best = (transfer[1], index)
+
+            if best[0] == INFINITY:
+                continue
+            trip_best[c.trip] = best
+
+            entry = (c.departure_time, best[0], index, best[1])
+            if c.departure_station == source and (departure_after is None or c.departure_time >= departure_after) \
+                    and (arrival_before is None or best[0] <= arrival_before):
+                candidates.append(entry)  # every departure from the source is a candidate journey
+
+            # keep only the Pareto-optimal entries (later departure or earlier arrival)
+            entries = profiles.setdefault(c.departure_station, [])
+            station_keys = keys.setdefault(c.departure_station, [])
+            if entries and entries[-1][0] == c.departure_time:
+                if best[0] < entries[-1][1]:
+                    entries[-1] = entry
+            elif not entries or best[0] < entries[-1][1]:
+                entries.append(entry)
+                station_keys.append(-c.departure_time)
+
+        return [self._journey(entry, profiles, keys, source, target) for entry in candidates]
+
+    @staticmethod
+    def _earliest_arrival(profiles, keys, station: int, time: int):
+        # the entry with the smallest departure >= time has the earliest arrival (entries are Pareto-optimal)
+        position = bisect_right(keys.get(station, []), -time) - 1
+        if position < 0:
+            return None
+        return profiles[station][position]
+
+    def _journey(self, entry, profiles, keys, source: int, target: int) -> dict:
+        # follow the pointers stored during the scan and collect the legs (one leg per train ridden)
+        legs = []
+        departure, arrival, enter, exit = entry
+        while True:
+            first, last = self.connections[enter], self.connections[exit]
+            if legs and legs[-1][-1].trip == first.trip:
+                legs[-1].extend(self._ride(first, last))  # same train, no actual change
+            else:
+                legs.append(self._ride(first, last))
+            if last.arrival_station == target:
+                break
+            _, _, enter, exit = self._earliest_arrival(profiles, keys, last.arrival_station, last.arrival_time)
+
+        waiting_time = sum(legs[i][0].departure_time - legs[i - 1][-1].arrival_time for i in range(1, len(legs)))
+        return {
+            'start_key': source,
+            'end_key': target,
+            'estimated_price': sum(c.price for leg in legs for c in leg),
+            'travel_time': arrival - departure,
+            'changes': len(legs) - 1,
+            'waiting_time': waiting_time,
+            # the ridden edges, in the format of the connections of buy_ticket
+            'legs': [{'train_id': c.train_id, 'starting_station_key': c.departure_station,
+                      'ending_station_key': c.arrival_station, 'travel_time': c.travel_time} for leg in legs for c in leg],
+        }
+
+    def _ride(self, first: Connection, last: Connection) -> List[Connection]:
+        # the connections of the trip from the first to the last one (both included)
+        stops = self.trip_connections[first.trip]
+        return [self.connections[stops[i]] for i in range(first.stop_index, last.stop_index + 1)]
+
+
+# the key of each sorting criteria in the journeys returned by ConnectionScan.search
+SORTING_KEYS = {
+    SortingCriteria.OVERALL_TRAVEL_TIME: 'travel_time',
+    SortingCriteria.NUMBER_OF_TRAIN_CHANGES: 'changes',
+    SortingCriteria.OVERALL_WAITING_TIME: 'waiting_time',
+    SortingCriteria.ESTIMATED_PRICE: 'estimated_price',
+}
+
+
+def copy_journey(journey: dict) -> dict:
+    return dict(journey, legs=[dict(leg) for leg in journey['legs']])
+
+
+class JourneyResults:
+    """
+    The journeys found by one search, with their sorting criteria kept as columns (one array per criteria), so they can
+    be ranked by any criteria, direction and limit without searching again. Only the returned journeys are sorted
+    (partial sort with a heap of size limit), the order is the one of sort_journeys.
+    """
+
+    def __init__(self, journeys: List[dict]) -> None:
+        self.journeys = journeys
+        self.columns = {key: array('d', [journey[key] for journey in journeys]) for key in SORTING_KEYS.values()}
+
+    def __len__(self) -> int:
+        return len(self.journeys)
+
+    def sort(self, sort_by: SortingCriteria = SortingCriteria.OVERALL_TRAVEL_TIME, is_ascending: bool = True,
+             limit: Optional[int] = 5) -> List[dict]:
+        """
+        Return (copies of) the journeys sorted by the given criteria (ties are broken by travel time), at most limit of them
+        """
+        column, travel_time = self.columns[SORTING_KEYS[sort_by]], self.columns['travel_time']
+
+        def key(index):
+            return column[index], travel_time[index]
+
+        indices = range(len(self.journeys))
+        if limit is None:
+            order = sorted(indices, key=key, reverse=not is_ascending)
+        elif is_ascending:
+            order = heapq.nsmallest(limit, indices, key=key)  # same as sorted(...)[:limit], ties keep their order
+        else:
+            order = heapq.nlargest(limit, indices, key=key)  # same as sorted(..., reverse=True)[:limit]
+        return [copy_journey(self.journeys[index]) for index in order]
+
+
+def sort_journeys(journeys: List[dict], sort_by: SortingCriteria, is_ascending: bool, limit: Optional[int]) -> List[dict]:
+    """
+    Sort the journeys by the given criteria (ties are broken by travel time) and return at most limit of them
+    """
+    return JourneyResults(journeys).sort(sort_by, is_ascending, limit)
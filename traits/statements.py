@@ -0,0 +1,144 @@
+import time
+from collections import OrderedDict
+from threading import RLock
+from typing import Dict, Optional, Sequence
+from weakref import WeakKeyDictionary, WeakSet
+
+# the hot statements of Traits (placeholders as %s, like for the other cursors)
+STATEMENTS = {
+    'train_status': "SELECT status FROM Trains WHERE train_id = %s",
+    'reserve_seat': "UPDATE Trains SET capacity = capacity - 1 WHERE train_id = %s AND capacity > 0",
+    'insert_ticket': "INSERT INTO Tickets (user_email, train_id, reserved_seat, price, purchase_date, start_station_key, end_station_key) VALUES (%s, %s, %s, %s, %s, %s, %s)",
+    'insert_purchase_history': "INSERT INTO PurchaseHistory (user_email, ticket_id, purchase_date) VALUES (%s, %s, %s)",
+}
+
+# MariaDB errors telling that a prepared statement is gone (connection reset or reconnected, statement deallocated)
+UNKNOWN_STMT_HANDLER = 1243  # ER_UNKNOWN_STMT_HANDLER
+NEED_REPREPARE = 1615  # ER_NEED_REPREPARE
+EVICTED_ERRORS = (UNKNOWN_STMT_HANDLER, NEED_REPREPARE)
+# the server cannot prepare more statements (max_prepared_stmt_count)
+TOO_MANY_PREPARED = 1461  # ER_MAX_PREPARED_STMT_COUNT_REACHED
+
+
+class PreparedStatements:
+    """
+    Registry of named SQL statements prepared on the server once per connection and then executed through prepared
+    cursors (only the parameters are sent, the statement is not parsed again).
+    Statements evicted by the server are prepared again transparently; if the server cannot prepare more statements,
+    the statement is sent as plain SQL. Statements built at run time (e.g. IN lists) can be executed under a name
+    too: each distinct text is prepared once and counted under that name.
+    Per statement name, stats() reports the executions and their cumulative latency.
+    """
+
+    def __init__(self, statements: Optional[Dict[str, str]] = None, max_per_connection: int = 64) -> None:
+        if max_per_connection < 1:
+            raise ValueError("At least one statement per connection must be allowed")
+
+        self.statements = dict(STATEMENTS if statements is None else statements)
+        self.max_per_connection = max_per_connection
+        self._cursors = WeakKeyDictionary()  # connection -> OrderedDict(sql -> prepared cursor), least recently used first
+        self._pools = WeakSet()  # pools whose resets are followed
+        self._lock = RLock()
+        self._stats: Dict[str, dict] = {}
+
+    def register(self, name: str, sql: str) -> None:
+        with self._lock:
+            self.statements[name] = sql
+
+    def follow_resets(self, pool) -> None:
+        """
+        Forget the statements of a ConnectionPool connection when the pool resets its session (which deallocates them)
+        """
+        with self._lock:
+            if pool not in self._pools:
+                self._pools.add(pool)
+                pool.reset_listeners.append(self.forget)
+
+    def forget(self, connection) -> None:
+        with self._lock:
+            cursors = self._cursors.pop(connection, {})
+        for cursor in cursors.values():
+            self._close(cursor)
+
+    def query(self, connection, name: str, params: Sequence = (), sql: Optional[str] = None) -> list:
+        """
+        Execute the statement and return all its rows (as tuples)
+        """
+        return self._execute(connection, name, params, sql, fetch=True)[1]
+
+    def execute(self, connection, name: str, params: Sequence = (), sql: Optional[str] = None):
+        """
+        Execute the statement and return its cursor (for rowcount and lastrowid)
+        """
+        return self._execute(connection, name, params, sql, fetch=False)[0]
+
+    def stats(self) -> Dict[str, dict]:
+        with self._lock:
+            return {name: dict(stats, average_time=stats['total_time'] / stats['executions'] if stats['executions'] else 0.0)
+                    for name, stats in self._stats.items()}
+
+    def _execute(self, connection, name: str, params: Sequence, sql: Optional[str], fetch: bool):
+        sql = sql if sql is not None else self.statements[name]
+        started = time.perf_counter()
+        attempt = 0
+        while True:
+            cursor = self._cursor(connection, name, sql)
+            try:
+                cursor.execute(sql, tuple(params))  # prepared on the server by the first execution
+                break
+            except Exception as error:
+                errno = getattr(error, 'errno', None)
+                if errno == TOO_MANY_PREPARED:  # send it as plain SQL
+                    self._evict(connection, sql)
+                    self._count(name, 'fallbacks')
+                    cursor = connection.cursor()
+                    cursor.execute(sql, tuple(params))
+                    break
+                if errno not in EVICTED_ERRORS or attempt:
+                    raise
+                # evicted by the server: prepare it again
+                self._evict(connection, sql)
+                self._count(name, 'reprepares')
+                attempt += 1
+        rows = cursor.fetchall() if fetch else None
+        self._count(name, 'executions', time.perf_counter() - started)
+        return cursor, rows
+
+    def _cursor(self, connection, name: str, sql: str):
+        with self._lock:
+            cursors = self._cursors.setdefault(connection, OrderedDict())
+            cursor = cursors.get(sql)
+            if cursor is not None:
+                cursors.move_to_end(sql)
+                return cursor
+
+            cursor = connection.cursor(prepared=True)
+            cursors[sql] = cursor
+            while len(cursors) > self.max_per_connection:  # keep within the server limits
+                self._close(cursors.popitem(last=False)[1])
+        self._count(name, 'prepares')
+        return cursor
+
+    def _evict(self, connection, sql: str) -> None:
+        with self._lock:
+            cursor = self._cursors.get(connection, {}).pop(sql, None)
+        if cursor is not None:
+            self._close(cursor)
+
+    def _count(self, name: str, counter: str, elapsed: float = 0.0) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(name, {'executions': 0, 'total_time': 0.0, 'prepares': 0, 'reprepares': 0,
+                                                  'fallbacks': 0})
+            stats[counter] += 1
+            stats['total_time'] += elapsed
+
+    @staticmethod
+    def _close(cursor) -> None:
+        try:
+            cursor.close()
+        except Exception:  # the connection may be gone already
+            pass
+
+
+# registry shared by the Traits instances (connections may be shared through pools)
+prepared_statements = PreparedStatements()
@@ -0,0 +1,61 @@
+import asyncio
+import time
+from typing import Callable
+
+# MariaDB errors after which the whole transaction can simply be run again
+DEADLOCK = 1213  # ER_LOCK_DEADLOCK
+LOCK_WAIT_TIMEOUT = 1205  # ER_LOCK_WAIT_TIMEOUT
+RETRYABLE_ERRORS = (DEADLOCK, LOCK_WAIT_TIMEOUT)
+
+
+def error_code(error: Exception):
+    """
+    Return the MariaDB error number of error (errno for mysql.connector, the first argument for PyMySQL and aiomysql)
+    """
+    code = getattr(error, 'errno', None)
+    if code is None and error.args and isinstance(error.args[0], int):
+        code = error.args[0]
+    return code
+
+
+def run_transaction(connection, work: Callable, retries: int = 3, backoff: float = 0.01, **cursor_options):
+    """
+    Run work(cursor) in a transaction on the given connection and commit it, returning the result of work.
+    On any error the transaction is rolled back; deadlocks and lock wait timeouts are retried (with exponential backoff)
+    up to retries times, every other error is raised.
+    """
+    attempt = 0
+    while True:
+        try:
+            with connection.cursor(**cursor_options) as cursor:
+                result = work(cursor)
+            connection.commit()
+            return result
+        except Exception as error:
+            connection.rollback()
+            if error_code(error) not in RETRYABLE_ERRORS or attempt >= retries:
+                raise
+            time.sleep(backoff * 2 ** attempt)
+            attempt += 1
+
+
+async def run_async_transaction(pool, work: Callable, retries: int = 3, backoff: float = 0.01, cursor_class=None):
+    """
+    Like run_transaction, on a connection checked out of an async pool (aiomysql) for the whole transaction:
+    work(cursor) is awaited, the connection is returned to the pool at the end (committed or rolled back).
+    """
+    attempt = 0
+    async with pool.acquire() as connection:
+        while True:
+            try:
+                await connection.begin()
+                async with (connection.cursor(cursor_class) if cursor_class else connection.cursor()) as cursor:
+                    result = await work(cursor)
+                await connection.commit()
+                return result
+            except Exception as error:
+                await connection.rollback()
+                if error_code(error) not in RETRYABLE_ERRORS or attempt >= retries:
+                    raise
+                await asyncio.sleep(backoff * 2 ** attempt)
+                attempt += 1
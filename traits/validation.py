@@ -0,0 +1,124 @@
+from typing import Iterable, Optional, Set, Tuple
+
+from traits.graph import StationGraph
+from traits.statements import PreparedStatements
+
+
+class MissingKeysError(ValueError):
+    """
+    ValueError raised when stations, trains or users do not exist; the missing keys are available as attributes
+    """
+
+    def __init__(self, message: str, stations: Iterable = (), trains: Iterable = (), users: Iterable = ()) -> None:
+        super().__init__(message)
+        self.missing_stations = sorted(stations)
+        self.missing_trains = sorted(trains)
+        self.missing_users = sorted(users)
+
+
+class ExistenceValidator:
+    """
+    Checks the existence of any number of station keys, train keys and user emails with at most one query per database:
+    stations are looked up in the snapshot of the station graph (or with one UNWIND-like IN query if not given),
+    trains and users with a single IN query on MariaDB.
+    """
+
+    def __init__(self, neo4j_driver, station_graph: Optional[StationGraph] = None,
+                 statements: Optional[PreparedStatements] = None) -> None:
+        self.neo4j_driver = neo4j_driver
+        self.station_graph = station_graph
+        self.statements = statements  # registry of prepared statements used for the MariaDB query (if given)
+
+    def check(self, rdbms_connection=None, stations: Iterable[int] = (), trains: Iterable[int] = (),
+              users: Iterable[str] = ()) -> None:
+        """
+        Raise a MissingKeysError if any of the given keys does not exist.
+        rdbms_connection is the connection used to check trains and users (not needed for stations only).
+        """
+        missing_trains, missing_users = self.missing_rows(rdbms_connection, trains, users, self.statements)
+        self.raise_missing(self.missing_stations(stations), missing_trains, missing_users)
+
+    async def check_async(self, cursor, stations: Iterable[int] = (), trains: Iterable[int] = (),
+                          users: Iterable[str] = ()) -> None:
+        """
+        Like check, with a cursor of an async (aiomysql) connection to check trains and users (the station graph
+        snapshot must be loaded)
+        """
+        missing_trains, missing_users = await self.missing_rows_async(cursor, trains, users)
+        self.raise_missing(self.missing_stations(stations), missing_trains, missing_users)
+
+    @staticmethod
+    def raise_missing(missing_stations: Set[int], missing_trains: Set[int], missing_users: Set[str]) -> None:
+        # same messages as the single checks they replace
+        if missing_users:
+            message = "User does not exist"
+        elif missing_trains:
+            message = "Train does not exist"
+        elif missing_stations:
+            message = "One or both stations do not exist"
+        else:
+            return
+        raise MissingKeysError(message, missing_stations, missing_trains, missing_users)
+
+    def missing_stations(self, stations: Iterable[int]) -> Set[int]:
+        stations = set(stations)
+        if not stations:
+            return set()
+        if self.station_graph is not None:
+            return {station_id for station_id in stations if not self.station_graph.has_station(station_id)}
+
+        with self.neo4j_driver.session() as session:
+            result = session.run("MATCH (s:Station) WHERE s.station_id IN $ids RETURN s.station_id AS station_id",
+                                 ids=list(stations))
+            return stations - {record['station_id'] for record in result}
+
+    @staticmethod
+    def missing_rows(rdbms_connection, trains: Iterable[int] = (), users: Iterable[str] = (),
+                     statements: Optional[PreparedStatements] = None) -> Tuple[Set[int], Set[str]]:
+        """
+        Return the train ids and user emails that do not exist (one query for both)
+        """
+        trains, users = {int(train_id) for train_id in trains}, set(users)  # compared with the ids read back as int
+        if not trains and not users:
+            return set(), set()
+
+        query, params = ExistenceValidator._existence_query(trains, users)
+        if statements is not None:
+            found = statements.query(rdbms_connection, 'existence_check', params, sql=query)
+        else:
+            with rdbms_connection.cursor() as cursor:
+                cursor.execute(query, tuple(params))
+                found = cursor.fetchall()
+        return ExistenceValidator._missing(trains, users, found)
+
+    @staticmethod
+    async def missing_rows_async(cursor, trains: Iterable[int] = (), users: Iterable[str] = ()) -> Tuple[Set[int], Set[str]]:
+        """
+        Like missing_rows, with a cursor of an async (aiomysql) connection
+        """
+        trains, users = {int(train_id) for train_id in trains}, set(users)
+        if not trains and not users:
+            return set(), set()
+
+        query, params = ExistenceValidator._existence_query(trains, users)
+        await cursor.execute(query, tuple(params))
+        return ExistenceValidator._missing(trains, users, await cursor.fetchall())
+
+    @staticmethod
+    def _existence_query(trains: Set[int], users: Set[str]) -> Tuple[str, list]:
+        queries, params = [], []
+        if trains:
+            queries.append(f"SELECT 'train', CAST(train_id AS CHAR) FROM Trains WHERE train_id IN ({', '.join(['%s'] * len(trains))})")
+            params.extend(trains)
+        if users:
+            queries.append(f"SELECT 'user', email FROM Users WHERE email IN ({', '.join(['%s'] * len(users))})")
+            params.extend(users)
+        return " UNION ALL ".join(queries), params
+
+    @staticmethod
+    def _missing(trains: Set[int], users: Set[str], found) -> Tuple[Set[int], Set[str]]:
+        # prepared cursors may return the strings as bytes
+        found = [tuple(v.decode() if isinstance(v, (bytes, bytearray)) else v for v in row) for row in found]
+        found_trains = {int(key) for kind, key in found if kind == 'train'}
+        found_users = {key.lower() for kind, key in found if kind == 'user'}  # emails are compared case-insensitively
+        return trains - found_trains, {email for email in users if email.lower() not in found_users}